@@ -14,6 +14,7 @@ import time
 import argparse
 from databaseapps.objectcatalog import ObjectCatalog
 from databaseapps.objectcatalog import Timing
+from databaseapps.Throttle import Throttle
 
 def checkParam(_args, param, required):
     """ Check whether the required arguments are present
@@ -61,6 +62,13 @@ def main():
     parser.add_argument('-dump', action='store')
     parser.add_argument('-section', '-s', help='db section in the desservices file')
     parser.add_argument('-des_services', help='desservices file')
+    parser.add_argument('-throttle_sessions', action='store', type=int,
+                        help='maximum number of concurrent insert sessions of all ingest jobs on this node')
+    parser.add_argument('-throttle_rows', action='store', type=float,
+                        help='maximum number of rows per second inserted by all ingest jobs on this node')
+    parser.add_argument('-throttle_dir', action='store', help='directory holding the throttle lock files')
+    parser.add_argument('-reingest', action='store_true',
+                        help='remove any rows already loaded from the file before ingesting it')
 
     args, _ = parser.parse_known_args()
     args = vars(args)
@@ -77,6 +85,7 @@ def main():
 
     if request is None or filename is None or filetype is None or targettable is None:
         return 1
+    ObjectCatalog.throttle = Throttle(args['throttle_dir'], args['throttle_sessions'], args['throttle_rows'])
     printinfo(runtime.report("INITIALIZE"))
     objectcat = ObjectCatalog(request=request,
                               filetype=filetype,
@@ -91,6 +100,9 @@ def main():
 
     objectcat.createIngestTable()
     printinfo(runtime.report("CREATE"))
+    if args['reingest']:
+        objectcat.purge()
+        printinfo(runtime.report("PURGE"))
     objectcat.executeIngest()
     printinfo(runtime.report(f"LOAD {str(objectcat.getNumObjects())}"))
     printinfo("catalogIngest load of " + str(objectcat.getNumObjects()) + " objects from " + filename + " completed")
@@ -21,6 +21,8 @@ def main():
     parser.add_argument('--filetype', action='store', required=True)
     parser.add_argument('--section', '-s', help='db section in the desservices file')
     parser.add_argument('--des_services', help='desservices file')
+    parser.add_argument('--reingest', action='store_true',
+                        help='remove any rows already loaded from the file before ingesting it')
 
     args = parser.parse_args()
     args = vars(args)
@@ -33,6 +35,8 @@ def main():
         print("datafile_ingest.py: Preparing to ingest " + fullname)
         dbh = DesDmDbi(args['des_services'], args['section'])
         [tablename, didatadefs] = dbh.get_datafile_metadata(filetype)
+        if args['reingest']:
+            dfiutils.purge_file(fullname, tablename, dbh)
 
         numrows = dfiutils.datafile_ingest_main(dbh, filetype, fullname, tablename, didatadefs)
         if numrows is None or numrows == 0:
@@ -4,14 +4,24 @@
 """
 import sys
 import time
+import os
+import json
 import argparse
+import functools
 import traceback
 from despydb import desdbi
 from databaseapps.CoaddCatalog import CoaddCatalog
-from databaseapps.CoaddHealpix import CoaddHealpix
 from databaseapps.Mangle import Mangle
-from databaseapps.Wavg import Wavg
-from databaseapps.Extinction import Extinction
+from databaseapps.IngestTask import IngestTask
+from databaseapps.IngestScheduler import IngestScheduler
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.Ingest import Ingest
+from databaseapps.Throttle import Throttle
+from databaseapps.Ledger import Ledger
+from databaseapps.IdMapCache import IdMapCache
+from databaseapps.SharedIdMap import SharedIdMap
+from databaseapps.ReadAhead import ReadAhead
+from databaseapps.WorkQueue import WorkQueue
 
 def checkParam(_args, param, required):
     """ Check that a parameter exists, else return None
@@ -30,31 +40,78 @@ def printinfo(msg):
     """
     print(time.strftime(CoaddCatalog.debugDateFormat) + " - " + msg)
 
-def getfilelist(_file):
-    """ Convert a comma separated list of items in a file into a list
+def backfill(args, dbh, tasks, attributes, alt_section, det_pfwid):
+    """ Update the given columns for the already ingested coadd and wavg
+        catalogs, rather than ingesting them
 
     """
-    files = []
-    f = open(_file, 'r')
-    lines = f.readlines()
-    for line in lines:
-        files.append(line.split(","))
-        files[-1][-1] = files[-1][-1].strip()
-    f.close()
-    return files
-
-def main():
-    """
-        main function
-    """
-    # var to hold to COADD_OBJECT_ID's
+    retval = 0
     coaddObjectIdDict = {}
+    status = [" completed", " aborted"]
+    for task in tasks:
+        if task.stage not in ('det', 'band', 'wavg'):
+            continue
+        label = task.label
+        datafile = task.datafile
+        try:
+            printinfo("Backfilling " + label + " " + datafile)
+            with task.create(coaddObjectIdDict, dbh) as obj:
+                if task.stage == 'det':
+                    if args['alt_table'] is not None:
+                        obj.retrieveCoaddObjectIds(args['des_services'], alt_section, det_pfwid, args['alt_table'])
+                        printinfo("Detection catalog is in the alternate table, skipping it")
+                        continue
+                    obj.retrieveCoaddObjectIds()
+                    if not coaddObjectIdDict:
+                        print("Detection catalog has not been ingested, cannot backfill")
+                        return 1
+                # only update the requested columns this filetype actually has
+                attrs = [att for att in attributes if att.upper() in obj.dbDict[obj.objhdu]]
+                if not attrs:
+                    printinfo("None of the backfill columns apply to " + datafile + ", skipping")
+                    continue
+                if obj.numAlreadyIngested() == 0:
+                    print("File " + datafile + " has not been ingested, cannot backfill it")
+                    retval += 1
+                    continue
+                stat = obj.backfillColumns(attrs)
+                retval += obj.getstatus()
+                printinfo("Backfill of " + label + " " + datafile + status[stat] + "\n")
+        except:  # pragma: no cover
+            se = sys.exc_info()
+            e = se[1]
+            tb = se[2]
+            print("Exception raised:", e)
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            retval += 1
 
-    retval = 0
+    return retval
 
+# banners printed before the first file of a stage
+banners = {'healpix': "\n###################### HEALPIX INGESTION ########################\n",
+           'wavg': "\n###################### WEIGHTED AVERAGE INGESTION ########################\n",
+           'ccdgon': "\n###################### MANGLE INGESTION ########################\n",
+           'extinct': "\n###################### EXTINCTION INGESTION ########################\n"}
+skipnames = {'band': 'Coadd Band catalog',
+             'healpix': 'Healpix',
+             'wavg': 'Weighted Average',
+             'wavg_oclink': 'Weighted Average OCLink',
+             'ccdgon': 'CCDgon',
+             'molygon': 'Molygon',
+             'molygon_ccdgon': 'Molygon CCDgon',
+             'coadd_object_molygon': 'Coadd Object Molygon',
+             'extinct': 'Extinction',
+             'extinct_band': 'Extinction Band'}
+
+def parseArgs():
+    """ Parse the command line
+
+    """
     parser = argparse.ArgumentParser(description='Ingest coadd objects from fits catalogs')
     parser.add_argument('--bandcat_list', action='store')
-    parser.add_argument('--detcat', action='store', required=True)
+    parser.add_argument('--detcat', action='store')
     parser.add_argument('--extinct', action='store')
     parser.add_argument('--extinct_band_list', action='store')
     parser.add_argument('--healpix', action='store')
@@ -79,34 +136,138 @@ def main():
     parser.add_argument('--alt_section', action='store')
     parser.add_argument('--det_pfwid', action='store')
     parser.add_argument('--alt_table', action='store')
-
+    parser.add_argument('--metadata_cache', action='store', help='local file to persist the ingest metadata in')
+    parser.add_argument('--metadata_ttl', action='store', type=float, default=3600.,
+                        help='seconds before persisted metadata is re-queried')
+    parser.add_argument('--reingest', action='store_true',
+                        help='remove any rows already loaded from each file before ingesting it')
+    parser.add_argument('--delta', action='store_true',
+                        help='for catalogs which are already loaded, only ingest the objects not yet in the database')
+    parser.add_argument('--delta_delete', action='store_true',
+                        help='with --delta, also delete the objects which are no longer in the catalogs, except from the detection catalog')
+    parser.add_argument('--sort_key', action='store',
+                        help='column to sort the coadd catalog rows by before insertion, or a RA,DEC column pair to sort them by healpix')
+    parser.add_argument('--throttle_sessions', action='store', type=int,
+                        help='maximum number of concurrent insert sessions of all ingest jobs on this node')
+    parser.add_argument('--throttle_rows', action='store', type=float,
+                        help='maximum number of rows per second inserted by all ingest jobs on this node')
+    parser.add_argument('--throttle_dir', action='store', help='directory holding the throttle lock files')
+    parser.add_argument('--ledger_dir', action='store',
+                        help='directory of the local ledger of completed ingests, used to skip unchanged files on reruns')
+    parser.add_argument('--jobs', action='store', type=int, default=1,
+                        help='number of files to ingest at once, each on its own db connection, after the detection catalog')
+    parser.add_argument('--processes', action='store_true',
+                        help='with --jobs, use worker processes sharing the coadd object ids through a shared id map (threads are used instead with a work queue, whose heartbeat thread makes forking unsafe)')
+    parser.add_argument('--shared_idmap', action='store_true',
+                        help='publish the coadd object ids to a memory mapped file other runs on this node can attach to')
+    parser.add_argument('--idmap_dir', action='store', help='directory of the shared id maps, default is /dev/shm')
+    parser.add_argument('--keep_idmap', action='store_true',
+                        help='leave the shared id map of each tile in place for later runs on this node, rather than removing it after the tile')
+    parser.add_argument('--id_reserve_func', action='store',
+                        help='database function reserving a contiguous block of coadd object ids, given the sequence name and number of ids and returning the first id; default is to reserve the block by stepping the sequence, or if that is not allowed to take the ids from the sequence one by one')
+    parser.add_argument('--idmap_cache_dir', action='store',
+                        help='directory of a local cache of the coadd object ids retrieved from the database, reused on reruns')
+    parser.add_argument('--readahead_mb', action='store', type=float, default=0.,
+                        help='MB to read ahead from the start of the next file while one is ingested, from a background thread (e.g. 64), default is 0 (no read ahead)')
+    parser.add_argument('--mangle_jobs', action='store', type=int, default=1,
+                        help='number of processes parsing each large mangle csv file, limited so that jobs times mangle_jobs is at most the number of cpus; ignored (one process) when other threads are running, i.e. with --readahead_mb, --queue_dir, or --jobs > 1 without --processes')
+    parser.add_argument('--coalesce_mb', action='store', type=float, default=0.,
+                        help='insert the files of a stage smaller than this many MB together, sharing statements and commits')
+    parser.add_argument('--manifest', action='store',
+                        help='JSON file listing many tiles to ingest in this process, each an object of the per tile options (detcat, bandcat_list, ...)')
+    parser.add_argument('--queue_dir', action='store',
+                        help='shared directory of a work queue of tiles: ingest tiles claimed from it until none are left')
+    parser.add_argument('--queue_submit', action='store_true',
+                        help='with --queue_dir, add the tiles of the manifest to the work queue and exit')
+    parser.add_argument('--queue_lease', action='store', type=float, default=600.,
+                        help='seconds after which a tile claimed by a worker which stopped renewing it is returned to the queue')
+    parser.add_argument('--backfill_columns', action='store',
+                        help='comma separated list of columns to update in the already ingested coadd and wavg catalogs, instead of ingesting')
 
     args, _ = parser.parse_known_args()
     args = vars(args)
+    if not args['detcat'] and not args['manifest'] and not args['queue_dir']:
+        parser.error("one of --detcat, --manifest or --queue_dir is required")
+    if args['queue_submit'] and not (args['queue_dir'] and args['manifest']):
+        parser.error("--queue_submit needs --queue_dir and --manifest")
+    return args
+
+def readManifest(manifest, args):
+    """ Read the list of tiles from a manifest, returning the complete
+        arguments of each tile: those given on the command line updated with
+        the ones of the tile
+
+    """
+    with open(manifest, 'r') as fh:
+        tiles = json.load(fh)
+    if isinstance(tiles, dict):
+        tiles = tiles['tiles']
+    return [tileArgs(tile, args, f"tile {i:d} of {manifest}") for i, tile in enumerate(tiles)]
+
+def tileArgs(tile, args, where):
+    """ Get the complete arguments of a tile of a manifest or work queue
+
+    """
+    unknown = set(tile) - set(args) - {'name'}
+    if unknown:
+        raise Exception(f"Unknown options {', '.join(sorted(unknown))} for {where}")
+    if not tile.get('detcat'):
+        raise Exception(f"{where[0].upper() + where[1:]} has no detcat")
+    targs = dict(args, **{key: val for key, val in tile.items() if key != 'name'})
+    targs['name'] = tile.get('name', os.path.basename(tile['detcat']))
+    return targs
+
+def checkClaim(lost):
+    """ Stop the ingest of a tile if its claim on the work queue has been lost,
+        so it is not ingested by two workers at once
+
+    """
+    if lost is not None and lost.is_set():
+        raise Exception("The claim on the tile was lost, abandoning it")
+
+def ingestTile(args, dbh, scheduler, lost=None):
+    """ Ingest the detection catalog and all other files of one tile. If the
+        lost event is set (the claim on the tile from a work queue has been
+        lost) the ingest is abandoned before the next file.
+
+        Returns the number of failures
+    """
+    # var to hold to COADD_OBJECT_ID's
+    coaddObjectIdDict = {}
+
+    retval = 0
 
-    bandcat = checkParam(args, 'bandcat_list', False)
     detcat = checkParam(args, 'detcat', True)
-    extinct = checkParam(args, 'extinct', False)
-    extinct_band = checkParam(args, 'extinct_band_list', False)
-    healpix = checkParam(args, 'healpix', False)
-    wavg = checkParam(args, 'wavg_list', False)
-    wavg_oclink = checkParam(args, 'wavg_oclink_list', False)
-    ccdgon = checkParam(args, 'ccdgon_list', False)
-    molygon = checkParam(args, 'molygon_list', False)
-    molygon_ccdgon = checkParam(args, 'molygon_ccdgon_list', False)
-    coadd_object_molygon = checkParam(args, 'coadd_object_molygon_list', False)
     section = checkParam(args, 'section', False)
-    services = checkParam(args, 'des_services', False)
     alt_section = checkParam(args, 'alt_section', False)
     det_pfwid = checkParam(args, 'det_pfwid', False)
     alt_table = checkParam(args, 'alt_table', False)
+    options = {'reingest': args['reingest'],
+               'delta': args['delta'],
+               'deleteMissing': args['delta_delete']}
+    sortkey = None
+    if args['sort_key']:
+        sortkey = tuple(key.strip() for key in args['sort_key'].split(','))
+        if len(sortkey) == 1:
+            sortkey = sortkey[0]
+
+    # load the metadata for every filetype this tile will touch in one go
+    tasks = IngestTask.fromArgs(args)
+    MetadataCache.prefetch(dbh, [task.filetype for task in tasks])
 
-    status = [" completed", " aborted"]
-    dbh = desdbi.DesDbi(services, section, retry=True)
     # do some quick checking
     try:
         if alt_section is None:
             alt_section = section
+        # the catalog table info of the detection and band catalogs in one
+        # query, dropping that of the previous tile
+        CoaddCatalog.catalogInfo.clear()
+        missing = CoaddCatalog.prefetchCatalogInfo(dbh, [task.shortfilename for task in tasks
+                                                         if task.ingestclass is CoaddCatalog])
+        if missing:
+            raise Exception("Files missing from the catalog table: " + ', '.join(missing))
+        if alt_table is not None and det_pfwid is None:
+            det_pfwid = CoaddCatalog.catalogInfo[tasks[0].shortfilename][2]
         if alt_table is not None and det_pfwid is None:
             print("Getting det_pfwid from database.")
             curs = dbh.cursor()
@@ -132,277 +293,253 @@ def main():
         print("Traceback: ")
         traceback.print_tb(tb)
         print(" ")
-        sys.exit(1)
+        return 1
+
+
+    if args['backfill_columns']:
+        print("\n###################### COLUMN BACKFILL ########################\n")
+        return backfill(args, dbh, tasks, [att.strip() for att in args['backfill_columns'].split(',')],
+                        alt_section, det_pfwid)
+
+    options.update({'sortkey': sortkey,
+                    'alt_table': alt_table,
+                    'des_services': args['des_services'],
+                    'alt_section': alt_section,
+                    'det_pfwid': det_pfwid})
 
+    # find which files already have rows in the database, in one query per table
+    IngestTask.preflight(tasks, dbh)
 
     print("\n###################### COADD OBJECT INGESTION ########################\n")
-    try:
-        printinfo("Working on detection catalog " + detcat)
-        detobj = CoaddCatalog(ingesttype='det', filetype=args['coadd_object_filetype'], datafile=detcat, idDict=coaddObjectIdDict, dbh=dbh)
+    detTask = tasks[0]
+    idmap = None
+    published = False
+    if args['shared_idmap'] or args['processes']:
+        # the ids are only valid for the same table in the same database
+        mappath = SharedIdMap.mapPath(f"{section}_{MetadataCache.getTableName(detTask.filetype, dbh)}_{detTask.shortfilename}",
+                                      args['idmap_dir'])
+        if alt_table is None and not args['reingest'] and not args['delta'] and detTask.numIngested:
+            # another run on this node may have kept the ids it published
+            idmap = SharedIdMap.attach(mappath)
+            if idmap is not None:
+                with detTask.create({}, dbh) as detobj:
+                    nrows, maxid = detobj.countCoaddObjectIds()
+                if len(idmap) != nrows or idmap.maxId() != maxid:
+                    printinfo(f"Shared id map {mappath} does not match the database, ignoring it")
+                    idmap = None
+    # the files in the order they are ingested when run one at a time
+    ordered = [task for stage, *_ in IngestTask.mepochStages for task in tasks if task.stage == stage]
+    readahead = ReadAhead(int(args['readahead_mb'] * (1 << 20)) if args['jobs'] == 1 else 0)
+    if ordered:
+        readahead.warm(ordered[0].datafile)
+
+    if idmap is not None:
+        printinfo(f"Using the {len(idmap):d} coadd object ids in the shared id map {mappath}")
+    else:
+        if args['reingest'] and alt_table is None:
+            # the other files hold the ids of the detection catalog, so they
+            # must go before it is purged
+            IngestTask.purgeDependents(tasks[1:], dbh)
+        retval += detTask.run(coaddObjectIdDict, dbh, options)
+
+        # do a sanity check, as these numbers are needed for the following steps
+        if not coaddObjectIdDict:
+            print("Coadd Object Dict is empty, cannot continue")
+            readahead.close()
+            return 1
+        if args['shared_idmap'] or args['processes']:
+            idmap = SharedIdMap.publish(coaddObjectIdDict, mappath)
+            published = True
+            printinfo(f"Published {len(idmap):d} coadd object ids to {mappath}")
+    # a dict is faster per lookup, so only use the shared map where needed
+    idDict = coaddObjectIdDict if coaddObjectIdDict and not args['processes'] else idmap
 
-        if alt_table is not None:
-            detobj.retrieveCoaddObjectIds(args['des_services'], alt_section, det_pfwid, alt_table)
+    try:
+        checkClaim(lost)
+        if args['jobs'] > 1:
+            # everything else only depends on the detection catalog
+            for stage, *_ in IngestTask.mepochStages:
+                if not [task for task in tasks if task.stage == stage]:
+                    print(f"Skipping {skipnames[stage]} ingestion, none specified on command line")
+            printinfo(f"Ingesting {len(tasks) - 1:d} files with {args['jobs']:d} jobs")
+            retval += scheduler.run(tasks[1:], idDict, options)
         else:
-            isLoaded = detobj.isLoaded()
-            if isLoaded:
-                detobj.retrieveCoaddObjectIds()
-            else:
-                detobj.getIDs()
-                stat = detobj.executeIngest()
-                retval += detobj.getstatus()
-                printinfo("Ingest of detection catalog " + detcat + status[stat] + "\n")
+            coalesce = args['coalesce_mb'] * (1 << 20)
+            with readahead:
+                for stage, *_ in IngestTask.mepochStages:
+                    if stage in banners:
+                        print(banners[stage])
+                    stagetasks = [task for task in tasks if task.stage == stage]
+                    if not stagetasks:
+                        print(f"Skipping {skipnames[stage]} ingestion, none specified on command line")
+                    # small files are inserted together, after the others
+                    small = [task for task in stagetasks if task.size() < coalesce]
+                    for task in stagetasks:
+                        if task in small:
+                            continue
+                        # warm the next file while this one is ingested
+                        pos = ordered.index(task)
+                        if pos + 1 < len(ordered):
+                            readahead.warm(ordered[pos + 1].datafile)
+                        checkClaim(lost)
+                        retval += task.run(idDict, dbh, options)
+                    if small:
+                        checkClaim(lost)
+                        retval += IngestTask.runCoalesced(small, idDict, dbh, options)
+    finally:
+        # the map lives in memory (/dev/shm), so it must not outlive the tile
+        if published and not args['keep_idmap']:
+            idmap.unlink()
+
+    return retval
+
+def runTile(targs, dbh, scheduler, lost=None):
+    """ Ingest one tile of a manifest or work queue, rolling back anything
+        left uncommitted if it fails or its claim on the work queue is lost
+
+        Returns
+        -------
+        tuple
+            The return value and the time taken
+    """
+    tilestart = time.time()
+    try:
+        tileret = ingestTile(targs, dbh, scheduler, lost)
     except:  # pragma: no cover
         se = sys.exc_info()
         e = se[1]
         tb = se[2]
-        print("Exception raised:", e)
+        print(f"Exception raised ingesting tile {targs['name']}:", e)
         print("Traceback: ")
         traceback.print_tb(tb)
         print(" ")
-        return 1
-
-    # do a sanity check, as these numbers are needed for the following steps
-    if not coaddObjectIdDict:
-        print("Coadd Object Dict is empty, cannot continue")
-        return 1
+        dbh.rollback()
+        tileret = 1
+    return tileret, time.time() - tilestart
 
-    if bandcat is not None:
-        bandfiles = getfilelist(bandcat)
-        for bandfile in bandfiles:
-            try:
-                bfile = bandfile[0]
-                printinfo("Working on band catalog " + bfile)
-                bandobj = CoaddCatalog(ingesttype='band', filetype=args['coadd_object_filetype'], datafile=bfile, idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = bandobj.isLoaded()
-                if not isLoaded:
-                    stat = bandobj.executeIngest()
-                    retval += bandobj.getstatus()
-                    printinfo("Ingest of band catalog " + bfile + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised3:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Coadd Band catalog ingestion, none specified on command line")
+def submitQueue(args):
+    """ Add the tiles of the manifest to the work queue, skipping those
+        already in it
 
-    print("\n###################### HEALPIX INGESTION ########################\n")
-    if healpix is not None:
-        try:
-            printinfo("Working on healpix catalog " + healpix)
-            healobj = CoaddHealpix(filetype=args['coadd_hpix_filetype'], datafile=healpix, idDict=coaddObjectIdDict, dbh=dbh)
-            isLoaded = healobj.isLoaded()
-            if not isLoaded:
-                stat = healobj.executeIngest()
-                retval += healobj.getstatus()
-                printinfo("Ingest of healpix catalog " + healpix + status[stat] + "\n")
-        except:  # pragma: no cover
-            se = sys.exc_info()
-            e = se[1]
-            tb = se[2]
-            print("Exception raised4:", e)
-            print("Traceback: ")
-            traceback.print_tb(tb)
-            print(" ")
-            retval += 1
-    else:
-        print("Skipping Healpix ingestion, none specified on command line")
-
-
-    print("\n###################### WEIGHTED AVERAGE INGESTION ########################\n")
-
-    if wavg is not None:
-        wavgfiles = getfilelist(wavg)
-        for _file in wavgfiles:
-            try:
-                printinfo("Working on wavg catalog " + _file[0])
-                wavgobj = Wavg(filetype=args['wavg_filetype'], datafile=_file[0], idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = wavgobj.isLoaded()
-                if not isLoaded:
-                    stat = wavgobj.executeIngest()
-                    retval += wavgobj.getstatus()
-                    printinfo("Ingest of wavg catalog " + _file[0] + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised5:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Weighted Average ingestion, none specified on command line")
-
-    if wavg_oclink is not None:
-        wavgfiles = getfilelist(wavg_oclink)
-        for _file in wavgfiles:
-            try:
-                printinfo("Working on wavg_oclink catalog " + _file[0])
-                wavgobj = Wavg(filetype=args['wavg_oclink_filetype'], datafile=_file[0], idDict=coaddObjectIdDict, dbh=dbh, matchCount=False)
-                isLoaded = wavgobj.isLoaded()
-                if not isLoaded:
-                    stat = wavgobj.executeIngest()
-                    retval += wavgobj.getstatus()
-                    printinfo("Ingest of wavg_oclink catalog " + _file[0] + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised6:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Weighted Average OCLink ingestion, none specified on command line")
-
-    print("\n###################### MANGLE INGESTION ########################\n")
-
-    if ccdgon is not None:
-        ccdfiles = getfilelist(ccdgon)
-        for _file in ccdfiles:
-            try:
-                printinfo("Working on ccdgon file " + _file[0])
-                ccdobj = Mangle(datafile=_file[0], filetype=args['ccdgon_filetype'], idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = ccdobj.isLoaded()
-                if not isLoaded:
-                    stat = ccdobj.executeIngest()
-                    retval += ccdobj.getstatus()
-                    printinfo("Ingest of ccdgon file " + _file[0] + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised7:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping CCDgon ingestion, none specified on command line")
-
-    if molygon is not None:
-        molyfiles = getfilelist(molygon)
-        for _file in molyfiles:
-            try:
-                printinfo("Working on molygon file " + _file[0])
-                molyobj = Mangle(datafile=_file[0], filetype=args['molygon_filetype'], idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = molyobj.isLoaded()
-                if not isLoaded:
-                    stat = molyobj.executeIngest()
-                    retval += molyobj.getstatus()
-                    printinfo("Ingest of molygon file " + _file[0] + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised8:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Molygon ingestion, none specified on command line")
+    """
+    try:
+        readManifest(args['manifest'], args)
+        with open(args['manifest'], 'r') as fh:
+            tiles = json.load(fh)
+    except:  # pragma: no cover
+        se = sys.exc_info()
+        print("Exception raised reading the manifest:", se[1])
+        return 1
+    if isinstance(tiles, dict):
+        tiles = tiles['tiles']
+    queue = WorkQueue(args['queue_dir'], args['queue_lease'])
+    added = sum(1 for tile in tiles if queue.submit(tile.get('name', os.path.basename(tile['detcat'])), tile))
+    printinfo(f"Added {added:d} of {len(tiles):d} tiles to the work queue {args['queue_dir']}")
+    print("EXITING WITH RETVAL", 0)
+    return 0
+
+def runQueue(args, dbh, scheduler, timings):
+    """ Claim and ingest tiles from a shared work queue until none are left,
+        returning claims left behind by crashed workers to the queue
 
-    if molygon_ccdgon is not None:
-        mcfiles = getfilelist(molygon_ccdgon)
-        for _file in mcfiles:
+    """
+    queue = WorkQueue(args['queue_dir'], args['queue_lease'])
+    retval = 0
+    while True:
+        for name in queue.reclaim():
+            printinfo(f"The claim on {name} has expired, returning it to the queue")
+        claimed = queue.claim()
+        if claimed is None:
+            if queue.counts()['claimed'] == 0:
+                break
+            # wait in case a worker still holding tiles crashes
+            time.sleep(min(queue.lease / 3., 60.))
+            continue
+        name, tile = claimed
+        print(f"\n###################### TILE {name} ({queue.owner}) ########################\n")
+        with queue.holding(name) as lost:
             try:
-                printinfo("Working on molygon_ccdgon file " + _file[0])
-                mcobj = Mangle(datafile=_file[0], filetype=args['molygon_ccdgon_filetype'], idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = mcobj.isLoaded()
-                if not isLoaded:
-                    stat = mcobj.executeIngest()
-                    retval += mcobj.getstatus()
-                    printinfo("Ingest of molygon_ccdgon file " + _file[0] + status[stat] + "\n")
+                targs = tileArgs(tile, args, f"tile {name}")
+                tileret, elapsed = runTile(targs, dbh, scheduler, lost)
             except:  # pragma: no cover
                 se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised9:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Molygon CCDgon ingestion, none specified on command line")
+                print(f"Exception raised ingesting tile {name}:", se[1])
+                tileret, elapsed = 1, 0.
+        if not queue.complete(name, tileret == 0):
+            # another worker has the tile now, so this run does not count
+            printinfo(f"The claim on {name} was lost before it was completed, counting it as failed")
+            tileret = max(tileret, 1)
+        retval += tileret
+        timings.append((name, tileret, elapsed))
+    counts = queue.counts()
+    printinfo(f"Work queue: {counts['done']:d} tiles done, {counts['failed']:d} failed")
+    return retval
 
-    if coadd_object_molygon is not None:
-        cmfiles = getfilelist(coadd_object_molygon)
-        for _file in cmfiles:
-            try:
-                printinfo("Working on coadd_object_molygon file " + _file[0])
-                cmobj = Mangle(datafile=_file[0], filetype=args['coadd_object_molygon_filetype'], idDict=coaddObjectIdDict, dbh=dbh, replacecol=3, checkcount=True, skipmissing=alt_table is not None)
-                isLoaded = cmobj.isLoaded()
-                if not isLoaded:
-                    stat = cmobj.executeIngest()
-                    retval += cmobj.getstatus()
-                    printinfo("Ingest of coadd_object_molygon file " + _file[0] + status[stat] + "\n")
-            except:  # pragma: no cover
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised0:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Coadd Object Molygon ingestion, none specified on command line")
 
-    print("\n###################### EXTINCTION INGESTION ########################\n")
+def main():
+    """
+        main function
+    """
+    args = parseArgs()
+    section = checkParam(args, 'section', False)
+    services = checkParam(args, 'des_services', False)
 
-    if extinct is not None:
-        try:
-            printinfo("Working on extinction catalog " + extinct)
-            extobj = Extinction(datafile=extinct, idDict=coaddObjectIdDict, filetype=args['extinct_filetype'], dbh=dbh)
-            isLoaded = extobj.isLoaded()
-            if not isLoaded:
-                stat = extobj.executeIngest()
-                retval += extobj.getstatus()
-                printinfo("Ingest of detection catalog " + extinct + status[stat] + "\n")
-        except:  # pragma: no cover
-            se = sys.exc_info()
-            e = se[1]
-            tb = se[2]
-            print("Exception raised11:", e)
-            print("Traceback: ")
-            traceback.print_tb(tb)
-            print(" ")
-            retval += 1
-    else:
-        print("Skipping Excintion ingestion, none specified on command line")
+    if args['queue_submit']:
+        return submitQueue(args)
 
-    if extinct_band is not None:
-        exfiles = getfilelist(extinct_band)
-        for _file in exfiles:
+    # the connection, metadata, throttle, ledger and workers are shared by all
+    # the tiles; cached metadata older than metadata_ttl is queried again
+    starttime = time.time()
+    dbh = desdbi.DesDbi(services, section, retry=True)
+    Ingest.throttle = Throttle(args['throttle_dir'], args['throttle_sessions'], args['throttle_rows'])
+    if args['ledger_dir']:
+        Ingest.ledger = Ledger(args['ledger_dir'], section)
+    if args['idmap_cache_dir']:
+        CoaddCatalog.idmapCache = IdMapCache(args['idmap_cache_dir'])
+    CoaddCatalog.reservefunc = args['id_reserve_func']
+    MetadataCache.configure(checkParam(args, 'metadata_cache', False), args['metadata_ttl'])
+    # the mangle parsing processes of all the jobs together stay within the cpus
+    Mangle.parsejobs = max(1, min(args['mangle_jobs'], (os.cpu_count() or 1) // max(1, args['jobs'])))
+    if Mangle.parsejobs < args['mangle_jobs']:
+        printinfo(f"Using {Mangle.parsejobs:d} mangle parsing processes per job rather than {args['mangle_jobs']:d}, to stay within the cpus")
+
+    with IngestScheduler(args['jobs'], functools.partial(desdbi.DesDbi, services, section, retry=True),
+                         args['processes']) as scheduler:
+        timings = []
+        if args['queue_dir']:
+            retval = runQueue(args, dbh, scheduler, timings)
+        elif args['manifest']:
             try:
-                printinfo("Working on extinction catalog " + _file[0])
-                extobj = Extinction(datafile=_file[0], idDict=coaddObjectIdDict, filetype=args['extinct_band_filetype'], dbh=dbh)
-                isLoaded = extobj.isLoaded()
-                if not isLoaded:
-                    stat = extobj.executeIngest()
-                    retval += extobj.getstatus()
-                    printinfo("Ingest of detection catalog " + _file[0] + status[stat] + "\n")
+                tiles = readManifest(args['manifest'], args)
             except:  # pragma: no cover
                 se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised12:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Extinction Band ingestion, none specified on command line")
-
+                print("Exception raised reading the manifest:", se[1])
+                return 1
+            # the metadata of all the filetypes of all the tiles is loaded at once
+            MetadataCache.prefetch(dbh, sorted({targs[key] for targs in tiles for key in targs
+                                                if key.endswith('_filetype')}))
+            retval = 0
+            for num, targs in enumerate(tiles):
+                print(f"\n###################### TILE {num + 1:d} OF {len(tiles):d}: {targs['name']} ########################\n")
+                tileret, elapsed = runTile(targs, dbh, scheduler)
+                retval += tileret
+                timings.append((targs['name'], tileret, elapsed))
+        else:
+            retval = ingestTile(args, dbh, scheduler)
+        if timings:
+            print("\n###################### TILE SUMMARY ########################\n")
+            for name, tileret, elapsed in timings:
+                printinfo(f"{name}: {elapsed:.1f} seconds, retval {tileret:d}")
+
+    printinfo(f"Total ingest time {time.time() - starttime:.1f} seconds")
+    if Ingest.throttle.enabled():
+        printinfo(f"Waited {Ingest.throttle.waited():.2f} seconds in total on the insert throttle")
+    if Ingest.ledger is not None:
+        for filetype, nfiles, nrows, elapsed, rate in Ingest.ledger.summary(starttime):
+            printinfo(f"Ingested {nfiles:d} {filetype} files, {nrows:d} rows in {elapsed:.1f} seconds ({rate:.0f} rows/s)")
     print("EXITING WITH RETVAL", retval)
     return retval
 
+
 if __name__ == '__main__':
     sys.exit(main())
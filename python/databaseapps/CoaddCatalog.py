@@ -1,49 +1,159 @@
 """ Module for ingesting coadd catalogs
 """
 from databaseapps.FitsIngest import FitsIngest
+from databaseapps.ingestutils import IngestUtils as ingestutils
 from despydb import desdbi
 import sys
+import numpy as np
 
 class CoaddCatalog(FitsIngest):
     """ Class for ingesting coadd catalogs
 
     """
+    # rows fetched per round trip when retrieving coadd object ids
+    fetchsize = 100000
+    # database function reserving a contiguous block of coadd object ids (see
+    # reserveCoaddObjectIds), None to reserve the block from the sequence
+    reservefunc = None
+    # whether to reserve blocks by stepping the sequence (see
+    # reserveSequenceBlock), cleared if that is not possible
+    blockreserve = True
+    # seconds to wait for another session reserving a block
+    blocktimeout = 300
+    # local cache of retrieved id maps (IdMapCache), None to always fetch them
+    idmapCache = None
+    catalogtable = 'CATALOG'
+    # (band, tilename, pfw_attempt_id) of each file, filled by prefetchCatalogInfo
+    catalogInfo = {}
+
     def __init__(self, ingesttype, filetype, datafile, idDict, dbh):
         FitsIngest.__init__(self, filetype, datafile, idDict, True, dbh)
 
-        self.catalogtable = 'CATALOG'
         self.idsequence = 'COADD_OBJECT_SEQ'
 
         # data retrieved from catalogtable
         self.band = None
         self.tilename = None
         self.pfw_attempt_id = None
+        self.ingesttype = ingesttype
 
-        # grab the band, tile, and pfw_attempt_id for this file
-        self.setCatalogInfo(ingesttype)
+    def setConstants(self):
+        """ Grab the band, tile, and pfw_attempt_id for this file
+        """
+        self.setCatalogInfo(self.ingesttype)
 
-    def getIDs(self):
-        """ doc
+    def getIDs(self, numobjs=None):
+        """ Get the block of new coadd object ids needed for the ingest, by
+            default one for every row of the file. A contiguous block is
+            reserved with the reservation function if one is set, otherwise by
+            stepping the sequence. If neither is possible the ids are fetched
+            from the sequence one by one.
         """
+        if numobjs is None:
+            numobjs = self.getNumObjects()
+        self.nextID = 0
+        first = self.reserveCoaddObjectIds(numobjs)
+        if first is None:
+            first = self.reserveSequenceBlock(numobjs)
+        if first is not None:
+            self.info(f"Reserved coadd object ids {first:d} to {first + numobjs - 1:d}")
+            self.coadd_ids = np.arange(first, first + numobjs, dtype=np.int64)
+            return
         # retrieve all coadd objects ids needed for this band's ingest as
         # one list
         self.info("Grabbing block of coadd object ids from DB sequence")
-        coadd_recs = self.getCoaddObjectIds(self.fits[self.objhdu].get_nrows())
-        self.coadd_ids = [item[0] for item in coadd_recs]
+        coadd_recs = self.getCoaddObjectIds(numobjs)
+        self.coadd_ids = np.sort(np.array([item[0] for item in coadd_recs], dtype=np.int64))
+
+    def reserveCoaddObjectIds(self, numobjs):
+        """ Reserve a contiguous block of numobjs ids from the sequence with a
+            single call to the reservefunc database function, if one is set
+            (mepoch_ingest --id_reserve_func). The function is given the
+            sequence name and the number of ids, and must return the first of
+            numobjs consecutive ids which the sequence will never hand out
+            again, e.g. by advancing the sequence past them.
+
+            Returns
+            -------
+            int, or None if the function is not available or the block it
+            returned cannot be used
+        """
+        if self.reservefunc is None or numobjs <= 0:
+            return None
+        try:
+            cursor = self.dbh.cursor()
+            first = cursor.callfunc(self.reservefunc, int, [self.idsequence, numobjs])
+            cursor.close()
+        except Exception as ex:
+            # do not try again for the other files
+            self.info(f"Could not reserve a block of coadd object ids ({str(ex).strip()}), using the sequence")
+            CoaddCatalog.reservefunc = None
+            return None
+        if not isinstance(first, int) or first <= 0:
+            return None
+        return first
+
+    def reserveSequenceBlock(self, numobjs):
+        """ Reserve a contiguous block of numobjs ids by setting the increment
+            of the sequence to numobjs for a single nextval, the last value of
+            the block. Sessions doing the same are kept apart with a user lock
+            (dbms_lock), while any other session taking a value meanwhile gets
+            one outside of the block. The alter sequence statements commit any
+            pending work of the connection.
 
+            Returns
+            -------
+            int, or None if the block cannot be reserved this way (the lock or
+            the privilege to alter the sequence is not available)
+        """
+        if not self.blockreserve or numobjs <= 1:
+            return None
+        cursor = self.dbh.cursor()
+        handle = None
+        try:
+            lockvar = cursor.var(str)
+            cursor.callproc('dbms_lock.allocate_unique', [f"{self.idsequence}_RESERVE", lockvar])
+            handle = lockvar.getvalue()
+            stat = cursor.callfunc('dbms_lock.request', int, [handle],
+                                   {'lockmode': 6, 'timeout': self.blocktimeout, 'release_on_commit': False})
+            if stat not in (0, 4):
+                handle = None
+                raise Exception(f"dbms_lock.request returned {stat:d}")
+            try:
+                cursor.execute(f"alter sequence {self.idsequence} increment by {numobjs:d}")
+                cursor.execute(f"select {self.idsequence}.nextval from dual")
+                last = cursor.fetchone()[0]
+            finally:
+                cursor.execute(f"alter sequence {self.idsequence} increment by 1")
+        except Exception as ex:
+            # do not try again for the other files
+            self.info(f"Could not reserve a block of coadd object ids from {self.idsequence} ({str(ex).strip()}), using the sequence")
+            CoaddCatalog.blockreserve = False
+            return None
+        finally:
+            if handle is not None:
+                try:
+                    cursor.callfunc('dbms_lock.release', int, [handle])
+                except Exception:  # pragma: no cover
+                    pass
+            cursor.close()
+        return int(last) - numobjs + 1
 
     def setCatalogInfo(self, ingesttype):
         """ Grab info from catalog table based on the filename, and set corresponding
             class variables.
         """
-        sqlstr = '''
-            select band, tilename, pfw_attempt_id
-            from {}
-            where filename=:fname
-            '''
-        cursor = self.dbh.cursor()
-        cursor.execute(sqlstr.format(self.catalogtable), {"fname" :self.shortfilename})
-        records = cursor.fetchall()
+        if self.shortfilename in self.catalogInfo:
+            records = [self.catalogInfo[self.shortfilename]]
+        else:
+            sqlstr = '''
+                select band, tilename, pfw_attempt_id
+                from {}
+                where filename=:fname
+                '''
+            cursor = self.dbh.cursor()
+            cursor.execute(sqlstr.format(self.catalogtable), {"fname" :self.shortfilename})
+            records = cursor.fetchall()
 
         if records:
             (self.band, self.tilename, self.pfw_attempt_id) = records[0]
@@ -66,6 +176,43 @@ class CoaddCatalog(FitsIngest):
                           "FILENAME": self.shortfilename,
                           "PFW_ATTEMPT_ID": self.pfw_attempt_id}
 
+    @classmethod
+    def prefetchCatalogInfo(cls, dbh, filenames, maxbinds=1000):
+        """ Get the band, tilename and pfw_attempt_id of many files from the
+            catalog table at once, with one query per maxbinds files. The
+            results are used by setCatalogInfo rather than querying each file.
+
+            Parameters
+            ----------
+            dbh : handle
+                The database handle to use
+
+            filenames : list
+                The (short) file names
+
+            maxbinds : int, optional
+                The maximum number of file names per query, default is 1000
+
+            Returns
+            -------
+            list
+                The file names which are not in the catalog table
+        """
+        filenames = sorted(set(filenames))
+        cursor = dbh.cursor()
+        try:
+            for offset in range(0, len(filenames), maxbinds):
+                binds = {f"f{i:d}": fname for i, fname in enumerate(filenames[offset:offset + maxbinds])}
+                sqlstr = f'''
+                    select filename, band, tilename, pfw_attempt_id from {cls.catalogtable}
+                    where filename in ({', '.join([':' + b for b in binds])})'''
+                cursor.execute(sqlstr, binds)
+                for rec in cursor.fetchall():
+                    cls.catalogInfo[rec[0]] = tuple(rec[1:])
+        finally:
+            cursor.close()
+        return [fname for fname in filenames if fname not in cls.catalogInfo]
+
     def getCoaddObjectIds(self, numobjs):
         """ Get block of coadd object ids from db. Number of ids needed is passed
             in numobjs
@@ -81,21 +228,77 @@ class CoaddCatalog(FitsIngest):
 
         return records
 
+    def countCoaddObjectIds(self):
+        """ Get the number of rows already ingested from the file and their
+            largest coadd object id
+
+            Returns
+            -------
+            tuple
+                The number of rows and the largest id (None if there are no rows)
+        """
+        cursor = self.dbh.cursor()
+        cursor.execute(f"select count(*), max(id) from {self.targettable} where filename=:fname",
+                       {'fname': self.shortfilename})
+        nrows, maxid = cursor.fetchone()
+        cursor.close()
+        return nrows, maxid
+
     def retrieveCoaddObjectIds(self, services=None, section=None, pfwid=None, table=None):
-        """ Get the coadd object id's if the data have already been ingested
+        """ Get the coadd object id's if the data have already been ingested.
+            The ids are streamed into arrays and added to the id dictionary in
+            bulk; numbers already in the dictionary keep their ids. If there is
+            a local id map cache, a cached map is used as long as its row count
+            and largest id match the database.
 
         """
+        tdbh = None
         if table is not None:
             self.printinfo('Getting Coadd IDs from alternate table')
-            sqlstr = f"select object_number, coadd_object_id from {table} where pfw_attempt_id={pfwid}"
+            sqlstr = f"select object_number, coadd_object_id from {table} where pfw_attempt_id=:pfwid"
+            countstr = f"select count(*), max(coadd_object_id) from {table} where pfw_attempt_id=:pfwid"
+            params = {'pfwid': pfwid}
+            key = f"{table}_{pfwid}"
             tdbh = desdbi.DesDbi(services, section, retry=True)
             cursor = tdbh.cursor()
         else:
             self.printinfo("Getting Coadd IDs from database\n")
-            sqlstr = f"select object_number, id from {self.targettable} where filename='{self.shortfilename}'"
+            sqlstr = f"select object_number, id from {self.targettable} where filename=:fname"
+            countstr = f"select count(*), max(id) from {self.targettable} where filename=:fname"
+            params = {'fname': self.shortfilename}
+            key = f"{self.targettable}_{self.shortfilename}"
             cursor = self.dbh.cursor()
-        cursor.execute(sqlstr)
-        records = cursor.fetchall()
-        for r in records:
-            if r[0] not in self.idDict:
-                self.idDict[r[0]] = r[1]
+        cached = None
+        if self.idmapCache is not None:
+            cursor.execute(countstr, params)
+            nrows, maxid = cursor.fetchone()
+            cached = self.idmapCache.load(key, nrows, maxid)
+        if cached is not None:
+            numbers, ids = cached
+            self.printinfo(f"Loaded {numbers.size:d} Coadd IDs from the local cache")
+        else:
+            cursor.arraysize = self.fetchsize
+            cursor.execute(sqlstr, params)
+            numbers, ids = ingestutils.fetchIntColumns(cursor, 2, self.fetchsize,
+                                                       self.numIngested if table is None else None)
+            if self.idmapCache is not None:
+                try:
+                    self.idmapCache.store(key, numbers, ids)
+                except OSError as ex:
+                    print(f"Could not cache the Coadd IDs: {ex}")
+        cursor.close()
+        if tdbh is not None:
+            tdbh.close()
+
+        # the first id of any number listed more than once wins
+        _, first = np.unique(numbers, return_index=True)
+        if first.size != numbers.size:
+            first.sort()
+            numbers = numbers[first]
+            ids = ids[first]
+        if self.idDict:
+            existing = np.fromiter(self.idDict.keys(), dtype=np.int64, count=len(self.idDict))
+            new = ~np.isin(numbers, existing)
+            numbers = numbers[new]
+            ids = ids[new]
+        self.idDict.update(zip(numbers.tolist(), ids.tolist()))
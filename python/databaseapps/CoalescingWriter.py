@@ -0,0 +1,131 @@
+"""
+    Combined inserts of many small files
+"""
+import sys
+import time
+import traceback
+from databaseapps.Ingest import Ingest
+
+class CoalescingWriter:
+    """ Merges the rows of consecutive small files going into the same table
+        with the same columns into shared batches, so they share one prepared
+        statement, a few executemany calls and one commit. The per-file
+        constants (FILENAME, BAND, ...) are bound as columns rather than
+        written into the statement. A batch always holds whole files, so each
+        file is either completely inserted or not at all, and the status of
+        every file is still reported separately.
+
+        Parameters
+        ----------
+        dbh : handle
+            The database handle to use
+
+        maxrows : int, optional
+            The number of rows which triggers a flush, default is 500000
+
+        maxfiles : int, optional
+            The number of files which triggers a flush, default is 100
+    """
+    def __init__(self, dbh, maxrows=500000, maxfiles=100):
+        self.dbh = dbh
+        self.maxrows = maxrows
+        self.maxfiles = maxfiles
+        self.table = None
+        self.columns = None
+        self.rows = []
+        # (ingest object, number of rows, seconds spent generating the rows)
+        self.files = []
+
+    def add(self, obj, sortkey=None):
+        """ Generate the rows of a file and add them to the current batch,
+            flushing first if the file has a different table or columns
+
+            Parameters
+            ----------
+            obj : Ingest
+                The ingest object of the file
+
+            sortkey : str or tuple, optional
+                Key to sort the rows of the file by, see Ingest.sortRows.
+                Default is None (file order)
+
+            Returns
+            -------
+            int
+                The number of files which failed, including any flushed
+        """
+        failed = 0
+        start = time.time()
+        obj.prepare()
+        obj.numIngested = None
+        if obj.generateRows() == 1:
+            return 1
+        datacols = obj.getInsertColumns()
+        if sortkey is not None:
+            obj.sortRows(datacols, sortkey)
+        columns = [col.upper() for col in list(obj.constants) + datacols]
+        if obj.targettable != self.table or columns != self.columns:
+            failed += self.flush()
+            self.table = obj.targettable
+            self.columns = columns
+        constants = list(obj.constants.values())
+        self.rows.extend([constants + list(row) for row in obj.sqldata])
+        self.files.append((obj, len(obj.sqldata), time.time() - start))
+        obj.sqldata = []
+        if len(self.rows) >= self.maxrows or len(self.files) >= self.maxfiles:
+            failed += self.flush()
+        return failed
+
+    def flush(self):
+        """ Insert and commit the current batch
+
+            Returns
+            -------
+            int
+                The number of files which failed
+        """
+        if not self.files:
+            return 0
+        throttle = Ingest.throttle
+        places = [f":{i + 1:d}" for i in range(len(self.columns))]
+        sqlstr = f"insert into {self.table} ({', '.join(self.columns)}) values ({', '.join(places)})"
+        maxchunk = 1000000
+        if throttle.maxRowsPerSec:
+            maxchunk = max(1, min(maxchunk, int(throttle.maxRowsPerSec)))
+        files = self.files
+        nrows = len(self.rows)
+        start = time.time()
+        failed = 0
+        try:
+            cursor = self.dbh.cursor()
+            cursor.prepare(sqlstr)
+            with throttle.session():
+                for offset in range(0, nrows, maxchunk):
+                    chunk = min(maxchunk, nrows - offset)
+                    throttle.acquireRows(chunk)
+                    cursor.executemany(None, self.rows[offset:offset + chunk])
+                cursor.close()
+                self.dbh.commit()
+            # share the insert time between the files by their number of rows
+            elapsed = time.time() - start
+            for obj, filerows, generate in files:
+                obj.status = 0
+                obj.info(f"Inserted {filerows:d} rows of {obj.shortfilename} into table {self.table}")
+                obj.updateLedger(filerows, generate + elapsed * filerows / max(nrows, 1))
+            files[0][0].info(f"Committed {nrows:d} rows from {len(files):d} files to table {self.table}")
+        except:   # pragma: no cover
+            se = sys.exc_info()
+            e = str(se[1])
+            tb = se[2]
+            print("Exception raised: ", e.strip(), " while ingesting ", ', '.join(obj.shortfilename for obj, _, _ in files))
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            self.dbh.rollback()
+            for obj, _, _ in files:
+                obj.status = 1
+            failed = len(files)
+        finally:
+            self.rows = []
+            self.files = []
+        return failed
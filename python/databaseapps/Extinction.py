@@ -15,7 +15,10 @@ class Extinction(FitsIngest):
 
         self.constants = {"FILENAME": self.shortfilename}
 
-        if filetype != 'coadd_extinct_ebv':
-            self.header = fitsio.read_header(datafile, self.dbDict[self.objhdu]['BAND'].hdu)
+    def setConstants(self):
+        """ Get the band from the file header, if needed
+        """
+        if self.filetype != 'coadd_extinct_ebv':
+            self.header = fitsio.read_header(self.fullfilename, self.dbDict[self.objhdu]['BAND'].hdu)
             band = self.header['BAND'].strip()
             self.constants["BAND"] = band
@@ -8,6 +8,7 @@ import math
 import fitsio
 import numpy as np
 from databaseapps.Ingest import Ingest, Entry
+from databaseapps.ingestutils import IngestUtils as ingestutils
 from despymisc import miscutils
 
 class FitsIngest(Ingest):
@@ -24,25 +25,60 @@ class FitsIngest(Ingest):
         """
         Ingest.__init__(self, filetype, datafile, hdu, '1,2,3', dbh)
 
-        self.fits = fitsio.FITS(datafile)
+        # the fits file is only opened when it is needed
+        self._fits = None
 
         self.idDict = idDict
 
         self.generateID = generateID
         self.matchCount = matchCount
+        # ids reserved for new objects, and the position of the next one to use
         self.coadd_ids = None
+        self.nextID = 0
+        # the numbers in idDict as a sorted array, kept in step by assignIDs
+        self.knownNumbers = None
+        # if set, only these rows of the file are ingested
+        self.rowSubset = None
 
     def __del__(self):  # pragma: no cover
-        if hasattr(self, 'fits'):
-            if self.fits:
-                self.fits.close()
+        if getattr(self, '_fits', None):
+            self._fits.close()
+
+    @property
+    def fits(self):
+        """ The open fits file, opened on first access
+
+            Returns
+            -------
+            fitsio.FITS
+        """
+        if self._fits is None:
+            self._fits = fitsio.FITS(self.fullfilename)
+        return self._fits
+
+    def close(self):
+        """ Close the fits file, if open, and release the db cursor
+        """
+        if self._fits is not None:
+            self._fits.close()
+            self._fits = None
+        Ingest.close(self)
 
     def getNumObjects(self):
-        """ Get the number of rows to be ingested
+        """ Get the number of rows to be ingested. If the file is not already
+            open only its header is read.
 
         """
+        if self._fits is None:
+            return fitsio.read_header(self.fullfilename, self.objhdu)['NAXIS2']
         return self.fits[self.objhdu].get_nrows()
 
+    def isPartial(self):
+        """ Whether only a subset of the rows is being ingested (a delta ingest)
+
+        """
+        return self.rowSubset is not None
+
     def generateRows(self):
         """ Convert the input fits data into a list of lists
 
@@ -77,10 +113,18 @@ class FitsIngest(Ingest):
                 startrow = endrow
                 endrow = min(startrow+self.fits_chunk, lastrow)
 
+                rows = range(startrow, endrow)
+                if self.rowSubset is not None:
+                    rows = self.rowSubset[(self.rowSubset >= startrow) & (self.rowSubset < endrow)]
+                    if rows.size == 0:
+                        continue
                 data = fitsio.read(self.fullfilename,
-                                   rows=range(startrow, endrow),
+                                   rows=rows,
                                    columns=self.orderedColumns, ext=self.objhdu)
 
+                if self.generateID and "NUMBER" in self.orderedColumns:
+                    self.assignIDs(data["NUMBER"])
+
                 for row in data:
                     linecount += 1
                     # IMPORTANT! Must convert numpy array to python list, or
@@ -109,12 +153,8 @@ class FitsIngest(Ingest):
                     for idx in range(0, len(self.orderedColumns)):
                         # if the COADD_OBJECT_ID dictionary is being created
                         if self.generateID and self.orderedColumns[idx] == "NUMBER":
-                            if row[idx] in self.idDict:
-                                outrow.insert(0, self.idDict[row[idx]])
-                            else:
-                                coadd_id = self.coadd_ids.pop()
-                                self.idDict[row[idx]] = coadd_id
-                                outrow.insert(0, coadd_id)
+                            # the ids were assigned for the whole chunk by assignIDs
+                            outrow.insert(0, self.idDict[row[idx]])
                             outrow.append(row[idx])
                         # if this is NUMBER column, look up COADD_OBJECT_ID and
                         # then skip it
@@ -156,9 +196,252 @@ class FitsIngest(Ingest):
             if self.generateID:
                 self.dbDict[self.objhdu]['ID'] = Entry(column_name='ID', position=0)
                 self.orderedColumns = ['ID'] + self.orderedColumns
-            elif self.matchCount and len(self.idDict) != len(self.sqldata):  # pragma: no cover
+            elif self.matchCount and self.rowSubset is None and len(self.idDict) != len(self.sqldata):  # pragma: no cover
                 self.status = 1
                 retval = 1
                 miscutils.fwdebug_print(f"Incorrect number of rows in {self.shortfilename}. Count is {len(self.sqldata):d}, should be {len(self.idDict):d}")
 
             return retval
+
+    def assignIDs(self, numbers):
+        """ Assign reserved ids to all the object numbers of a chunk which do
+            not have one yet, in order of first appearance
+
+            Parameters
+            ----------
+            numbers : numpy.ndarray
+                The NUMBER column of the chunk
+        """
+        numbers = np.asarray(numbers, dtype=np.int64)
+        if self.knownNumbers is None or self.knownNumbers.size != len(self.idDict):
+            # the dictionary was filled elsewhere (e.g. retrieveCoaddObjectIds)
+            self.knownNumbers = np.sort(np.fromiter(self.idDict.keys(), dtype=np.int64, count=len(self.idDict)))
+        pos = np.searchsorted(self.knownNumbers, numbers)
+        known = pos < self.knownNumbers.size
+        known[known] = self.knownNumbers[pos[known]] == numbers[known]
+        numbers = numbers[~known]
+        _, first = np.unique(numbers, return_index=True)
+        numbers = numbers[np.sort(first)]
+        if numbers.size == 0:
+            return
+        if self.coadd_ids is None or self.nextID + numbers.size > len(self.coadd_ids):
+            raise Exception(f"Not enough coadd object ids reserved for {self.shortfilename}")
+        ids = self.coadd_ids[self.nextID:self.nextID + numbers.size]
+        self.nextID += numbers.size
+        self.idDict.update(zip(numbers.tolist(), ids.tolist()))
+        added = np.sort(numbers)
+        self.knownNumbers = np.insert(self.knownNumbers, np.searchsorted(self.knownNumbers, added), added)
+
+    @staticmethod
+    def columnToList(values):
+        """ Convert a numpy column into a python list, replacing NaN's with None
+            and stripping any strings
+
+        """
+        if values.dtype.kind in 'SU':
+            return [val.strip() for val in values.tolist()]
+        out = values.tolist()
+        if values.dtype.kind == 'f':
+            for i in np.flatnonzero(np.isnan(values)):
+                out[i] = None
+        return out
+
+    def getKeyColumn(self):
+        """ Get the name of the db column which identifies the object a row
+            belongs to (ID for catalogs generating the ids, otherwise the
+            column the NUMBER is mapped into)
+
+        """
+        if self.generateID:
+            return 'ID'
+        return self.dbDict[self.objhdu]['NUMBER'].column_name[0]
+
+    def backfillColumns(self, attributes):
+        """ Update the given columns of the rows already ingested from this file,
+            reading only those columns (plus NUMBER) from the file and mapping
+            NUMBER to the object ids through idDict. NUMBER itself, and any
+            column which is not an ingested column of the file, are skipped.
+
+            Parameters
+            ----------
+            attributes : list
+                The names of the attributes (FITS columns) to update
+
+            Returns
+            -------
+            int
+                0 on success, 1 on failure
+        """
+        #pylint: disable=lost-exception
+        attrsToCollect = self.dbDict[self.objhdu]
+        fitscols = {col.upper(): col for col in self.fits[self.objhdu].get_colnames()}
+        attrs = []
+        for att in attributes:
+            att = att.upper()
+            if att not in attrsToCollect or att not in fitscols or att == 'NUMBER':
+                self.info(f"Cannot backfill {att} for {self.shortfilename}, it is not an ingested column of the file, skipping it")
+            elif att not in attrs:
+                attrs.append(att)
+        if not attrs:
+            self.info(f"Nothing to backfill for {self.shortfilename}")
+            self.status = 0
+            return 0
+
+        columns = []
+        for att in attrs:
+            columns += attrsToCollect[att].column_name
+        sqlstr = f"update {self.targettable} set "
+        sqlstr += ', '.join([f"{col}=:{i + 1:d}" for i, col in enumerate(columns)])
+        sqlstr += f" where {self.getKeyColumn()}=:{len(columns) + 1:d} and filename=:{len(columns) + 2:d}"
+
+        lastrow = self.getNumObjects()
+        readcols = [fitscols['NUMBER']] + [fitscols[att] for att in attrs]
+        cursor = self.dbh.cursor()
+        cursor.prepare(sqlstr)
+        updated = 0
+        try:
+            for startrow in range(0, lastrow, self.fits_chunk):
+                endrow = min(startrow + self.fits_chunk, lastrow)
+                data = self.fits[self.objhdu].read(columns=readcols, rows=range(startrow, endrow))
+                values = []
+                for att in attrs:
+                    col = data[fitscols[att]]
+                    if col.ndim > 1:
+                        # only the elements with a column in the table, which
+                        # need not be all of them or contiguous
+                        col = col.reshape(len(col), -1)
+                        for _, pos in zip(attrsToCollect[att].column_name, attrsToCollect[att].position):
+                            values.append(self.columnToList(col[:, pos]))
+                    else:
+                        values.append(self.columnToList(col))
+                ids = []
+                for num in data[fitscols['NUMBER']].tolist():
+                    try:
+                        ids.append(self.idDict[num])
+                    except KeyError:
+                        miscutils.fwdebug_print(f"ERROR: Coadd number ({num:d}) specified that does not have a corresponding coadd id, found in {self.shortfilename}.")
+                        raise
+                values.append(ids)
+                values.append([self.shortfilename] * len(ids))
+                cursor.executemany(None, list(zip(*values)))
+                updated += len(ids)
+            cursor.close()
+            self.dbh.commit()
+            self.info(f"Updated {', '.join(columns)} in {updated:d} rows of table {self.targettable}")
+            self.status = 0
+        except:   # pragma: no cover
+            se = sys.exc_info()
+            e = str(se[1])
+            tb = se[2]
+            print("Exception raised: ", e.strip(), " while backfilling ", self.shortfilename)
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            self.dbh.rollback()
+            self.status = 1
+        finally:
+            return self.status
+
+    def supportsDelta(self):
+        """ Whether the file can be delta ingested, which needs a NUMBER column
+            in the file that is ingested into the table to identify the rows
+
+            Returns
+            -------
+            bool
+        """
+        if 'NUMBER' not in self.dbDict.get(self.objhdu, {}):
+            return False
+        return 'NUMBER' in [col.upper() for col in self.fits[self.objhdu].get_colnames()]
+
+    def getIngestedKeys(self, column, arraysize=100000):
+        """ Stream the values of a (integer) column for the rows already
+            ingested from this file into a numpy array
+
+            Parameters
+            ----------
+            column : str
+                The db column to retrieve
+
+            arraysize : int, optional
+                The number of rows to fetch per round trip, default is 100000
+
+            Returns
+            -------
+            numpy.ndarray
+        """
+        cursor = self.dbh.cursor()
+        cursor.arraysize = arraysize
+        cursor.execute(f"select {column} from {self.targettable} where filename=:fname",
+                       {'fname': self.shortfilename})
+        keys = ingestutils.fetchIntColumns(cursor, 1, arraysize)[0]
+        cursor.close()
+        return keys
+
+    def deltaIngest(self, deleteMissing=False, batchsize=100000, sortkey=None):
+        """ Bring the rows already ingested from this (reprocessed) file in line
+            with the file, by inserting only the objects which are not yet in the
+            database and, optionally, deleting the ones no longer in the file.
+
+            Parameters
+            ----------
+            deleteMissing : bool, optional
+                Whether to delete rows for objects which are no longer in the
+                file, default is False. It is refused for a catalog which
+                generates the object ids, as other tables reference them.
+
+            batchsize : int, optional
+                The number of rows to delete per executemany, default is 100000
+
+            sortkey : str or tuple, optional
+                Key to sort the new rows by before inserting them, see
+                Ingest.sortRows. Default is None (file order)
+
+            Returns
+            -------
+            int
+                0 on success, 1 on failure
+        """
+        if not self.supportsDelta():
+            miscutils.fwdebug_print(f"ERROR: {self.shortfilename} has no ingested NUMBER column, it cannot be delta ingested")
+            self.status = 1
+            return 1
+        if deleteMissing and self.generateID:
+            miscutils.fwdebug_print(f"ERROR: the objects of {self.shortfilename} own their ids, vanished objects cannot be deleted by a delta ingest")
+            self.status = 1
+            return 1
+        keycol = self.dbDict[self.objhdu]['NUMBER'].column_name[0]
+        dbkeys = self.getIngestedKeys(keycol)
+
+        numbers = self.fits[self.objhdu].read_column('NUMBER').astype(np.int64)
+        if self.generateID:
+            filekeys = numbers
+        else:
+            # the db holds the coadd object ids the numbers map to
+            filekeys = np.array([self.idDict.get(num, -1) for num in numbers.tolist()], dtype=np.int64)
+        newrows = np.flatnonzero(~np.isin(filekeys, dbkeys))
+        vanished = np.setdiff1d(dbkeys, filekeys)
+        self.info(f"Delta for {self.shortfilename}: {newrows.size:d} new, {vanished.size:d} vanished, "
+                  f"{numbers.size - newrows.size:d} already ingested objects")
+
+        if deleteMissing and vanished.size > 0:
+            cursor = self.dbh.cursor()
+            cursor.prepare(f"delete from {self.targettable} where filename=:1 and {keycol}=:2")
+            for offset in range(0, vanished.size, batchsize):
+                cursor.executemany(None, [(self.shortfilename, key) for key in vanished[offset:offset + batchsize].tolist()])
+            cursor.close()
+            self.info(f"Deleted {vanished.size:d} vanished objects of {self.shortfilename} from {self.targettable}")
+
+        if newrows.size == 0:
+            # nothing to insert, just commit any deletes
+            self.dbh.commit()
+            self.numIngested = None
+            self.status = 0
+            return self.status
+
+        if self.generateID:
+            missing = sum(1 for num in numbers[newrows].tolist() if num not in self.idDict)
+            if missing:
+                self.getIDs(missing)
+        self.rowSubset = newrows
+        return self.executeIngest(sortkey)
@@ -0,0 +1,106 @@
+"""
+    Local on-disk cache of coadd object id maps
+"""
+import os
+import re
+import json
+import hashlib
+import numpy as np
+
+class IdMapCache:
+    """ Keeps the (NUMBER, COADD_OBJECT_ID) maps retrieved from the database
+        in a local directory, so a rerun of the same tile does not have to
+        transfer the whole map again. Each map is stored as a (2, n) int64
+        .npy file with a small json sidecar holding its row count, largest id
+        and checksum. A map is only used if the row count and largest id still
+        match what the database reports, and its checksum is correct.
+
+        Parameters
+        ----------
+        cachedir : str
+            The directory holding the maps, created if needed
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        os.makedirs(cachedir, exist_ok=True)
+
+    def path(self, key):
+        """ Get the path of the map file for a key
+
+            Parameters
+            ----------
+            key : str
+                The key of the map, e.g. the alternate table and pfw_attempt_id,
+                or the detection catalog file name
+
+            Returns
+            -------
+            str
+        """
+        return os.path.join(self.cachedir, "idmap_" + re.sub(r'[^\w.-]', '_', str(key)) + ".npy")
+
+    @staticmethod
+    def checksum(data):
+        """ Get the md5 checksum of an array
+        """
+        return hashlib.md5(np.ascontiguousarray(data).tobytes()).hexdigest()
+
+    def load(self, key, nrows, maxid):
+        """ Load a map, if it is cached and still matches the database
+
+            Parameters
+            ----------
+            key : str
+                The key of the map
+
+            nrows : int
+                The number of rows of the map in the database
+
+            maxid : int
+                The largest id of the map in the database
+
+            Returns
+            -------
+            tuple of numpy.ndarray
+                The numbers and ids, or None if there is no valid cached map
+        """
+        path = self.path(key)
+        try:
+            with open(path + ".json", 'r') as fh:
+                info = json.load(fh)
+            if info['nrows'] != nrows or info['maxid'] != maxid:
+                return None
+            data = np.load(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        if data.shape != (2, nrows) or self.checksum(data) != info['checksum']:
+            return None
+        return data[0], data[1]
+
+    def store(self, key, numbers, ids):
+        """ Store a map, replacing any previous version
+
+            Parameters
+            ----------
+            key : str
+                The key of the map
+
+            numbers : numpy.ndarray
+                The object numbers
+
+            ids : numpy.ndarray
+                The coadd object ids
+        """
+        path = self.path(key)
+        data = np.vstack((np.asarray(numbers, dtype=np.int64), np.asarray(ids, dtype=np.int64)))
+        info = {'nrows': int(data.shape[1]),
+                'maxid': int(data[1].max()) if data.shape[1] else None,
+                'checksum': self.checksum(data)}
+        tmpfile = f"{path}.{os.getpid()}.tmp"
+        with open(tmpfile, 'wb') as fh:
+            np.save(fh, data)
+        with open(tmpfile + ".json", 'w') as fh:
+            json.dump(info, fh)
+        # the sidecar goes last, so a reader never pairs it with a stale map
+        os.replace(tmpfile, path)
+        os.replace(tmpfile + ".json", path + ".json")
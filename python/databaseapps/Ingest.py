@@ -5,7 +5,11 @@ import time
 import traceback
 import sys
 import collections
+import sqlite3
+import numpy as np
 from databaseapps.ingestutils import IngestUtils as ingestutils
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.Throttle import Throttle
 from despymisc import miscutils
 from despydb import desdbi
 
@@ -29,9 +33,20 @@ class Ingest:
         dbh : handle, optional
             The database handle to use. The default None makes the code
             create its own handle.
+
+        The column metadata and any file or header access needed for the ingest
+        are only acquired when they are first used (e.g. by executeIngest), so
+        objects for files which are already loaded stay cheap. Instances can be
+        used as context managers to release their resources deterministically.
     """
     _debug = True
     debugDateFormat = '%Y-%m-%d %H:%M:%S'
+    # healpix nside used when sorting rows by position before insertion
+    sortNside = 4096
+    # throttle on the inserts, shared by all the ingest objects in the process
+    throttle = Throttle()
+    # local ledger of completed ingests, consulted before the database
+    ledger = None
 
     def __init__(self, filetype, datafile, hdu=None, order=None, dbh=None):
         self.objhdu = hdu
@@ -41,8 +56,7 @@ class Ingest:
             self.dbh = dbh
         self.cursor = self.dbh.cursor()
         # get the table name that is being filled, based on the input data type
-        self.cursor.execute(f"select table_name from ops_datafile_table where filetype='{filetype}'")
-        self.targettable = self.cursor.fetchall()[0][0]
+        self.targettable = MetadataCache.getTableName(filetype, self.dbh)
         self.filetype = filetype
         self.idColumn = None
         self.order = order
@@ -53,9 +67,51 @@ class Ingest:
         self.fullfilename = datafile
         self.shortfilename = ingestutils.getShortFilename(datafile)
         self.status = 0
+        self._prepared = False
+        # number of rows already ingested, if known in advance (e.g. from a
+        # batched pre-flight check), cleared whenever it may have changed
+        self.numIngested = None
+
+        # dictionary of table columns in db, filled on first use
+        self._dbDict = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def dbDict(self):
+        """ Dictionary of the table columns in the db, loaded on first access
+
+            Returns
+            -------
+            dict
+        """
+        if self._dbDict is None:
+            self._dbDict = self.getObjectColumns()
+        return self._dbDict
+
+    def close(self):
+        """ Release any resources held by the object
+        """
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def prepare(self):
+        """ Acquire everything needed for the actual ingest, this is only
+            done once
+        """
+        if not self._prepared:
+            self.setConstants()
+            self._prepared = True
 
-        # dictionary of table columns in db
-        self.dbDict = self.getObjectColumns()
+    def setConstants(self):
+        """ Set the constant column values for the ingest, can be overloaded
+            by child classes which need to look them up
+        """
 
     def getstatus(self):
         """ Returns the status
@@ -92,12 +148,7 @@ class Ingest:
 
         """
         results = {}
-        sqlstr = f"select hdu, UPPER(attribute_name), position, column_name, datafile_datatype from ops_datafile_metadata where filetype = '{self.filetype}'"
-        if self.order is not None:
-            sqlstr += f" order by {self.order}"
-        cursor = self.dbh.cursor()
-        cursor.execute(sqlstr)
-        records = cursor.fetchall()
+        records = MetadataCache.getRecords(self.filetype, self.dbh, self.order)
 
         for rec in records:
             hdr = None
@@ -115,7 +166,6 @@ class Ingest:
                 results[hdr][rec[1]] = Entry(hdu=hdr, attribute_name=rec[1], position=rec[2], column_name=rec[3], dtype=rec[4])
             else:
                 results[hdr][rec[1]].append(rec[3], rec[2])
-        cursor.close()
         return results
 
     def getNumObjects(self):
@@ -135,6 +185,8 @@ class Ingest:
         """ Determine the number of entries already ingested from the data source
 
         """
+        if self.numIngested is not None:
+            return self.numIngested
         num = 0
         while num < 5:
             num += 1
@@ -151,6 +203,66 @@ class Ingest:
                 time.sleep(10)  # sleep 10 seconds and retry
 
 
+    def purge(self, batchsize=100000):
+        """ Remove any rows already ingested from this file, in committed batches,
+            so that the file can be ingested again
+
+            Parameters
+            ----------
+            batchsize : int, optional
+                The maximum number of rows to delete per commit, default is 100000
+
+            Returns
+            -------
+            int
+                The number of rows removed
+        """
+        numDbObjects = self.numAlreadyIngested()
+        if numDbObjects == 0:
+            return 0
+        self.info(f"Removing {numDbObjects:d} rows of {self.shortfilename} from {self.targettable} for reingest")
+        deleted = ingestutils.purgeFile(self.targettable, self.shortfilename, self.dbh,
+                                        batchsize, numDbObjects, self.info)
+        self.numIngested = None
+        self.info(f"Removed {deleted:d} rows of {self.shortfilename} from {self.targettable}")
+        if self.ledger is not None:
+            try:
+                self.ledger.forget(self.filetype, self.shortfilename)
+            except (OSError, sqlite3.Error) as ex:
+                self.info(f"WARNING: could not update the ingest ledger: {ex}")
+        return deleted
+
+    def updateLedger(self, nrows, elapsed=None):
+        """ Record the file as completely ingested in the ledger, if there is one
+
+            Parameters
+            ----------
+            nrows : int
+                The number of rows ingested
+
+            elapsed : float, optional
+                The time the ingest took, in seconds. Default is None (the file
+                was found to be loaded already)
+        """
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.record(self.filetype, self.shortfilename, self.fullfilename,
+                               self.targettable, nrows, elapsed)
+        except (OSError, sqlite3.Error) as ex:
+            self.info(f"WARNING: could not update the ingest ledger: {ex}")
+
+    def isPartial(self):
+        """ Whether only part of the file is being ingested, in which case it
+            is not recorded in the ledger. Overloaded by child classes which
+            support partial ingests.
+
+            Returns
+            -------
+            bool
+        """
+        return False
+
     def isLoaded(self):
         """ Determine if the data have already been loaded into the database,
             based on file name
@@ -161,14 +273,25 @@ class Ingest:
         """
         loaded = False
 
+        if self.ledger is not None:
+            try:
+                nrows = self.ledger.lookup(self.filetype, self.shortfilename, self.fullfilename, self.targettable)
+            except (OSError, sqlite3.Error) as ex:
+                self.info(f"WARNING: could not read the ingest ledger: {ex}")
+                nrows = None
+            if nrows is not None:
+                self.info(f"INFO: file {self.fullfilename} is listed in the ingest ledger with {nrows:d} rows. Skipping.")
+                return True
+
         numDbObjects = self.numAlreadyIngested()
-        numCatObjects = self.getNumObjects()
         if numDbObjects > 0:
             loaded = True
+            numCatObjects = self.getNumObjects()
             if numDbObjects == numCatObjects:
                 self.info("INFO: file " + self.fullfilename +
                           " already ingested with the same number of" +
                           " objects. Skipping.")
+                self.updateLedger(numDbObjects)
             else:   # pragma: no cover
                 miscutils.fwdebug_print("ERROR: file " + self.fullfilename +
                                         " already ingested, but the number of objects is" +
@@ -177,11 +300,66 @@ class Ingest:
 
         return loaded
 
-    def executeIngest(self):
+    def sortRows(self, columns, sortkey):
+        """ Reorder the rows to be inserted so that they are clustered by the
+            given key, improving the block locality of later queries
+
+            Parameters
+            ----------
+            columns : list
+                The db columns the rows hold, in order
+
+            sortkey : str or tuple
+                Either the name of the column to sort by or a tuple of the
+                (ra, dec) column names, in which case the rows are sorted by
+                their nested healpix index
+        """
+        if not self.sqldata:
+            return
+        ucols = [col.upper() for col in columns]
+        try:
+            if isinstance(sortkey, str):
+                idx = ucols.index(sortkey.upper())
+                keys = np.array([row[idx] for row in self.sqldata])
+            else:
+                ridx = ucols.index(sortkey[0].upper())
+                didx = ucols.index(sortkey[1].upper())
+                ra = np.array([row[ridx] for row in self.sqldata], dtype=np.float64)
+                dec = np.array([row[didx] for row in self.sqldata], dtype=np.float64)
+                good = np.isfinite(ra) & np.isfinite(dec)
+                keys = np.full(ra.shape, np.iinfo(np.int64).max, dtype=np.int64)
+                keys[good] = ingestutils.hpixNest(self.sortNside, ra[good], dec[good])
+            order = np.argsort(keys, kind='stable')
+        except (ValueError, TypeError):
+            self.info(f"WARNING: cannot sort {self.shortfilename} by {sortkey}, inserting it in file order")
+            return
+        self.sqldata = [self.sqldata[i] for i in order]
+
+    def getInsertColumns(self):
+        """ Get the db columns the generated rows hold, in order
+
+            Returns
+            -------
+            list
+        """
+        columns = []
+        for att in self.orderedColumns:
+            columns += self.dbDict[self.objhdu][att].column_name
+        return columns
+
+    def executeIngest(self, sortkey=None):
         """ Generic method to insert the data into the database
 
+            Parameters
+            ----------
+            sortkey : str or tuple, optional
+                Key to sort the rows by before inserting them, see sortRows.
+                Default is None (file order)
         """
         #pylint: disable=lost-exception
+        start = time.time()
+        self.prepare()
+        self.numIngested = None
         if self.generateRows() == 1:
             return 1
         for k, v in self.constants.items():
@@ -189,9 +367,9 @@ class Ingest:
                 self.constants[k] = "'" + v + "'"
             else:
                 self.constants[k] = str(v)
-        columns = []
-        for att in self.orderedColumns:
-            columns += self.dbDict[self.objhdu][att].column_name
+        columns = self.getInsertColumns()
+        if sortkey is not None:
+            self.sortRows(columns, sortkey)
         places = []
         for i in range(len(columns)):
             places.append(f":{i + 1:d}")
@@ -203,14 +381,25 @@ class Ingest:
         cursor = self.dbh.cursor()
         cursor.prepare(sqlstr)
         offset = 0
+        maxchunk = 1000000
+        if self.throttle.maxRowsPerSec:
+            # keep the throttled inserts smooth
+            maxchunk = max(1, min(maxchunk, int(self.throttle.maxRowsPerSec)))
+        waited = self.throttle.waited()
         try:
-            while offset < len(self.sqldata):
-                chunk = min(1000000, len(self.sqldata) - offset)
-                cursor.executemany(None, self.sqldata[offset:offset + chunk])
-                offset += chunk
-            cursor.close()
-            self.dbh.commit()
+            with self.throttle.session():
+                while offset < len(self.sqldata):
+                    chunk = min(maxchunk, len(self.sqldata) - offset)
+                    self.throttle.acquireRows(chunk)
+                    cursor.executemany(None, self.sqldata[offset:offset + chunk])
+                    offset += chunk
+                cursor.close()
+                self.dbh.commit()
             self.info(f"Inserted {len(self.sqldata):d} rows into table {self.targettable}")
+            if not self.isPartial():
+                self.updateLedger(len(self.sqldata), time.time() - start)
+            if self.throttle.enabled():
+                self.info(f"Waited {self.throttle.waited() - waited:.2f} seconds on the insert throttle")
             self.status = 0
         except:   # pragma: no cover
             se = sys.exc_info()
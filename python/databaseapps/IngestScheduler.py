@@ -0,0 +1,164 @@
+"""
+    Concurrent execution of independent ingest tasks
+"""
+import threading
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+from databaseapps.SharedIdMap import SharedIdMap
+
+# database handle of a worker process
+_processDbh = None
+
+def _closeProcessDbh():
+    """ Close the database handle of a worker process, as it exits
+    """
+    global _processDbh  # pylint: disable=global-statement
+    if _processDbh is not None:
+        try:
+            _processDbh.close()
+        except Exception:  # pragma: no cover
+            pass
+        _processDbh = None
+
+def _runInProcess(task, idDict, options, connect):
+    """ Run a single task in a worker process, connecting on first use
+    """
+    global _processDbh  # pylint: disable=global-statement
+    if _processDbh is None:
+        _processDbh = connect()
+        multiprocessing.util.Finalize(None, _closeProcessDbh, exitpriority=10)
+    return task.run(idDict, _processDbh, options)
+
+class IngestScheduler:
+    """ Runs independent ingest tasks on a pool of worker threads, each worker
+        using its own database connection. The largest files are started
+        first so the run is not held up by a big file started last. The
+        worker threads and their connections are kept between calls to run, until
+        close is called.
+
+        Worker processes can be used instead of threads, in which case the
+        id map must be a SharedIdMap, so the workers attach to it rather than
+        each receiving a copy. The processes are forked, so they share the
+        class level configuration (metadata cache, throttle, ledger) of the
+        parent. They are forked again for every call to run, so each run sees
+        the state of the parent at the time (e.g. the metadata and catalog
+        info of the current tile), and exit with their connections at the end
+        of the run. A process which forks while other threads are running (e.g.
+        the heartbeat of a work queue) can leave its children holding locks
+        no thread will release, so in that case the tasks are run on threads
+        instead.
+
+        Parameters
+        ----------
+        jobs : int
+            The number of tasks to run at once
+
+        connect : callable
+            Function returning a new database handle, called once per worker.
+            Must be picklable when using processes (e.g. a functools.partial)
+
+        processes : bool, optional
+            Whether to use worker processes rather than threads, default is False
+    """
+    def __init__(self, jobs, connect, processes=False):
+        self.jobs = max(1, jobs)
+        self.connect = connect
+        self.processes = processes
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+        self._pool = None
+        self._downgraded = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _dbh(self):
+        """ Get the database handle of the current worker, connecting if needed
+        """
+        dbh = getattr(self._local, 'dbh', None)
+        if dbh is None:
+            dbh = self.connect()
+            self._local.dbh = dbh
+            with self._lock:
+                self._handles.append(dbh)
+        return dbh
+
+    def _run(self, task, idDict, options):
+        """ Run a single task on the current worker
+        """
+        return task.run(idDict, self._dbh(), options)
+
+    def run(self, tasks, idDict, options):
+        """ Run the tasks, which must not depend on each other
+
+            Parameters
+            ----------
+            tasks : list
+                The IngestTask objects to run
+
+            idDict : dict or SharedIdMap
+                The coadd object id map, only read by the tasks
+
+            options : dict
+                The ingest options, see IngestTask.run
+
+            Returns
+            -------
+            int
+                The sum of the task return values
+        """
+        ordered = sorted(tasks, key=lambda task: task.size(), reverse=True)
+        if self.processes:
+            if not isinstance(idDict, SharedIdMap):
+                raise TypeError("Worker processes need the id map as a SharedIdMap")
+            if threading.active_count() == 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                            mp_context=multiprocessing.get_context('fork')) as pool:
+                    return self._collect([pool.submit(_runInProcess, task, idDict, options, self.connect)
+                                          for task in ordered])
+            if not self._downgraded:
+                print("Other threads are running, using worker threads rather than processes")
+                self._downgraded = True
+        pool = self._getPool()
+        return self._collect([pool.submit(self._run, task, idDict, options) for task in ordered])
+
+    @staticmethod
+    def _collect(futures):
+        """ Wait for the tasks to finish and sum their return values
+        """
+        retval = 0
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                retval += future.result()
+            except Exception as ex:  # pragma: no cover
+                # failing to connect, task failures are handled by the task
+                print("Exception raised:", ex)
+                retval += 1
+        return retval
+
+    def _getPool(self):
+        """ Get the pool of worker threads, starting it on first use
+        """
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        return self._pool
+
+    def close(self):
+        """ Stop the workers and close their database connections
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._lock:
+            for dbh in self._handles:
+                try:
+                    dbh.close()
+                except Exception:  # pragma: no cover
+                    pass
+            self._handles = []
+            self._local = threading.local()
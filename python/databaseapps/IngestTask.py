@@ -0,0 +1,363 @@
+"""
+    A single file ingest of a multi-epoch run
+"""
+import os
+import sys
+import time
+import traceback
+from databaseapps.Ingest import Ingest
+from databaseapps.FitsIngest import FitsIngest
+from databaseapps.CoaddCatalog import CoaddCatalog
+from databaseapps.CoaddHealpix import CoaddHealpix
+from databaseapps.Mangle import Mangle
+from databaseapps.Wavg import Wavg
+from databaseapps.Extinction import Extinction
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.CoalescingWriter import CoalescingWriter
+from databaseapps.ingestutils import IngestUtils as ingestutils
+
+class IngestTask:
+    """ Describes the ingestion of a single file: which class ingests it and
+        with what arguments. The ingest object itself is only created when the
+        task is run.
+
+        Parameters
+        ----------
+        stage : str
+            The stage of the run the file belongs to (e.g. 'det', 'wavg')
+
+        label : str
+            Description of the file used in the output
+
+        ingestclass : class
+            The Ingest subclass used to ingest the file
+
+        datafile : str
+            The file to ingest
+
+        delta : bool, optional
+            Whether the file can be delta ingested, default is True
+
+        sort : bool, optional
+            Whether the rows of the file can be sorted before insertion,
+            default is False
+
+        kwargs : dict
+            Any additional arguments for the ingest class, including filetype
+    """
+    # stage, command line argument holding the file(s), whether that argument
+    # is a list file, the filetype argument, label, ingest class, and any
+    # additional arguments for the class
+    mepochStages = [('band', 'bandcat_list', True, 'coadd_object_filetype', 'band catalog', CoaddCatalog, {'ingesttype': 'band'}),
+                    ('healpix', 'healpix', False, 'coadd_hpix_filetype', 'healpix catalog', CoaddHealpix, {}),
+                    ('wavg', 'wavg_list', True, 'wavg_filetype', 'wavg catalog', Wavg, {}),
+                    ('wavg_oclink', 'wavg_oclink_list', True, 'wavg_oclink_filetype', 'wavg_oclink catalog', Wavg, {'matchCount': False}),
+                    ('ccdgon', 'ccdgon_list', True, 'ccdgon_filetype', 'ccdgon file', Mangle, {}),
+                    ('molygon', 'molygon_list', True, 'molygon_filetype', 'molygon file', Mangle, {}),
+                    ('molygon_ccdgon', 'molygon_ccdgon_list', True, 'molygon_ccdgon_filetype', 'molygon_ccdgon file', Mangle, {}),
+                    ('coadd_object_molygon', 'coadd_object_molygon_list', True, 'coadd_object_molygon_filetype',
+                     'coadd_object_molygon file', Mangle, {'replacecol': 3, 'checkcount': True}),
+                    ('extinct', 'extinct', False, 'extinct_filetype', 'extinction catalog', Extinction, {}),
+                    ('extinct_band', 'extinct_band_list', True, 'extinct_band_filetype', 'extinction catalog', Extinction, {})]
+
+    status = [" completed", " aborted"]
+
+    def __init__(self, stage, label, ingestclass, datafile, delta=True, sort=False, **kwargs):
+        self.stage = stage
+        self.label = label
+        self.ingestclass = ingestclass
+        self.datafile = datafile
+        self.delta = delta
+        self.sort = sort
+        self.kwargs = kwargs
+        self.filetype = kwargs['filetype']
+        self.shortfilename = ingestutils.getShortFilename(datafile)
+        # number of rows already ingested, if found by preflight
+        self.numIngested = None
+
+    def size(self):
+        """ The size of the file in bytes, 0 if it cannot be found
+
+        """
+        try:
+            return os.path.getsize(self.datafile)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def printinfo(msg):
+        """ Generic print statement with time stamp
+
+        """
+        print(time.strftime(Ingest.debugDateFormat) + " - " + msg)
+
+    @staticmethod
+    def getfilelist(_file):
+        """ Convert a comma separated list of items in a file into a list
+
+        """
+        files = []
+        with open(_file, 'r') as f:
+            for line in f.readlines():
+                files.append(line.split(","))
+                files[-1][-1] = files[-1][-1].strip()
+        return files
+
+    @classmethod
+    def fromArgs(cls, args):
+        """ Create the tasks for all of the files given on the mepoch_ingest
+            command line, the detection catalog first
+
+            Parameters
+            ----------
+            args : dict
+                The command line arguments
+
+            Returns
+            -------
+            list of IngestTask
+        """
+        tasks = [cls('det', 'detection catalog', CoaddCatalog, args['detcat'], sort=True,
+                     ingesttype='det', filetype=args['coadd_object_filetype'])]
+        for stage, filearg, islist, typearg, label, ingestclass, kwargs in cls.mepochStages:
+            if not args.get(filearg):
+                continue
+            if islist:
+                datafiles = [item[0] for item in cls.getfilelist(args[filearg])]
+            else:
+                datafiles = [args[filearg]]
+            kwargs = dict(kwargs, filetype=args[typearg])
+            if stage == 'coadd_object_molygon':
+                kwargs['skipmissing'] = args.get('alt_table') is not None
+            for datafile in datafiles:
+                tasks.append(cls(stage, label, ingestclass, datafile, delta=stage != 'wavg_oclink',
+                                 sort=stage == 'band', **kwargs))
+        return tasks
+
+    @staticmethod
+    def preflight(tasks, dbh):
+        """ Find the number of rows already ingested for all of the tasks, with
+            one query per target table rather than one per file. If the check
+            fails the tasks are left to query their own counts.
+
+            Parameters
+            ----------
+            tasks : list
+                The tasks to check
+
+            dbh : handle
+                The database handle to use
+        """
+        bytable = {}
+        try:
+            for task in tasks:
+                bytable.setdefault(MetadataCache.getTableName(task.filetype, dbh), []).append(task)
+            for table, tabletasks in bytable.items():
+                counts = ingestutils.countIngested(table, [task.shortfilename for task in tabletasks], dbh)
+                for task in tabletasks:
+                    task.numIngested = counts[task.shortfilename]
+        except:  # pragma: no cover
+            se = sys.exc_info()
+            print("Pre-flight check of the ingested files failed, checking each file individually:", se[1])
+            for task in tasks:
+                task.numIngested = None
+            return
+        loaded = sum(1 for task in tasks if task.numIngested)
+        IngestTask.printinfo(f"Pre-flight check: {loaded:d} of {len(tasks):d} files already have rows in the database")
+
+    @staticmethod
+    def purgeDependents(tasks, dbh):
+        """ Remove the rows of the files which reference the coadd object ids
+            of the detection catalog, the last stage first, so that the
+            detection catalog can be purged for a reingest without leaving
+            rows pointing at ids which no longer exist. The purged tasks are
+            marked as having no rows ingested, so they are not purged again.
+
+            Parameters
+            ----------
+            tasks : list
+                The tasks to purge, none of them the detection catalog
+
+            dbh : handle
+                The database handle to use
+
+            Returns
+            -------
+            int
+                The number of rows removed
+        """
+        order = [stage for stage, *_ in IngestTask.mepochStages]
+        deleted = 0
+        for task in sorted(tasks, key=lambda task: order.index(task.stage), reverse=True):
+            if task.numIngested == 0:
+                continue
+            with task.create({}, dbh) as obj:
+                deleted += obj.purge()
+            task.numIngested = 0
+        return deleted
+
+    def create(self, idDict, dbh):
+        """ Create the ingest object for the task
+
+            Parameters
+            ----------
+            idDict : dict
+                The coadd object id dictionary
+
+            dbh : handle
+                The database handle to use
+
+            Returns
+            -------
+            Ingest
+        """
+        obj = self.ingestclass(datafile=self.datafile, idDict=idDict, dbh=dbh, **self.kwargs)
+        obj.numIngested = self.numIngested
+        return obj
+
+    def run(self, idDict, dbh, options):
+        """ Ingest the file, unless it is already loaded
+
+            Parameters
+            ----------
+            idDict : dict
+                The coadd object id dictionary
+
+            dbh : handle
+                The database handle to use
+
+            options : dict
+                The ingest options: reingest, delta, deleteMissing and sortkey,
+                plus alt_table, des_services, alt_section and det_pfwid for the
+                detection catalog
+
+            Returns
+            -------
+            int
+                The status of the ingest (0 if nothing needed doing)
+        """
+        try:
+            self.printinfo("Working on " + self.label + " " + self.datafile)
+            with self.create(idDict, dbh) as obj:
+                if self.stage == 'det':
+                    return self._ingestDetection(obj, options)
+                return self._ingest(obj, options)
+        except:  # pragma: no cover
+            se = sys.exc_info()
+            e = se[1]
+            tb = se[2]
+            print(f"Exception raised while ingesting {self.label} {self.datafile}:", e)
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            return 1
+
+    def _useDelta(self, obj, options):
+        """ Whether to delta ingest the file: a delta ingest must be requested,
+            the file must already have rows in the database, and they must be
+            identifiable by their NUMBER
+        """
+        if not (self.delta and options.get('delta') and isinstance(obj, FitsIngest) and obj.numAlreadyIngested() > 0):
+            return False
+        if not obj.supportsDelta():
+            self.printinfo(f"The {self.label} {self.datafile} has no NUMBER column, it cannot be delta ingested")
+            return False
+        return True
+
+    def _ingest(self, obj, options):
+        """ Ingest a single file unless it is already loaded, optionally purging
+            it first or only ingesting the differences from what is loaded
+        """
+        sortkey = options.get('sortkey') if self.sort else None
+        if options.get('reingest'):
+            obj.purge()
+        if self._useDelta(obj, options):
+            stat = obj.deltaIngest(options.get('deleteMissing', False), sortkey=sortkey)
+            self.printinfo("Delta ingest of " + self.label + " " + self.datafile + self.status[stat] + "\n")
+            return obj.getstatus()
+        if obj.isLoaded():
+            return 0
+        stat = obj.executeIngest(sortkey)
+        self.printinfo("Ingest of " + self.label + " " + self.datafile + self.status[stat] + "\n")
+        return obj.getstatus()
+
+    def _ingestDetection(self, obj, options):
+        """ Ingest the detection catalog, or retrieve its coadd object ids if
+            it is already loaded (or is in an alternate table)
+        """
+        if options.get('alt_table') is not None:
+            obj.retrieveCoaddObjectIds(options['des_services'], options['alt_section'],
+                                       options['det_pfwid'], options['alt_table'])
+            return 0
+        sortkey = options.get('sortkey')
+        if options.get('reingest') and obj.numAlreadyIngested() > 0:
+            # keep the existing coadd object ids so the other tables stay valid
+            obj.retrieveCoaddObjectIds()
+            obj.purge()
+        elif self._useDelta(obj, options):
+            if options.get('deleteMissing'):
+                self.printinfo(f"Keeping any vanished objects of the {self.label} {self.datafile}, other tables reference their ids")
+            obj.retrieveCoaddObjectIds()
+            stat = obj.deltaIngest(sortkey=sortkey)
+            self.printinfo("Delta ingest of " + self.label + " " + self.datafile + self.status[stat] + "\n")
+            return obj.getstatus()
+        elif obj.isLoaded():
+            obj.retrieveCoaddObjectIds()
+            return 0
+        if len(obj.idDict) < obj.getNumObjects():
+            obj.getIDs()
+        stat = obj.executeIngest(sortkey)
+        self.printinfo("Ingest of " + self.label + " " + self.datafile + self.status[stat] + "\n")
+        return obj.getstatus()
+
+    @classmethod
+    def runCoalesced(cls, tasks, idDict, dbh, options, maxrows=500000):
+        """ Ingest a list of small files, merging the inserts of consecutive
+            files of the same table into shared batches. Files which need a
+            delta ingest are ingested on their own.
+
+            Parameters
+            ----------
+            tasks : list
+                The tasks to run, none of them the detection catalog
+
+            idDict : dict
+                The coadd object id dictionary
+
+            dbh : handle
+                The database handle to use
+
+            options : dict
+                The ingest options, see run
+
+            maxrows : int, optional
+                The number of rows which triggers a flush, default is 500000
+
+            Returns
+            -------
+            int
+                The number of files which failed
+        """
+        retval = 0
+        writer = CoalescingWriter(dbh, maxrows)
+        for task in tasks:
+            try:
+                cls.printinfo("Working on " + task.label + " " + task.datafile)
+                with task.create(idDict, dbh) as obj:
+                    if options.get('reingest'):
+                        obj.purge()
+                    if task._useDelta(obj, options):
+                        retval += task._ingest(obj, options)
+                    elif not obj.isLoaded():
+                        retval += writer.add(obj, options.get('sortkey') if task.sort else None)
+            except:  # pragma: no cover
+                se = sys.exc_info()
+                e = se[1]
+                tb = se[2]
+                print(f"Exception raised while ingesting {task.label} {task.datafile}:", e)
+                print("Traceback: ")
+                traceback.print_tb(tb)
+                print(" ")
+                retval += 1
+        retval += writer.flush()
+        return retval
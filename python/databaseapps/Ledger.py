@@ -0,0 +1,222 @@
+"""
+    Local ledger of completed ingests
+"""
+import os
+import time
+import hashlib
+import sqlite3
+
+class Ledger:
+    """ Persistent local record of the files which have been completely
+        ingested, kept in a SQLite file. Each entry holds the size and
+        modification time of the file, so a rerun can tell that a file is
+        already loaded without querying the database, as long as the file has
+        not changed. An md5 checksum, if one was recorded, is only computed
+        when the size matches but the modification time does not.
+
+        The entries are kept per database section, so ledgers of ingests into
+        different databases can share a directory.
+
+        Every operation opens its own connection, so a ledger can be shared by
+        threads and by processes.
+
+        Parameters
+        ----------
+        ledgerdir : str
+            The directory holding the ledger file, created if needed
+
+        section : str, optional
+            The des_services section of the database the files are ingested
+            into, default is None (no section given)
+    """
+    ledgerfile = 'ingest_ledger.sqlite'
+    # seconds to wait for another process holding the ledger locked
+    timeout = 60.
+    # bytes read at a time when computing checksums
+    blocksize = 1 << 22
+
+    def __init__(self, ledgerdir, section=None):
+        os.makedirs(ledgerdir, exist_ok=True)
+        self.path = os.path.join(ledgerdir, self.ledgerfile)
+        self.section = section or ''
+        conn = self._connect()
+        try:
+            with conn:
+                # a ledger from before the entries were kept per section says
+                # nothing about which database they are in, so it is dropped
+                columns = [rec[1] for rec in conn.execute('pragma table_info(ingested)')]
+                if columns and 'section' not in columns:
+                    conn.execute('drop table ingested')
+                conn.execute('''
+                    create table if not exists ingested (
+                        section text not null,
+                        filetype text not null,
+                        filename text not null,
+                        tablename text not null,
+                        filesize integer not null,
+                        mtime real not null,
+                        checksum text,
+                        nrows integer not null,
+                        completed real not null,
+                        elapsed real,
+                        primary key (section, filetype, filename))''')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        """ Open a connection to the ledger
+        """
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    @classmethod
+    def checksum(cls, fullname):
+        """ Compute the md5 checksum of a file
+
+            Parameters
+            ----------
+            fullname : str
+                The file
+
+            Returns
+            -------
+            str
+        """
+        md5 = hashlib.md5()
+        with open(fullname, 'rb') as fh:
+            for block in iter(lambda: fh.read(cls.blocksize), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def lookup(self, filetype, filename, fullname, table):
+        """ Get the number of rows the ledger lists as ingested from a file, if
+            the file is unchanged since it was ingested into the same table of
+            the same database section
+
+            Parameters
+            ----------
+            filetype : str
+                The filetype of the file
+
+            filename : str
+                The (short) name the file is ingested under
+
+            fullname : str
+                The path to the file
+
+            table : str
+                The table the file is ingested into
+
+            Returns
+            -------
+            int, or None if the file is not in the ledger or may have changed
+        """
+        conn = self._connect()
+        try:
+            rec = conn.execute('''
+                select tablename, filesize, mtime, checksum, nrows from ingested
+                where section=? and filetype=? and filename=?''', (self.section, filetype, filename)).fetchone()
+            if rec is None or rec[0] != table:
+                return None
+            try:
+                st = os.stat(fullname)
+            except OSError:
+                return None
+            if st.st_size != rec[1]:
+                return None
+            if st.st_mtime != rec[2]:
+                # without a checksum the database has to tell
+                if rec[3] is None or self.checksum(fullname) != rec[3]:
+                    return None
+                # same content, just touched
+                with conn:
+                    conn.execute('update ingested set mtime=? where section=? and filetype=? and filename=?',
+                                 (st.st_mtime, self.section, filetype, filename))
+            return rec[4]
+        finally:
+            conn.close()
+
+    def record(self, filetype, filename, fullname, table, nrows, elapsed=None, checksum=None):
+        """ Record a file as completely ingested. The file is not read, only
+            its size and modification time are recorded.
+
+            Parameters
+            ----------
+            filetype : str
+                The filetype of the file
+
+            filename : str
+                The (short) name the file is ingested under
+
+            fullname : str
+                The path to the file
+
+            table : str
+                The table the file was ingested into
+
+            nrows : int
+                The number of rows ingested
+
+            elapsed : float, optional
+                The time the ingest took, in seconds. Default is None (the file
+                was found to be loaded rather than ingested)
+
+            checksum : str, optional
+                The md5 checksum of the file, if already known. It lets a lookup
+                of a file which was touched but not changed avoid the database.
+                Default is None
+        """
+        st = os.stat(fullname)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('insert or replace into ingested values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (self.section, filetype, filename, table, st.st_size, st.st_mtime, checksum,
+                              nrows, time.time(), elapsed))
+        finally:
+            conn.close()
+
+    def forget(self, filetype, filename):
+        """ Remove a file from the ledger
+
+            Parameters
+            ----------
+            filetype : str
+                The filetype of the file
+
+            filename : str
+                The (short) name the file is ingested under
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('delete from ingested where section=? and filetype=? and filename=?',
+                             (self.section, filetype, filename))
+        finally:
+            conn.close()
+
+    def summary(self, since=None):
+        """ Get the ingest throughput per filetype, counting only actual
+            ingests (not files found to be already loaded)
+
+            Parameters
+            ----------
+            since : float, optional
+                Only include ingests completed after this time, default is
+                None (all)
+
+            Returns
+            -------
+            list
+                Tuples of (filetype, number of files, number of rows, total
+                seconds, rows per second)
+        """
+        conn = self._connect()
+        try:
+            recs = conn.execute('''
+                select filetype, count(*), sum(nrows), sum(elapsed) from ingested
+                where section=? and elapsed is not null and completed >= ?
+                group by filetype order by filetype''', (self.section, since or 0.)).fetchall()
+        finally:
+            conn.close()
+        return [(ft, nfiles, nrows, elapsed, nrows / elapsed if elapsed else 0.)
+                for ft, nfiles, nrows, elapsed in recs]
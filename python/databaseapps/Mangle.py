@@ -1,67 +1,376 @@
 """
     Mangle Ingestion
 """
+import os
 import sys
+import mmap
+import locale
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+import itertools
 import traceback
+import numpy as np
 from databaseapps.Ingest import Ingest
+from databaseapps.SharedIdMap import SharedIdMap
 from despymisc import miscutils
 
+# Mangle objects parsing a file in parallel, inherited by the forked workers
+_rangeParsers = {}
+
+def _parseRange(key, filename, start, end, types):
+    """ Parse a byte range of a CSV file in a worker process. Errors are
+        returned with the number of lines read up to the bad line, so the
+        parent can report the line number in the whole file.
+    """
+    parser = _rangeParsers[key]
+    parser.linecount = 0
+    rows = []
+    skip = 0
+    try:
+        for block in parser.rangeBlocks(filename, start, end):
+            brows, bskip = parser.parseBlock(block, types)
+            rows.extend(brows)
+            skip += bskip
+    except Exception as ex:  # pylint: disable=broad-except
+        return None, 0, parser.linecount, ex
+    return rows, skip, parser.linecount, None
+
 class Mangle(Ingest):
     """ Class to ingest the outputs from a Mangle run
 
     """
+    # bytes of a CSV file parsed per batch
+    batchbytes = 16 << 20
+    # bytes read at a time from a CSV file
+    blocksize = 1 << 20
+    # encoding of the CSV files, as when opening them as text
+    encoding = locale.getpreferredencoding(False)
+    # number of processes parsing a large CSV file, and the size from which
+    # a file is parsed by several processes. The processes are forked, so this
+    # is only done while no other threads are running.
+    parsejobs = 1
+    parallelbytes = 64 << 20
+
     def __init__(self, datafile, filetype, idDict, dbh, replacecol=None, checkcount=False, skipmissing=False):
         Ingest.__init__(self, filetype, datafile, "CSV", '3', dbh)
         self.hdu = "CSV"
         self.idDict = idDict
-        self.coadd_id = None
+        # position of the COADD_OBJECT_ID column, looked up on first use
+        self._coadd_id = None
+        self._coadd_id_set = False
         self.constants = {"FILENAME" : self.shortfilename}
         self.replacecol = replacecol
         self.checkcount = checkcount
         self.skipmissing = skipmissing
+        # number of lines read from the CSV file, for error reports
+        self.linecount = 0
+
+    @property
+    def coadd_id(self):
+        """ The position of the COADD_OBJECT_ID column in the file, or None
+
+        """
+        if not self._coadd_id_set:
+            if "COADD_OBJECT_ID" in self.dbDict[self.hdu]:
+                self._coadd_id = self.dbDict[self.hdu]["COADD_OBJECT_ID"].position[0]
+            self._coadd_id_set = True
+        return self._coadd_id
+
+    @coadd_id.setter
+    def coadd_id(self, value):
+        self._coadd_id = value
+        self._coadd_id_set = True
+
+    def readCSV(self, filename, types):
+        """ Read a CSV file in blocks of about batchbytes, split at line ends,
+            without holding the whole file in memory. The values are cast as
+            needed, the coadd object ids looked up and the replacecol values of
+            -1 set to None.
+
+            Yields
+            ------
+            tuple
+                The rows of the block as a list of tuples, and the number of
+                lines skipped because their id was not found
+        """
+        self.linecount = 0
+        if self.parsejobs > 1 and os.path.getsize(filename) >= self.parallelbytes:
+            # forking while another thread may hold a lock (db client, stdio)
+            # can deadlock the workers
+            if threading.active_count() == 1:
+                yield from self.readParallel(filename, types)
+                return
+            self.info(f"Other threads are running, parsing {self.shortfilename} in one process rather than {self.parsejobs:d}")
+        rest = b''
+        with open(filename, 'rb', buffering=self.blocksize) as f:
+            while True:
+                block = f.read(self.batchbytes)
+                if not block:
+                    break
+                block = rest + block
+                cut = block.rfind(b'\n') + 1
+                rest = block[cut:]
+                if cut:
+                    yield self.parseBlock(block[:cut], types)
+        if rest:
+            yield self.parseBlock(rest, types)
+
+    def readParallel(self, filename, types):
+        """ Read a CSV file by parsing newline aligned byte ranges of it in
+            parsejobs worker processes, giving the rows of the ranges in file
+            order. The workers are forked, so they share the id map rather
+            than each receiving a copy. The ranges are about batchbytes long,
+            and only a few more than parsejobs are parsed ahead of the caller,
+            so the rows sent back are held in memory a batch at a time. Line
+            numbers in errors are counted from the start of the file.
+
+            Yields
+            ------
+            tuple
+                The rows of a range as a list of tuples, and the number of
+                lines skipped because their id was not found
+        """
+        nranges = max(self.parsejobs * 2, -(-os.path.getsize(filename) // self.batchbytes))
+        ranges = iter(self.byteRanges(filename, nranges))
+        key = id(self)
+        _rangeParsers[key] = self
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.parsejobs,
+                                                        mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = collections.deque(pool.submit(_parseRange, key, filename, start, end, types)
+                                            for start, end in itertools.islice(ranges, self.parsejobs * 2))
+                linecount = 0
+                while futures:
+                    rows, skip, nlines, ex = futures.popleft().result()
+                    self.linecount = linecount + nlines
+                    if ex is not None:
+                        for other in futures:
+                            other.cancel()
+                        raise ex
+                    linecount = self.linecount
+                    for start, end in itertools.islice(ranges, 1):
+                        futures.append(pool.submit(_parseRange, key, filename, start, end, types))
+                    yield rows, skip
+        finally:
+            del _rangeParsers[key]
 
-        if "COADD_OBJECT_ID" in self.dbDict[self.hdu]:
-            self.coadd_id = self.dbDict[self.hdu]["COADD_OBJECT_ID"].position[0]
+    @staticmethod
+    def byteRanges(filename, nranges):
+        """ Split a file into about nranges byte ranges, each starting at the
+            beginning of a line
+
+            Returns
+            -------
+            list
+                The (start, end) offsets of the ranges
+        """
+        size = os.path.getsize(filename)
+        bounds = [0]
+        with open(filename, 'rb') as f:
+            for i in range(1, nranges):
+                pos = max(size * i // nranges, bounds[-1] + 1)
+                if pos >= size:
+                    break
+                # move to just after the end of the line holding byte pos - 1
+                f.seek(pos - 1)
+                f.readline()
+                bounds.append(min(f.tell(), size))
+        bounds.append(size)
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    @classmethod
+    def rangeBlocks(cls, filename, start, end):
+        """ Read a byte range of a file in blocks of about batchbytes cut at line
+            ends, memory mapping the file where possible
+
+            Yields
+            ------
+            bytes
+        """
+        with open(filename, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                f.seek(start)
+                data = f.read(end - start)
+                end -= start
+                start = 0
+            try:
+                pos = start
+                while pos < end:
+                    stop = min(pos + cls.batchbytes, end)
+                    if stop < end:
+                        cut = data.rfind(b'\n', pos, stop)
+                        if cut < 0:
+                            # a line longer than a block
+                            cut = data.find(b'\n', stop, end)
+                        stop = end if cut < 0 else cut + 1
+                    yield data[pos:stop]
+                    pos = stop
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    def parseBlock(self, block, types):
+        """ Parse a block of whole lines of a CSV file, column by column where
+            possible. Blocks the columnar parser cannot handle (carriage
+            returns, bad lines, missing ids) are parsed line by line, which
+            gives the same rows, or the same error on the same line.
+
+            Parameters
+            ----------
+            block : bytes
+                The lines to parse
+
+            types : list
+                The type of each column: int, float or str
+
+            Returns
+            -------
+            tuple
+                The rows as a list of tuples, and the number of lines skipped
+                because their id was not found
+        """
+        text = block.decode(self.encoding)
+        result = None
+        if b'\r' not in block:
+            try:
+                result = self.parseColumns(block, text, types)
+            except (ValueError, TypeError, OverflowError):
+                result = None
+        if result is None:
+            # universal newlines, as when reading the file as text
+            lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            last = lines.pop()
+            lines = [line + '\n' for line in lines]
+            if last:
+                lines.append(last)
+            result = self.parseLines(lines, types)
+        return result
+
+    def parseColumns(self, block, text, types):
+        """ Parse a block of lines with no carriage returns into typed numpy
+            columns, mapping the ids, dropping missing ids and replacing the
+            -1's with masks rather than row by row
+
+            Returns
+            -------
+            tuple
+                The rows and the number of lines skipped, or None if the block
+                has to be parsed line by line
+        """
+        ncols = len(types)
+        # check every line has the right number of columns
+        data = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(data == ord('\n')) + 1
+        if ends.size == 0 or ends[-1] != data.size:
+            ends = np.append(ends, data.size)
+        nlines = ends.size
+        commas = np.searchsorted(np.flatnonzero(data == ord(',')), ends)
+        if np.any(np.diff(commas, prepend=0) != ncols - 1):
+            return None
+        # split every field, keeping the line end on the last one of each line
+        fields = text.replace('\n', '\n,').split(',')
+        if text.endswith('\n'):
+            fields.pop()
+        columns = []
+        keep = None
+        for i, ctype in enumerate(types):
+            values = fields[i::ncols]
+            if ctype is str:
+                columns.append(values)
+                continue
+            values = np.fromiter(map(ctype, values), dtype=np.int64 if ctype is int else np.float64, count=nlines)
+            if self.coadd_id is not None and i == self.coadd_id:
+                if ctype is not int:
+                    return None
+                values, found = self.lookupIds(values)
+                if not found.all():
+                    if not self.skipmissing:
+                        return None
+                    keep = found
+            columns.append(values)
+        if self.replacecol is not None and not isinstance(columns[self.replacecol], list):
+            col = columns[self.replacecol]
+            replace = col == -1
+            if replace.any():
+                col = col.astype(object)
+                col[replace] = None
+                columns[self.replacecol] = col
+        skip = 0
+        if keep is not None:
+            skip = nlines - int(np.count_nonzero(keep))
+            columns = [list(itertools.compress(col, keep)) if isinstance(col, list) else col[keep] for col in columns]
+        columns = [col if isinstance(col, list) else col.tolist() for col in columns]
+        self.linecount += nlines
+        return list(zip(*columns)), skip
+
+    def lookupIds(self, numbers):
+        """ Translate an array of object numbers into coadd object ids
+
+            Returns
+            -------
+            tuple
+                The ids, and a boolean array of which numbers were found
+        """
+        if isinstance(self.idDict, SharedIdMap):
+            return self.idDict.lookup(numbers)
+        ids = np.fromiter(map(self.idDict.get, numbers.tolist(), itertools.repeat(-1)),
+                          dtype=np.int64, count=numbers.size)
+        return ids, ids != -1
+
+    def parseLines(self, lines, types):
+        """ Parse lines of a CSV file one at a time
+
+            Returns
+            -------
+            tuple
+                The rows as a list of tuples, and the number of lines skipped
+                because their id was not found
+        """
+        rows = []
+        skip = 0
+        for line in lines:
+            drop = False
+            self.linecount += 1
+            tdata = line.split(",")
+            if len(tdata) != len(types):
+                raise Exception("Incorrect number of columns.")
+            # cast the data appropriately
+            for i, d in enumerate(tdata):
+                if self.coadd_id is not None and i == self.coadd_id:
+                    try:
+                        tdata[i] = self.idDict[types[i](d)]
+                    except KeyError:
+                        if self.skipmissing:
+                            skip += 1
+                            drop = True
+                        else:
+                            raise
+                else:
+                    tdata[i] = types[i](d)
+            if self.replacecol is not None and tdata[self.replacecol] == -1:
+                tdata[self.replacecol] = None
+            if not drop:
+                rows.append(tuple(tdata))
+        return rows, skip
 
     def parseCSV(self, filename, types):
-        """ Parse a CSV file, casting as needed into a list of lists
+        """ Parse a CSV file, casting as needed into a list of tuples
 
         """
-        linecount = 0
+        self.linecount = 0
         try:
-            f = open(filename, 'r')
-            lines = f.readlines()
             skip = 0
-            for line in lines:
-                drop = False
-                linecount += 1
-                tdata = line.split(",")
-                if len(tdata) != len(types):
-                    raise Exception("Incorrect number of columns.")
-                # cast the data appropriately
-                for i, d in enumerate(tdata):
-                    if self.coadd_id is not None and i == self.coadd_id:
-                        try:
-                            tdata[i] = self.idDict[types[i](d)]
-                        except KeyError:
-                            se = sys.exc_info()
-                            e = se[0]
-                            if self.skipmissing:
-                                skip += 1
-                                drop = True
-                            else:
-                                raise
-                    else:
-                        tdata[i] = types[i](d)
-                if self.replacecol is not None and tdata[self.replacecol] == -1:
-                    tdata[self.replacecol] = None
-                if not drop:
-                    self.sqldata.append(tdata)
+            for rows, skipped in self.readCSV(filename, types):
+                self.sqldata.extend(rows)
+                skip += skipped
             if miscutils.fwdebug_check(10, "MANGLEINGEST_DEBUG"):
                 miscutils.fwdebug_print(self.shortfilename)
                 for d in self.sqldata:
                     miscutils.fwdebug_print(d)
-            f.close()
             if skip > 0:
                 print(f"Skipped {skip:d} items which were not found in the alternate table.")
         except:  # pragma: no cover
@@ -72,7 +381,7 @@ class Mangle(Ingest):
             print("Traceback: ")
             traceback.print_tb(tb)
 
-            miscutils.fwdebug_print(f"Error in line {linecount:d} of {self.shortfilename}")
+            miscutils.fwdebug_print(f"Error in line {self.linecount:d} of {self.shortfilename}")
             raise
 
     def generateRows(self):
@@ -110,10 +419,32 @@ class Mangle(Ingest):
     def getNumObjects(self):
         """ Get the number of objects to ingest
 
+        """
+        return self.countLines(self.fullfilename)
+
+    @classmethod
+    def countLines(cls, filename):
+        """ Count the lines of a file by scanning its bytes for newlines, a
+            last line with no newline included
+
+            Parameters
+            ----------
+            filename : str
+                The file to count
+
+            Returns
+            -------
+            int
         """
         count = 0
-        f = open(self.fullfilename, 'r')
-        lines = f.readlines()
-        count += len(lines)
-        f.close()
+        last = b'\n'
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(cls.blocksize)
+                if not block:
+                    break
+                count += block.count(b'\n')
+                last = block[-1:]
+        if last != b'\n':
+            count += 1
         return count
@@ -0,0 +1,256 @@
+"""
+    Process-wide cache of the ingest metadata tables
+"""
+import os
+import json
+import time
+import threading
+
+class MetadataCache:
+    """ Class level (process-wide) cache of the contents of ops_datafile_table
+        and ops_datafile_metadata, keyed by filetype, along with the results of
+        database object name resolution. The cache can optionally be persisted
+        to a local file, in which case entries older than the ttl are ignored
+        and re-queried.
+
+        Metadata records are stored as tuples of
+        (hdu, UPPER(attribute_name), position, column_name, datafile_datatype, derived)
+    """
+    cachefile = None
+    ttl = None
+
+    _lock = threading.RLock()
+    _tables = {}
+    _records = {}
+    _objects = {}
+
+    @classmethod
+    def configure(cls, cachefile=None, ttl=None):
+        """ Set the local file used to persist the cache and the time to live
+            of its entries, loading any entries already in the file
+
+            Parameters
+            ----------
+            cachefile : str, optional
+                The file to persist the cache to, default is None (in memory only)
+
+            ttl : float, optional
+                The time, in seconds, an entry is valid for. Default is None
+                (entries never expire)
+        """
+        with cls._lock:
+            cls.cachefile = cachefile
+            cls.ttl = ttl
+            if cachefile is None or not os.path.exists(cachefile):
+                return
+            try:
+                with open(cachefile, 'r') as fh:
+                    stored = json.load(fh)
+            except (OSError, ValueError):
+                print(f"Could not read metadata cache {cachefile}, ignoring it")
+                return
+            for filetype, (stamp, table) in stored.get('tables', {}).items():
+                cls._tables.setdefault(filetype, (stamp, table))
+            for filetype, (stamp, records) in stored.get('records', {}).items():
+                cls._records.setdefault(filetype, (stamp, [tuple(r) for r in records]))
+            for objname, (stamp, value) in stored.get('objects', {}).items():
+                cls._objects.setdefault(objname, (stamp, tuple(value)))
+
+    @classmethod
+    def clear(cls):
+        """ Empty the in memory cache
+        """
+        with cls._lock:
+            cls._tables.clear()
+            cls._records.clear()
+            cls._objects.clear()
+
+    @classmethod
+    def save(cls):
+        """ Write the cache to the local cache file, if one is configured
+        """
+        with cls._lock:
+            if cls.cachefile is None:
+                return
+            stored = {'tables': cls._tables,
+                      'records': cls._records,
+                      'objects': cls._objects}
+            tmpfile = f"{cls.cachefile}.{os.getpid()}.tmp"
+            try:
+                with open(tmpfile, 'w') as fh:
+                    json.dump(stored, fh)
+                os.replace(tmpfile, cls.cachefile)
+            except OSError as ex:
+                print(f"Could not write metadata cache {cls.cachefile}: {ex}")
+
+    @classmethod
+    def _valid(cls, entry):
+        """ Determine whether a cache entry exists and is still within its ttl
+        """
+        if entry is None:
+            return False
+        return cls.ttl is None or time.time() - entry[0] < cls.ttl
+
+    @classmethod
+    def prefetch(cls, dbh, filetypes):
+        """ Load the target table and column metadata for all of the given
+            filetypes with a single query
+
+            Parameters
+            ----------
+            dbh : handle
+                The database handle to use
+
+            filetypes : list
+                The filetypes to load
+        """
+        with cls._lock:
+            needed = sorted({ft for ft in filetypes if ft is not None and
+                             not (cls._valid(cls._tables.get(ft)) and cls._valid(cls._records.get(ft)))})
+            if not needed:
+                return
+            binds = {f"ft{i:d}": ft for i, ft in enumerate(needed)}
+            sqlstr = f'''
+                select m.filetype, t.table_name, m.hdu, UPPER(m.attribute_name), m.position,
+                    m.column_name, m.datafile_datatype, m.derived
+                from ops_datafile_metadata m
+                    left outer join ops_datafile_table t on t.filetype=m.filetype
+                where m.filetype in ({', '.join([':' + b for b in binds])})'''
+            cursor = dbh.cursor()
+            cursor.execute(sqlstr, binds)
+            found = {}
+            for rec in cursor.fetchall():
+                if rec[0] not in found:
+                    found[rec[0]] = (rec[1], [])
+                found[rec[0]][1].append(tuple(rec[2:]))
+            cursor.close()
+
+            now = time.time()
+            for filetype, (table, records) in found.items():
+                # a filetype without a target table is only used for its metadata
+                if table is not None:
+                    cls._tables[filetype] = (now, table)
+                cls._records[filetype] = (now, records)
+            cls.save()
+
+    @classmethod
+    def getTableName(cls, filetype, dbh):
+        """ Get the name of the table a filetype is ingested into
+
+            Parameters
+            ----------
+            filetype : str
+                The filetype
+
+            dbh : handle
+                The database handle to use on a cache miss
+
+            Returns
+            -------
+            str
+        """
+        with cls._lock:
+            entry = cls._tables.get(filetype)
+            if cls._valid(entry):
+                return entry[1]
+            cursor = dbh.cursor()
+            cursor.execute("select table_name from ops_datafile_table where filetype=:ftype", {'ftype': filetype})
+            records = cursor.fetchall()
+            cursor.close()
+            if not records:
+                raise Exception(f"No table listed for filetype {filetype} in ops_datafile_table")
+            cls._tables[filetype] = (time.time(), records[0][0])
+            cls.save()
+            return records[0][0]
+
+    @classmethod
+    def getRecords(cls, filetype, dbh, order=None):
+        """ Get the ops_datafile_metadata records for a filetype
+
+            Parameters
+            ----------
+            filetype : str
+                The filetype
+
+            dbh : handle
+                The database handle to use on a cache miss
+
+            order : str, optional
+                Comma separated list of (1 based) record positions to sort the
+                records by, the same as an sql order by clause. Default is None
+
+            Returns
+            -------
+            list
+        """
+        with cls._lock:
+            entry = cls._records.get(filetype)
+            if not cls._valid(entry):
+                sqlstr = '''
+                    select hdu, UPPER(attribute_name), position, column_name, datafile_datatype, derived
+                    from ops_datafile_metadata
+                    where filetype=:ftype'''
+                cursor = dbh.cursor()
+                cursor.execute(sqlstr, {'ftype': filetype})
+                entry = (time.time(), [tuple(rec) for rec in cursor.fetchall()])
+                cursor.close()
+                cls._records[filetype] = entry
+                cls.save()
+        return cls.sortRecords(entry[1], order)
+
+    @staticmethod
+    def sortRecords(records, order):
+        """ Sort records the way an sql order by clause would (ascending, nulls last)
+
+            Parameters
+            ----------
+            records : list
+                The records to sort
+
+            order : str
+                Comma separated list of (1 based) record positions to sort by
+
+            Returns
+            -------
+            list
+        """
+        if order is None:
+            return list(records)
+        positions = [int(pos) - 1 for pos in str(order).split(',')]
+        return sorted(records, key=lambda rec: [(rec[p] is None, rec[p] if rec[p] is not None else 0)
+                                                for p in positions])
+
+    @classmethod
+    def getObject(cls, objectname):
+        """ Get the cached (schema, object name) resolution of a database object
+
+            Parameters
+            ----------
+            objectname : str
+                The name of the object
+
+            Returns
+            -------
+            tuple or None if not cached
+        """
+        with cls._lock:
+            entry = cls._objects.get(objectname)
+            if cls._valid(entry):
+                return entry[1]
+            return None
+
+    @classmethod
+    def setObject(cls, objectname, value):
+        """ Cache the (schema, object name) resolution of a database object
+
+            Parameters
+            ----------
+            objectname : str
+                The name of the object
+
+            value : tuple
+                The schema and object name
+        """
+        with cls._lock:
+            cls._objects[objectname] = (time.time(), tuple(value))
+            cls.save()
@@ -0,0 +1,89 @@
+"""
+    Background read ahead of the next file to be ingested
+"""
+import os
+import concurrent.futures
+
+class ReadAhead:
+    """ Warms the next file to be ingested while the current one is being
+        inserted, by reading its start (headers and first chunks) into the
+        page cache from a background thread, and asking the kernel to read
+        ahead. Only one file is warmed at a time; asking for a new file drops
+        any request which has not started yet.
+
+        Parameters
+        ----------
+        nbytes : int, optional
+            The maximum number of bytes to read from the start of each file,
+            default is 64 MB. 0 disables the read ahead.
+    """
+    # bytes read per call when warming a file
+    blocksize = 1 << 20
+
+    def __init__(self, nbytes=64 << 20):
+        self.nbytes = nbytes
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1) if nbytes > 0 else None
+        self._pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def warm(self, fullname):
+        """ Start warming a file in the background
+
+            Parameters
+            ----------
+            fullname : str
+                The file to warm
+        """
+        if self._pool is None:
+            return
+        if self._pending is not None:
+            self._pending.cancel()
+        self._pending = self._pool.submit(self.warmFile, fullname, self.nbytes)
+
+    @classmethod
+    def warmFile(cls, fullname, nbytes):
+        """ Read the start of a file so it is in the page cache
+
+            Parameters
+            ----------
+            fullname : str
+                The file to warm
+
+            nbytes : int
+                The maximum number of bytes to read
+
+            Returns
+            -------
+            int
+                The number of bytes read
+        """
+        done = 0
+        try:
+            fd = os.open(fullname, os.O_RDONLY)
+        except OSError:
+            return 0
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_WILLNEED)
+            while done < nbytes:
+                block = os.read(fd, min(cls.blocksize, nbytes - done))
+                if not block:
+                    break
+                done += len(block)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return done
+
+    def close(self):
+        """ Stop the background thread, dropping any pending request
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
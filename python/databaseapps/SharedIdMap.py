@@ -0,0 +1,172 @@
+"""
+    Read only NUMBER -> COADD_OBJECT_ID map shared between processes
+"""
+import os
+import re
+import tempfile
+import collections.abc
+import numpy as np
+
+class SharedIdMap(collections.abc.Mapping):
+    """ Read only mapping of NUMBER to COADD_OBJECT_ID held in a memory mapped
+        file, by default in /dev/shm. The file holds a (2, n) int64 array of the
+        sorted numbers and their ids; every process attaching to it shares the
+        same pages, and pickling a map (e.g. to send it to a worker process)
+        only sends the path. The file is written under
+        a temporary name and renamed into place, so readers never see a partial
+        map.
+
+        Lookups use a binary search, so this is slower per item than a dict;
+        use lookup() to translate whole arrays at once.
+
+        Parameters
+        ----------
+        path : str
+            The map file to attach to
+    """
+    # default directory for the map files
+    shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    def __init__(self, path):
+        self.path = path
+        data = np.load(path, mmap_mode='r')
+        self._keys = data[0]
+        self._values = data[1]
+
+    @classmethod
+    def mapPath(cls, name, shmdir=None):
+        """ Get the path of the map file for a given name
+
+            Parameters
+            ----------
+            name : str
+                The name of the map, e.g. the db section, target table and
+                detection catalog file name
+
+            shmdir : str, optional
+                The directory of the map files, default is None (shmdir)
+
+            Returns
+            -------
+            str
+        """
+        return os.path.join(shmdir or cls.shmdir, "idmap_" + re.sub(r'[^\w.-]', '_', str(name)) + ".npy")
+
+    @classmethod
+    def publish(cls, idDict, path):
+        """ Write an id map to a file and attach to it
+
+            Parameters
+            ----------
+            idDict : dict
+                The NUMBER -> COADD_OBJECT_ID map
+
+            path : str
+                The file to write
+
+            Returns
+            -------
+            SharedIdMap
+        """
+        tmpfile = f"{path}.{os.getpid()}.tmp.npy"
+        data = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.int64, shape=(2, len(idDict)))
+        keys = np.fromiter(idDict.keys(), dtype=np.int64, count=len(idDict))
+        values = np.fromiter(idDict.values(), dtype=np.int64, count=len(idDict))
+        order = np.argsort(keys, kind='stable')
+        data[0] = keys[order]
+        data[1] = values[order]
+        data.flush()
+        del data
+        os.replace(tmpfile, path)
+        return cls(path)
+
+    @classmethod
+    def attach(cls, path):
+        """ Attach to an existing map file
+
+            Parameters
+            ----------
+            path : str
+                The map file
+
+            Returns
+            -------
+            SharedIdMap, or None if there is no such file
+        """
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def __reduce__(self):
+        # only the path is sent to other processes, which attach to the file
+        return (self.__class__, (self.path,))
+
+    def unlink(self):
+        """ Remove the map file, processes already attached keep their mapping
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def maxId(self):
+        """ Get the largest id in the map
+
+            Returns
+            -------
+            int, or None if the map is empty
+        """
+        if len(self._values) == 0:
+            return None
+        return int(self._values.max())
+
+    def _index(self, key):
+        """ Get the position of a key, or -1 if it is not in the map
+        """
+        try:
+            ikey = int(key)
+        except (TypeError, ValueError, OverflowError):
+            return -1
+        if ikey != key:
+            return -1
+        key = ikey
+        idx = int(np.searchsorted(self._keys, key))
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return idx
+        return -1
+
+    def __getitem__(self, key):
+        idx = self._index(key)
+        if idx < 0:
+            raise KeyError(key)
+        return int(self._values[idx])
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def __iter__(self):
+        return (int(key) for key in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, keys):
+        """ Translate an array of numbers into ids
+
+            Parameters
+            ----------
+            keys : array like
+                The numbers to translate
+
+            Returns
+            -------
+            tuple
+                The ids (0 where not found) and a boolean array of which
+                numbers were found
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self._keys) == 0:
+            return np.zeros(keys.shape, dtype=np.int64), np.zeros(keys.shape, dtype=bool)
+        idx = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found = self._keys[idx] == keys
+        return np.where(found, self._values[idx], 0), found
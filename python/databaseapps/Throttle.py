@@ -0,0 +1,130 @@
+"""
+    Client side throttle on database inserts, shared by all processes on a node
+"""
+import os
+import time
+import fcntl
+import tempfile
+import contextlib
+
+class Throttle:
+    """ Limits the number of concurrent insert sessions and the insert rate of
+        all the ingest processes on a node which share the same lock directory.
+        Sessions are limited by a set of slot lock files, the rate by a token
+        bucket kept in a state file; both are protected by flock, so locks held
+        by crashed processes are released automatically.
+
+        With no limits given the throttle does nothing.
+
+        Parameters
+        ----------
+        lockdir : str, optional
+            The directory holding the lock and state files, default is None
+            (/dev/shm if available, else the temp directory)
+
+        maxSessions : int, optional
+            The maximum number of concurrent insert sessions, default is None
+            (no limit)
+
+        maxRowsPerSec : float, optional
+            The maximum number of rows per second inserted by all processes,
+            default is None (no limit)
+    """
+    # seconds between attempts to get a free session slot
+    pollInterval = 0.5
+
+    def __init__(self, lockdir=None, maxSessions=None, maxRowsPerSec=None):
+        if lockdir is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            lockdir = os.path.join(base, 'desdm_ingest_throttle')
+        self.lockdir = lockdir
+        self.maxSessions = maxSessions
+        self.maxRowsPerSec = maxRowsPerSec
+        self.sessionWait = 0.
+        self.rowWait = 0.
+        if maxSessions or maxRowsPerSec:
+            os.makedirs(lockdir, exist_ok=True)
+
+    def enabled(self):
+        """ Whether any limit is set
+
+            Returns
+            -------
+            bool
+        """
+        return bool(self.maxSessions or self.maxRowsPerSec)
+
+    def waited(self):
+        """ The total time, in seconds, spent waiting on the throttle
+
+            Returns
+            -------
+            float
+        """
+        return self.sessionWait + self.rowWait
+
+    @contextlib.contextmanager
+    def session(self):
+        """ Context manager which holds one of the insert session slots,
+            waiting for one to become free if needed
+        """
+        if not self.maxSessions:
+            yield
+            return
+        start = time.time()
+        fh = None
+        while fh is None:
+            for slot in range(self.maxSessions):
+                slotfh = open(os.path.join(self.lockdir, f"session.{slot:d}.lock"), 'a')
+                try:
+                    fcntl.flock(slotfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    slotfh.close()
+                    continue
+                fh = slotfh
+                break
+            if fh is None:
+                time.sleep(self.pollInterval)
+        self.sessionWait += time.time() - start
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+    def acquireRows(self, nrows):
+        """ Take nrows tokens from the shared bucket, sleeping until the rate
+            allows them to be inserted. The bucket holds at most one second
+            worth of tokens.
+
+            Parameters
+            ----------
+            nrows : int
+                The number of rows about to be inserted
+        """
+        if not self.maxRowsPerSec or nrows <= 0:
+            return
+        with open(os.path.join(self.lockdir, 'rows.bucket'), 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                fh.seek(0)
+                state = fh.read().split()
+                now = time.time()
+                if len(state) == 2:
+                    tokens = min(self.maxRowsPerSec,
+                                 float(state[0]) + (now - float(state[1])) * self.maxRowsPerSec)
+                else:
+                    tokens = self.maxRowsPerSec
+                # reserve the tokens now (possibly going into debt), then wait
+                # for the debt to be paid off outside of the lock
+                tokens -= nrows
+                fh.seek(0)
+                fh.truncate()
+                fh.write(f"{tokens!r} {now!r}")
+                fh.flush()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        if tokens < 0:
+            wait = -tokens / self.maxRowsPerSec
+            time.sleep(wait)
+            self.rowWait += wait
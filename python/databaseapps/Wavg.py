@@ -14,7 +14,10 @@ class Wavg(FitsIngest):
     def __init__(self, filetype, datafile, idDict, dbh, matchCount=True):
         FitsIngest.__init__(self, filetype, datafile, idDict, dbh=dbh, matchCount=matchCount)
 
-        header = fitsio.read_header(datafile, self.dbDict[self.objhdu]['BAND'].hdu)
+    def setConstants(self):
+        """ Get the band from the file header
+        """
+        header = fitsio.read_header(self.fullfilename, self.dbDict[self.objhdu]['BAND'].hdu)
         band = header['BAND'].strip()
 
         self.constants = {
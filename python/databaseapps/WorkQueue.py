@@ -0,0 +1,220 @@
+"""
+    Queue of work items shared by ingest jobs on many nodes through a directory
+"""
+import os
+import json
+import time
+import socket
+import threading
+import contextlib
+
+class WorkQueue:
+    """ Distributes work items (e.g. the tiles of a campaign) between any
+        number of workers on any nodes which can see the same directory, with
+        no central service. Each item is a json file which moves between the
+        todo, claimed, done and failed subdirectories with atomic renames, so
+        only one worker can claim it. A claimed item carries the name of its
+        worker, who renews the lease by touching the file while working on it.
+        Claims whose lease has run out (e.g. the node crashed) are put back in
+        todo by the other workers. Lease times are measured against the clock
+        of the file system holding the queue, not that of the nodes.
+
+        Parameters
+        ----------
+        queuedir : str
+            The directory holding the queue, created if needed
+
+        lease : float, optional
+            The number of seconds a claim lasts without being renewed, default
+            is 600
+
+        owner : str, optional
+            The name of this worker, default is None (host name and process id)
+    """
+    states = ('todo', 'claimed', 'done', 'failed')
+    # separates the item name from the worker in the name of a claimed file
+    separator = '@'
+
+    def __init__(self, queuedir, lease=600., owner=None):
+        self.queuedir = queuedir
+        self.lease = lease
+        self.owner = owner or f"{socket.gethostname()}.{os.getpid():d}"
+        for state in self.states:
+            os.makedirs(os.path.join(queuedir, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.queuedir, state, name + '.json')
+
+    def _claimPath(self, name):
+        return os.path.join(self.queuedir, 'claimed', name + self.separator + self.owner)
+
+    def _names(self, state):
+        """ Get the item names in a state, with their file names
+        """
+        names = {}
+        for fname in os.listdir(os.path.join(self.queuedir, state)):
+            if state == 'claimed':
+                name = fname.rpartition(self.separator)[0]
+            elif fname.endswith('.json'):
+                name = fname[:-5]
+            else:
+                continue
+            if name:
+                names[name] = fname
+        return names
+
+    def _now(self):
+        """ Get the current time of the file system holding the queue
+        """
+        clock = os.path.join(self.queuedir, '.clock.' + self.owner)
+        with open(clock, 'a'):
+            pass
+        os.utime(clock)
+        now = os.stat(clock).st_mtime
+        os.unlink(clock)
+        return now
+
+    def submit(self, name, item):
+        """ Add an item to the queue, unless an item of the same name is
+            already in any state
+
+            Parameters
+            ----------
+            name : str
+                The unique name of the item, used as a file name
+
+            item : dict
+                The item, which must be json serializable
+
+            Returns
+            -------
+            bool
+                Whether the item was added
+        """
+        if any(name in self._names(state) for state in self.states):
+            return False
+        tmpfile = os.path.join(self.queuedir, f".{name}.{self.owner}.tmp")
+        with open(tmpfile, 'w') as fh:
+            json.dump(item, fh)
+        try:
+            # unlike rename, link does not replace an existing item
+            os.link(tmpfile, self._path('todo', name))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(tmpfile)
+
+    def claim(self):
+        """ Claim the next item in todo
+
+            Returns
+            -------
+            tuple
+                The name of the item and the item, or None if there is nothing
+                left to claim
+        """
+        for name, fname in sorted(self._names('todo').items()):
+            src = os.path.join(self.queuedir, 'todo', fname)
+            try:
+                # start the lease before the file becomes visible in claimed
+                os.utime(src)
+                os.rename(src, self._claimPath(name))
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            with open(self._claimPath(name), 'r') as fh:
+                return name, json.load(fh)
+        return None
+
+    def renew(self, name):
+        """ Renew the lease of an item claimed by this worker
+
+            Returns
+            -------
+            bool
+                False if the claim has been lost
+        """
+        try:
+            os.utime(self._claimPath(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, name, ok=True):
+        """ Move an item claimed by this worker to done, or failed
+
+            Returns
+            -------
+            bool
+                False if the claim had been lost
+        """
+        try:
+            os.rename(self._claimPath(name), self._path('done' if ok else 'failed', name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release(self, name):
+        """ Put an item claimed by this worker back in todo
+        """
+        try:
+            os.rename(self._claimPath(name), self._path('todo', name))
+        except FileNotFoundError:
+            pass
+
+    def reclaim(self):
+        """ Put the claims whose lease has run out back in todo
+
+            Returns
+            -------
+            list
+                The names of the items put back
+        """
+        now = self._now()
+        names = []
+        for name, fname in self._names('claimed').items():
+            path = os.path.join(self.queuedir, 'claimed', fname)
+            try:
+                if now - os.stat(path).st_mtime <= self.lease:
+                    continue
+                os.rename(path, self._path('todo', name))
+            except FileNotFoundError:
+                continue
+            names.append(name)
+        return names
+
+    def counts(self):
+        """ Get the number of items in each state
+
+            Returns
+            -------
+            dict
+        """
+        return {state: len(self._names(state)) for state in self.states}
+
+    @contextlib.contextmanager
+    def holding(self, name):
+        """ Context manager renewing the lease of a claimed item from a
+            background thread while the work is done. It yields an event
+            which is set if the claim is lost (e.g. the lease ran out and the
+            item was claimed by another worker), the work should then be
+            abandoned.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease / 3.):
+                if not self.renew(name):
+                    print(f"Lost the claim on {name}, it may be ingested again by another worker")
+                    lost.set()
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
@@ -11,10 +11,13 @@ import numpy
 
 import despymisc.miscutils as miscutils
 from despymisc.xmlslurp import Xmlslurper
+from databaseapps.ingestutils import IngestUtils
 
 DI_COLUMNS = 'columns'
 DI_DATATYPE = 'datatype'
 DI_FORMAT = 'format'
+# number of rows given to each insert_many_indiv call
+DI_INSERT_BATCH = 100000
 
 
 ######################################################################
@@ -26,6 +29,94 @@ def ci_get(mydict, mykey):
     return None
 # end ci_get
 
+######################################################################
+def resolve_keys(keys, attributes):
+    """ Find the key matching each attribute, ignoring case, as ci_get would
+
+        Returns a dict of attribute to key, or None if there is no match
+    """
+    lowered = {}
+    for key in keys:
+        lowered.setdefault(key.lower(), key)
+    return {attribute: lowered.get(attribute.lower()) for attribute in attributes}
+# end resolve_keys
+
+######################################################################
+def convert_value(attr, indx, datatype, rownum):
+    """ Get the value of element indx of an attribute, cast to its datatype """
+    if attr is None and datatype != 'rnum':
+        return None
+    if isinstance(attr, numpy.ndarray):
+        attr = attr.reshape(-1).tolist()
+    if isinstance(attr, list):
+        if indx < len(attr):
+            return attr[indx]
+        return None
+    if indx != 0:
+        return None
+    if datatype == 'int':
+        return int(attr)
+    if datatype == 'float':
+        return float(attr)
+    if datatype == 'rnum':
+        return rownum
+    return attr
+# end convert_value
+
+######################################################################
+def iter_fits_chunks(table, nrows):
+    """ Yield the rows of a table nrows at a time, with the number of the
+        first row of each chunk. The chunks are views, so the columns of a
+        memory mapped table are only read and converted when used.
+    """
+    for start in range(0, len(table), nrows):
+        yield start, table[start:start + nrows]
+# end iter_fits_chunks
+
+######################################################################
+def get_fits_rows(chunk, fitskeys, columns, start):
+    """ Get the values of a chunk of rows of a BINTABLE, starting at row
+        start, for each output column, a whole column at a time, giving the
+        same values as convert_value does for each cell
+
+        Returns a dict of output column position to list of values
+    """
+    values = {}
+    nrows = len(chunk)
+    stop = start + nrows
+    for pos, attribute, indx, datatype in columns:
+        key = fitskeys.get(attribute)
+        if key is None:
+            if datatype == 'rnum' and indx == 0:
+                values[pos] = numpy.arange(start + 1, stop + 1).tolist()
+            continue
+        col = chunk.field(key)
+        if col.dtype == object:
+            # variable length arrays
+            values[pos] = [convert_value(attr, indx, datatype, start + i + 1) for i, attr in enumerate(col)]
+        elif col.ndim > 1:
+            # array columns, element indx of each row
+            col = col.reshape(nrows, -1)
+            if indx < col.shape[1]:
+                values[pos] = col[:, indx].tolist()
+        elif indx != 0:
+            continue
+        elif datatype == 'rnum':
+            values[pos] = numpy.arange(start + 1, stop + 1).tolist()
+        elif datatype == 'int' and col.dtype.kind in 'biu':
+            values[pos] = col.astype(numpy.int64).tolist()
+        elif datatype == 'float' and col.dtype.kind in 'biuf':
+            values[pos] = col.astype(numpy.float64).tolist()
+        elif datatype in ('int', 'float'):
+            values[pos] = list(map(int if datatype == 'int' else float, col.tolist()))
+        elif col.dtype.kind in 'SU':
+            # as when indexing the character array, without trailing blanks
+            values[pos] = numpy.char.rstrip(numpy.asarray(col)).tolist()
+        else:
+            values[pos] = col.tolist()
+    return values
+# end get_fits_rows
+
 ######################################################################
 def print_node(indict, level, filehandle):
     """ print a node """
@@ -74,6 +165,19 @@ def ingest_datafile_contents(sourcefile, filetype, tablename, metadata, datadict
         cur = dbh.cursor()
         cur.execute(f"ALTER SESSION SET NLS_TIMESTAMP_FORMAT = '{dateformat}'")
 
+    # position of every column in columnlist, per hdu
+    positions = {}
+    pos = 0
+    for hdu, attrdict in metadata.items():
+        positions[hdu] = []
+        for attribute, coldata in attrdict.items():
+            for indx, _ in enumerate(coldata[DI_COLUMNS]):
+                positions[hdu].append((pos, attribute, indx, coldata[DI_DATATYPE]))
+                pos += 1
+        pos += 1
+    filenamepos = [i for i, col in enumerate(columnlist) if col == 'filename']
+
+    numrows = 0
     for hdu, attrdict in datadict.items():
         indata = []
         if hasattr(attrdict, "keys"):
@@ -81,49 +185,53 @@ def ingest_datafile_contents(sourcefile, filetype, tablename, metadata, datadict
         else:
             indata = attrdict
 
+        columns = positions[hdu]
+        if not columns:
+            continue
+        attributes = {attribute for _, attribute, _, _ in columns}
+        if hasattr(indata, 'columns'):
+            # BINTABLE, handled a column at a time
+            fitskeys = resolve_keys(indata.columns.names, attributes)
+            for start, chunk in iter_fits_chunks(indata, DI_INSERT_BATCH):
+                stop = start + len(chunk)
+                rows = get_fits_rows(chunk, fitskeys, columns, start)
+                rowdata = [None] * len(columnlist)
+                for pos, values in rows.items():
+                    rowdata[pos] = values
+                for pos in filenamepos:
+                    rowdata[pos] = [sourcefile] * (stop - start)
+                rowdata = [[None] * (stop - start) if values is None else values for values in rowdata]
+                dbh.insert_many_indiv(tablename, columnlist, list(zip(*rowdata)))
+                numrows += stop - start
+            continue
+        rowkeys = None
+        keymap = None
+
         rownum = 0  # counter used for rnum column
         for inrow in indata:
-            row = {}
+            row = [None] * len(columnlist)
             rownum += 1
-            for attribute, coldata in metadata[hdu].items():
-                for indx, colname in enumerate(coldata[DI_COLUMNS]):
-                    attr = None
-                    if isinstance(inrow, dict):
-                        attr = ci_get(inrow, attribute)
-                    else:
-                        fitscols = indata.columns.names
-                        for k in fitscols:
-                            if k.lower() == attribute.lower():
-                                attr = inrow.field(k)
-                                break
-                    if attr is not None or coldata[DI_DATATYPE] == 'rnum':
-                        if isinstance(attr, numpy.ndarray):
-                            attr = attr.reshape(-1).tolist()
-                        if isinstance(attr, list):
-                            if indx < len(attr):
-                                row[colname] = attr[indx]
-                            else:
-                                row[colname] = None
-                        else:
-                            if indx == 0:
-                                if coldata[DI_DATATYPE] == 'int':
-                                    row[colname] = int(attr)
-                                elif coldata[DI_DATATYPE] == 'float':
-                                    row[colname] = float(attr)
-                                elif coldata[DI_DATATYPE] == 'rnum':
-                                    row[colname] = rownum
-                                else:
-                                    row[colname] = attr
-                            else:
-                                row[colname] = None
-                    else:
-                        row[colname] = None
-            if row:
-                row["filename"] = sourcefile
-                data.append(row)
+            if isinstance(inrow, dict) and tuple(inrow) != rowkeys:
+                # rows usually share their keys, so only resolve them when they change
+                rowkeys = tuple(inrow)
+                keymap = resolve_keys(rowkeys, attributes)
+            for pos, attribute, indx, datatype in columns:
+                attr = None
+                key = keymap.get(attribute) if keymap is not None else None
+                if key is not None:
+                    attr = inrow[key] if isinstance(inrow, dict) else inrow.field(key)
+                row[pos] = convert_value(attr, indx, datatype, rownum)
+            for pos in filenamepos:
+                row[pos] = sourcefile
+            data.append(tuple(row))
+            if len(data) >= DI_INSERT_BATCH:
+                dbh.insert_many_indiv(tablename, columnlist, data)
+                numrows += len(data)
+                data = []
     if data:
         dbh.insert_many_indiv(tablename, columnlist, data)
-    return len(data)
+        numrows += len(data)
+    return numrows
 # end ingest_datafile_contents
 
 
@@ -144,9 +252,24 @@ def is_ingested(filename, tablename, dbh):
 # end is_ingested
 
 
+######################################################################
+def purge_file(fullname, tablename, dbh):
+    """ Remove the data for a file from a table, in committed batches, so it can be ingested again """
+
+    filename = miscutils.parse_fullname(fullname, miscutils.CU_PARSE_FILENAME)
+    deleted = IngestUtils.purgeFile(tablename, filename, dbh)
+    print(f"Removed {deleted:d} rows of {filename} from {tablename}")
+    return deleted
+# end purge_file
+
+
 ######################################################################
 def get_fits_data(fullname, whichhdu):
-    """ Get data from fits file header"""
+    """ Get data from fits file header, or the table of a BINTABLE hdu.
+        The file is memory mapped and its hdus loaded lazily, so only the
+        headers up to the wanted hdu are read, and table columns are only
+        read when they are used.
+    """
 
     hdu = None
     try:
@@ -154,16 +277,14 @@ def get_fits_data(fullname, whichhdu):
     except ValueError:
         hdu = str(whichhdu)
 
-    hdulist = fits.open(fullname)
-    hdr = hdulist[hdu].header
-
     mydict = {}
-    if 'XTENSION' in hdr and hdr['XTENSION'] == 'BINTABLE':
-        mydict[whichhdu] = hdulist[hdu].data
-    else:
-        mydict[whichhdu] = dict(hdr)
-
-    hdulist.close()
+    with fits.open(fullname, memmap=True, lazy_load_hdus=True) as hdulist:
+        hdr = hdulist[hdu].header
+        if 'XTENSION' in hdr and hdr['XTENSION'] == 'BINTABLE':
+            # a view of the memory mapped file, which stays open while it is used
+            mydict[whichhdu] = hdulist[hdu].data
+        else:
+            mydict[whichhdu] = dict(hdr)
 
     return mydict
 
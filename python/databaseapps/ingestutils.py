@@ -1,6 +1,8 @@
 """
     Utility class methods
 """
+import numpy as np
+from databaseapps.MetadataCache import MetadataCache
 
 class IngestUtils:
     """ Class of static untility methods
@@ -54,7 +56,8 @@ class IngestUtils:
     @staticmethod
     def resolveDbObject(objectname, dbh):
         """ Given an object name and an open DB handle, this routine returns
-            the schema that owns the object and the object name
+            the schema that owns the object and the object name. Resolved names
+            are kept in the MetadataCache.
 
             Parameters
             ----------
@@ -72,9 +75,12 @@ class IngestUtils:
         obname = None
         schema = None
         arr = objectname.split('.')
+        cached = MetadataCache.getObject(objectname) if len(arr) == 1 else None
         if len(arr) > 1:
             schema = arr[0]
             obname = arr[1]
+        elif cached is not None:
+            (schema, obname) = cached
         else:
             sqlstmt = '''
                 select USER, table_name, 0 preference from user_tables where table_name=:obj
@@ -92,4 +98,222 @@ class IngestUtils:
                 obname = rec[1]
                 break
             cursor.close()
+            if obname is not None:
+                MetadataCache.setObject(objectname, (schema, obname))
         return (schema, obname)
+
+    @staticmethod
+    def purgeFile(table, filename, dbh, batchsize=100000, expected=None, report=print):
+        """ Delete all rows from the given file out of a table, using batched
+            deletes which are committed as they go. The deletes are not
+            restricted to partitions, looking up the partitions holding the
+            file's rows costs as much as the delete itself.
+
+            Parameters
+            ----------
+            table : str
+                The table (optionally schema.table) to delete from
+
+            filename : str
+                The name of the file whose rows are to be deleted
+
+            dbh : handle
+                The database handle to use
+
+            batchsize : int, optional
+                The maximum number of rows to delete per commit, default is 100000
+
+            expected : int, optional
+                The number of rows expected to be deleted, used for progress
+                reports. Default is None (unknown)
+
+            report : function, optional
+                Function used to report progress, default is print
+
+            Returns
+            -------
+            int
+                The number of rows deleted
+        """
+        total = ''
+        if expected is not None:
+            total = f" of {expected:d}"
+        deleted = 0
+        cursor = dbh.cursor()
+        try:
+            sqlstr = f"delete from {table} where filename=:fname and rownum <= :nrows"
+            while True:
+                cursor.execute(sqlstr, {'fname': filename, 'nrows': batchsize})
+                count = cursor.rowcount
+                dbh.commit()
+                deleted += count
+                if count:
+                    report(f"Deleted {deleted:d}{total} rows of {filename} from {table}")
+                if count < batchsize:
+                    break
+        finally:
+            cursor.close()
+        return deleted
+
+    @staticmethod
+    def spreadBits(values):
+        """ Interleave the bits of the input integers with zeros (bit i moves to
+            bit 2i), as used for the healpix nested scheme
+
+            Parameters
+            ----------
+            values : numpy.ndarray
+                The (up to 32 bit) integers to spread
+
+            Returns
+            -------
+            numpy.ndarray of uint64
+        """
+        x = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                            (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                            (1, 0x5555555555555555)]:
+            x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+        return x
+
+    @staticmethod
+    def hpixNest(nside, ra, dec):
+        """ Compute the nested healpix index of the given positions, the same
+            as healpy.ang2pix(nside, ra, dec, nest=True, lonlat=True)
+
+            Parameters
+            ----------
+            nside : int
+                The healpix nside, must be a power of 2
+
+            ra : numpy.ndarray
+                The right ascensions, in degrees
+
+            dec : numpy.ndarray
+                The declinations, in degrees
+
+            Returns
+            -------
+            numpy.ndarray of int64
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        theta = 0.5 * np.pi - np.radians(np.asarray(dec, dtype=np.float64))
+        z = np.cos(theta)
+        za = np.abs(z)
+        tt = np.mod(np.radians(ra) * (2. / np.pi), 4.0)
+        # any ra wraps into [0, 360), a tiny negative one to 0 rather than 360
+        tt = np.where(tt >= 4.0, 0., tt)
+        face = np.zeros(ra.shape, dtype=np.int64)
+        ix = np.zeros(ra.shape, dtype=np.int64)
+        iy = np.zeros(ra.shape, dtype=np.int64)
+
+        # equatorial region
+        eq = za <= 2. / 3.
+        temp1 = nside * (0.5 + tt[eq])
+        temp2 = nside * (z[eq] * 0.75)
+        jp = (temp1 - temp2).astype(np.int64)
+        jm = (temp1 + temp2).astype(np.int64)
+        ifp = jp // nside
+        ifm = jm // nside
+        face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+        ix[eq] = jm & (nside - 1)
+        iy[eq] = nside - (jp & (nside - 1)) - 1
+
+        # polar caps
+        pol = ~eq
+        ntt = np.minimum(3, tt[pol].astype(np.int64))
+        tp = tt[pol] - ntt
+        # close to the poles the distance is taken from sin(theta), for accuracy
+        sth = np.sin(theta[pol])
+        nearpole = (za[pol] >= 0.99) & ((theta[pol] < 0.01) | (theta[pol] > np.pi - 0.01))
+        tmp = nside * np.where(nearpole, sth / np.sqrt((1. + za[pol]) / 3.), np.sqrt(3. * (1. - za[pol])))
+        jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+        jm = np.minimum(((1. - tp) * tmp).astype(np.int64), nside - 1)
+        north = z[pol] >= 0
+        face[pol] = np.where(north, ntt, ntt + 8)
+        ix[pol] = np.where(north, nside - jm - 1, jp)
+        iy[pol] = np.where(north, nside - jp - 1, jm)
+
+        pix = (face.astype(np.uint64) * np.uint64(nside * nside) +
+               IngestUtils.spreadBits(ix) + (IngestUtils.spreadBits(iy) << np.uint64(1)))
+        return pix.astype(np.int64)
+
+    @staticmethod
+    def countIngested(table, filenames, dbh, maxbinds=1000):
+        """ Count the rows already ingested into a table for each of the given
+            files, with one grouped query per maxbinds files
+
+            Parameters
+            ----------
+            table : str
+                The table to look in
+
+            filenames : list
+                The (short) file names
+
+            dbh : handle
+                The database handle to use
+
+            maxbinds : int, optional
+                The maximum number of file names per query, default is 1000
+
+            Returns
+            -------
+            dict
+                The number of rows for each file name, 0 if none
+        """
+        filenames = sorted(set(filenames))
+        counts = dict.fromkeys(filenames, 0)
+        cursor = dbh.cursor()
+        try:
+            for offset in range(0, len(filenames), maxbinds):
+                binds = {f"f{i:d}": fname for i, fname in enumerate(filenames[offset:offset + maxbinds])}
+                sqlstr = f'''
+                    select filename, count(*) from {table}
+                    where filename in ({', '.join([':' + b for b in binds])})
+                    group by filename'''
+                cursor.execute(sqlstr, binds)
+                for rec in cursor.fetchall():
+                    counts[rec[0]] = rec[1]
+        finally:
+            cursor.close()
+        return counts
+
+    @staticmethod
+    def fetchIntColumns(cursor, ncols, arraysize=100000, expected=None):
+        """ Stream the (integer) results of an executed query into a numpy
+            array with fetchmany, rather than building a list of all the rows
+
+            Parameters
+            ----------
+            cursor : cursor
+                The cursor the query was executed on
+
+            ncols : int
+                The number of columns the query returns
+
+            arraysize : int, optional
+                The number of rows to fetch per round trip, default is 100000
+
+            expected : int, optional
+                The expected number of rows, used to size the array up front,
+                default is None (grow as needed)
+
+            Returns
+            -------
+            numpy.ndarray
+                An (ncols, number of rows) int64 array
+        """
+        data = np.empty((ncols, expected if expected else arraysize), dtype=np.int64)
+        count = 0
+        while True:
+            records = cursor.fetchmany(arraysize)
+            if not records:
+                break
+            if count + len(records) > data.shape[1]:
+                grown = np.empty((ncols, max(2 * data.shape[1], count + len(records))), dtype=np.int64)
+                grown[:, :count] = data[:, :count]
+                data = grown
+            data[:, count:count + len(records)] = np.array(records, dtype=np.int64).reshape(len(records), ncols).T
+            count += len(records)
+        return data[:, :count]
@@ -16,6 +16,8 @@ import collections
 import fitsio
 from despydb import desdbi
 from databaseapps.ingestutils import IngestUtils as ingestutils
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.Throttle import Throttle
 
 class Timing:
     """ Class for timing
@@ -78,6 +80,8 @@ class ObjectCatalog:
     fits = None
     dodebug = True
     debugDateFormat = '%Y-%m-%d %H:%M:%S'
+    # throttle on the inserts, shared by all the catalogs in the process
+    throttle = Throttle()
     def __init__(self, request, filetype, datafile, temptable, targettable,
                  fitsheader, dumponly, services, section):
 
@@ -157,23 +161,14 @@ class ObjectCatalog:
         """ Get the columns from the tables
         """
         results = collections.OrderedDict()
-        sqlstr = '''
-            select hdu, UPPER(attribute_name), NVL(position,0),
-                column_name, NVL(derived,'h'),
-                case when datafile_datatype='int' THEN 'integer external'
-                    when datafile_datatype='float' THEN 'float external'
-                    when datafile_datatype='double' THEN 'decimal external'
-                    when datafile_datatype='char' THEN 'char'
-                end sqlldr_type
-            from ops_datafile_metadata
-            where filetype = :ftype
-            order by 1,2,3 '''
-        cursor = self.dbh.cursor()
-        params = {
-            'ftype':self.filetype,
-            }
-        cursor.execute(sqlstr, params)
-        records = cursor.fetchall()
+        sqlldr_types = {'int': 'integer external',
+                        'float': 'float external',
+                        'double': 'decimal external',
+                        'char': 'char'}
+        records = [(rec[0], rec[1], 0 if rec[2] is None else rec[2], rec[3],
+                    'h' if rec[5] is None else rec[5], sqlldr_types.get(rec[4]))
+                   for rec in MetadataCache.getRecords(self.filetype, self.dbh)]
+        records = MetadataCache.sortRecords(records, '1,2,3')
         #print records
         if not records:
             sys.exit(f"No columns listed for filetype {self.filetype} in ops_datafile_metadata, exiting")
@@ -196,7 +191,6 @@ class ObjectCatalog:
             else:
                 results[hdr][rec[1]][self.COLUMN_NAME].append(rec[3])
                 results[hdr][rec[1]][self.POSITION].append(str(rec[2]))
-        cursor.close()
         self.checkForArrays(results)
 
         return results
@@ -357,12 +351,23 @@ class ObjectCatalog:
         stmt = f'INSERT INTO {table} ({colStr}) VALUES ({vals})'
 
         curs = self.dbh.cursor()
+        maxchunk = len(rows)
+        if self.throttle.maxRowsPerSec:
+            # keep the throttled inserts smooth
+            maxchunk = max(1, min(maxchunk, int(self.throttle.maxRowsPerSec)))
+        waited = self.throttle.waited()
         try:
-            curs.executemany(stmt, rows)
-            #curs.execute('COMMIT WRITE BATCH NOWAIT')
-            self.dbh.commit()
+            with self.throttle.session():
+                for offset in range(0, len(rows), maxchunk):
+                    chunk = rows[offset:offset + maxchunk]
+                    self.throttle.acquireRows(len(chunk))
+                    curs.executemany(stmt, chunk)
+                #curs.execute('COMMIT WRITE BATCH NOWAIT')
+                self.dbh.commit()
         finally:
             curs.close()
+        if self.throttle.enabled():
+            self.info(f"Waited {self.throttle.waited() - waited:.2f} seconds on the insert throttle")
 
 
     def numAlreadyIngested(self):
@@ -392,6 +397,17 @@ class ObjectCatalog:
                 time.sleep(10)  # sleep 10 seconds and retry
 
 
+    def purge(self, batchsize=100000):
+        """ Remove the rows from this file out of the table being loaded, in
+            committed batches, so that the file can be ingested again
+        """
+        schtbl = self.tempschema + '.' + self.temptable
+        self.info(f"Removing rows of {self.shortfilename} from {schtbl} for reingest")
+        deleted = ingestutils.purgeFile(schtbl, self.shortfilename, self.dbh,
+                                        batchsize, report=self.info)
+        self.info(f"Removed {deleted:d} rows of {self.shortfilename} from {schtbl}")
+        return deleted
+
     def getNumObjects(self):
         """ Get the number of objects
         """
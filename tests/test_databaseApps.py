@@ -7,6 +7,11 @@ import sys
 import copy
 import mock
 import time
+import shutil
+import tempfile
+import threading
+import pickle
+import multiprocessing
 import numpy as np
 from mock import patch, MagicMock
 from contextlib import contextmanager
@@ -24,6 +29,16 @@ import databaseapps.datafile_ingest_utils as diu
 import databaseapps.objectcatalog as ojc
 import databaseapps.CoaddCatalog as ccol
 import databaseapps.Mangle as mgl
+import databaseapps.MetadataCache as mdc
+import databaseapps.Throttle as thr
+import databaseapps.Ledger as ldg
+import databaseapps.IdMapCache as imc
+import databaseapps.IngestScheduler as isch
+import databaseapps.SharedIdMap as sim
+import databaseapps.ReadAhead as rda
+import databaseapps.CoalescingWriter as cwr
+import databaseapps.WorkQueue as wkq
+import databaseapps.IngestTask as itk
 from despydb import desdbi
 
 import catalog_ingest as cati
@@ -374,6 +389,7 @@ port    =   0
         self.assertTrue('WCL' in cols.keys())
         self.assertTrue('FILENAME' in cols['WCL'].keys())
         try:
+            mdc.MetadataCache.clear()
             dbh.con.fakeResults(((None,'NITE', 0, 'NITE', 'int'),
                                  (0, 'EXPNUM', 0, 'EXPNUM', 'int'),
                                  ('PRIMARY', 'BAND', 0, 'BAND', 'char'),
@@ -463,6 +479,33 @@ port    =   0
         self.assertEqual(diu.ci_get(indict, 'HELLO'), 5)
         self.assertIsNone(diu.ci_get(indict, 'hellobye'))
 
+    def test_resolve_keys(self):
+        keys = diu.resolve_keys(['HeLlo', 'BYE', 'hello'], ['hello', 'Bye', 'hellobye'])
+        self.assertEqual(keys, {'hello': 'HeLlo', 'Bye': 'BYE', 'hellobye': None})
+
+    def test_ingest_datafile_rows(self):
+        dbh = MagicMock()
+        data = {'TESTER': [{'RA': [1.5, 2.5], 'Count': 3, 'comment': 'a'},
+                           {'count': 4}]}
+        res = diu.ingest_datafile_contents('test6.fits', 'fits', self.table, self.metadata, data, dbh)
+        self.assertEqual(res, 2)
+        _, columns, rows = dbh.insert_many_indiv.call_args[0]
+        self.assertEqual(columns, ['ra', 'ra2', 'count', 'rownum', 'comment', 'filename'])
+        self.assertEqual(rows, [(1.5, 2.5, 3, 1, 'a', 'test6.fits'),
+                                (None, None, 4, 2, None, 'test6.fits')])
+
+    def test_ingest_datafile_columns(self):
+        dbh = MagicMock()
+        data = make_fits().data
+        with patch.object(diu, 'DI_INSERT_BATCH', 300):
+            res = diu.ingest_datafile_contents('test7.fits', 'fits', self.table, self.metadata, {'TESTER': data}, dbh)
+        self.assertEqual(res, 1000)
+        self.assertEqual(dbh.insert_many_indiv.call_count, 4)
+        rows = [row for call in dbh.insert_many_indiv.call_args_list for row in call[0][2]]
+        self.assertEqual([row[3] for row in rows], list(range(1, 1001)))
+        self.assertEqual(rows[500], (float(data['ra'][500]), None, int(data['count'][500]), 501, 'a', 'test7.fits'))
+        self.assertTrue(isinstance(rows[0][2], int))
+
     def test_print_node(self):
         indict = {'hello': {'good': 1,
                             'bye': 2},
@@ -571,6 +614,18 @@ port    =   0
         data1 = diu.get_fits_data('test.fits', 1)
         self.assertTrue(np.array_equal(data['TESTER'], data1[1]))
 
+    def test_get_fits_header(self):
+        if not os.path.exists('test.fits'):
+            write_fits()
+        data = diu.get_fits_data('test.fits', 0)
+        self.assertTrue(isinstance(data[0], dict))
+        self.assertTrue(data[0]['SIMPLE'])
+        # the memory mapped table can still be read in chunks once the file is closed
+        table = diu.get_fits_data('test.fits', 'TESTER')['TESTER']
+        chunks = list(diu.iter_fits_chunks(table, 400))
+        self.assertEqual([start for start, _ in chunks], [0, 400, 800])
+        self.assertTrue(np.array_equal(chunks[2][1].field('count'), table.field('count')[800:]))
+
     def test_ingest_main(self):
         #print(make_xml())
         try:
@@ -614,6 +669,150 @@ class TestIngestUtils(unittest.TestCase):
         self.assertEqual(len(res), 2)
         self.assertEqual(res[0], 'test')
 
+    def test_hpixNest(self):
+        # the 12 base pixels at nside 1
+        ra = np.array([45., 135., 225., 315., 0., 90., 180., 270., 45., 135., 225., 315.])
+        dec = np.array([60.] * 4 + [0.] * 4 + [-60.] * 4)
+        res = ingutil.IngestUtils.hpixNest(1, ra, dec)
+        self.assertEqual(res.tolist(), [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+        # nested indices of neighbouring points share their parent pixel
+        res = ingutil.IngestUtils.hpixNest(4096, np.array([10., 10.0001]), np.array([-30., -30.0001]))
+        self.assertEqual(res[0] // 4 ** 6, res[1] // 4 ** 6)
+        # ra wraps around at 360, the pixels are those of healpy.ang2pix(4096, ra, dec, nest=True, lonlat=True)
+        res = ingutil.IngestUtils.hpixNest(4096, np.array([0., 360., -1e-17, 720., 359.999999, 0., 90.]),
+                                           np.array([0., 0., 0., 50., 0., -50., 89.9999]))
+        self.assertEqual(res.tolist(), [79691776, 79691776, 79691776, 11463658, 76895573, 144844842, 33554431])
+        self.assertEqual(ingutil.IngestUtils.spreadBits(np.array([3, 5])).tolist(), [5, 17])
+
+    def test_purgeFile(self):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        counts = iter([10, 10, 3])
+        def execute(sql, params):
+            curs.rowcount = next(counts)
+        curs.execute = MagicMock(side_effect=execute)
+        msgs = []
+        res = ingutil.IngestUtils.purgeFile('test.testtable', 'test.fits', dbh, batchsize=10,
+                                            expected=23, report=msgs.append)
+        self.assertEqual(res, 23)
+        self.assertEqual(dbh.commit.call_count, 3)
+        self.assertEqual(curs.execute.call_count, 3)
+        self.assertTrue(msgs[-1].startswith('Deleted 23 of 23 rows'))
+        self.assertFalse('partition' in curs.execute.call_args[0][0])
+
+    def test_countIngested(self):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.fetchall.side_effect = [[('a.fits', 5)], [('c.fits', 2)]]
+        res = ingutil.IngestUtils.countIngested('test.testtable', ['c.fits', 'a.fits', 'b.fits', 'a.fits'],
+                                                dbh, maxbinds=2)
+        self.assertEqual(res, {'a.fits': 5, 'b.fits': 0, 'c.fits': 2})
+        self.assertEqual(curs.execute.call_count, 2)
+        self.assertEqual(curs.execute.call_args_list[0][0][1], {'f0': 'a.fits', 'f1': 'b.fits'})
+
+    def test_fetchIntColumns(self):
+        curs = MagicMock()
+        curs.fetchmany.side_effect = [[(1, 10), (2, 20)], [(3, 30)], []]
+        res = ingutil.IngestUtils.fetchIntColumns(curs, 2, arraysize=2)
+        self.assertTrue(np.array_equal(res, [[1, 2, 3], [10, 20, 30]]))
+        curs.fetchmany.side_effect = [[]]
+        self.assertEqual(ingutil.IngestUtils.fetchIntColumns(curs, 2, expected=10).shape, (2, 0))
+
+
+class TestMetadataCache(unittest.TestCase):
+    def tearDown(self):
+        mdc.MetadataCache.configure()
+        mdc.MetadataCache.clear()
+        try:
+            os.unlink('metadata.cache')
+        except:
+            pass
+
+    def test_sortRecords(self):
+        recs = [('B', 'RA', 2), ('A', 'DEC', None), ('A', 'RA', 1), (None, 'DEC', 0)]
+        res = mdc.MetadataCache.sortRecords(recs, '1,2,3')
+        self.assertEqual(res[0], ('A', 'DEC', None))
+        self.assertEqual(res[-1], (None, 'DEC', 0))
+        res = mdc.MetadataCache.sortRecords(recs, '3')
+        self.assertEqual(res[0], (None, 'DEC', 0))
+        self.assertEqual(res[-1], ('A', 'DEC', None))
+        self.assertEqual(mdc.MetadataCache.sortRecords(recs, None), recs)
+
+    def test_prefetch(self):
+        dbh = MagicMock()
+        dbh.cursor.return_value.fetchall.return_value = [('wavg', 'WAVG_TABLE', 'OBJECTS', 'NUMBER', 1, 'COADD_OBJECT_ID', 'int', None),
+                                                         ('wavg', 'WAVG_TABLE', 'OBJECTS', 'BAND', 2, 'BAND', 'char', None)]
+        mdc.MetadataCache.configure('metadata.cache', 100.)
+        mdc.MetadataCache.prefetch(dbh, ['wavg', 'wavg'])
+        self.assertEqual(dbh.cursor.return_value.execute.call_count, 1)
+        self.assertEqual(mdc.MetadataCache.getTableName('wavg', dbh), 'WAVG_TABLE')
+        self.assertEqual(len(mdc.MetadataCache.getRecords('wavg', dbh)), 2)
+        mdc.MetadataCache.prefetch(dbh, ['wavg'])
+        self.assertEqual(dbh.cursor.return_value.execute.call_count, 1)
+
+        # a new process picks the entries up from the local file
+        mdc.MetadataCache.clear()
+        mdc.MetadataCache.configure('metadata.cache', 100.)
+        self.assertEqual(mdc.MetadataCache.getTableName('wavg', dbh), 'WAVG_TABLE')
+        self.assertEqual(dbh.cursor.return_value.execute.call_count, 1)
+
+        # expired entries are re-queried
+        mdc.MetadataCache.configure('metadata.cache', 0.)
+        dbh.cursor.return_value.fetchall.return_value = [('NEW_TABLE',)]
+        self.assertEqual(mdc.MetadataCache.getTableName('wavg', dbh), 'NEW_TABLE')
+        self.assertEqual(dbh.cursor.return_value.execute.call_count, 2)
+
+
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        self.lockdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lockdir)
+
+    def test_disabled(self):
+        throttle = thr.Throttle(self.lockdir)
+        self.assertFalse(throttle.enabled())
+        with throttle.session():
+            throttle.acquireRows(10000000)
+        self.assertEqual(throttle.waited(), 0.)
+
+    def test_session(self):
+        throttle = thr.Throttle(self.lockdir, maxSessions=1)
+        other = thr.Throttle(self.lockdir, maxSessions=1)
+        other.pollInterval = 0.05
+        def hold():
+            with other.session():
+                pass
+        with throttle.session():
+            worker = threading.Thread(target=hold)
+            worker.start()
+            time.sleep(0.3)
+        worker.join()
+        self.assertTrue(other.sessionWait >= 0.2)
+        self.assertTrue(throttle.sessionWait < 0.1)
+
+    def test_acquireRows(self):
+        throttle = thr.Throttle(self.lockdir, maxRowsPerSec=1000)
+        throttle.acquireRows(1000)
+        self.assertEqual(throttle.rowWait, 0.)
+        start = time.time()
+        thr.Throttle(self.lockdir, maxRowsPerSec=1000).acquireRows(500)
+        self.assertTrue(time.time() - start >= 0.4)
+
+    def test_insert_many(self):
+        # the rows of a catalog are throttled one chunk at a time
+        cat = ojc.ObjectCatalog.__new__(ojc.ObjectCatalog)
+        cat.dbh = MagicMock()
+        cat.dbh.get_positional_bind_string.return_value = ':1'
+        cat.throttle = thr.Throttle(self.lockdir, maxRowsPerSec=2)
+        with patch.object(cat.throttle, 'acquireRows') as acquire, capture_output():
+            cat.insert_many('TEMP', ['A', 'B'], [(i, i) for i in range(5)])
+        self.assertEqual([call[0][0] for call in acquire.call_args_list], [2, 2, 1])
+        curs = cat.dbh.cursor.return_value
+        self.assertEqual([len(call[0][1]) for call in curs.executemany.call_args_list], [2, 2, 1])
+        cat.dbh.commit.assert_called_once_with()
+
 
 class Testobjectcatalog(unittest.TestCase):
     @classmethod
@@ -776,15 +975,15 @@ port    =   0
     def test_setCatalogInfo_corner(self):
         dbh = desdbi.DesDbi(self.sfile, 'db-test')
         dbh.autocommit = True
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
 
         cur = dbh.cursor()
         cur.execute("insert into catalog (filename, filetype, band, tilename, pfw_attempt_id) values ('D00526157_r_c01_r3463p01_red-fullcatx.fits', 'cat_firstcut', NULL, NULL, 123)")
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
         cur.execute("update catalog set band='r' where pfw_attempt_id=123")
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
         cur.execute("update catalog set tilename='abc' where pfw_attempt_id=123")
-        _ = ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare()
 
     def test_retrieveCoaddObjectIds(self):
         os.environ['DES_SERVICES'] = self.sfile
@@ -800,6 +999,233 @@ port    =   0
         ci.retrieveCoaddObjectIds(pfwid=12345, table='COADD_OBJECT_TEST')
         self.assertTrue(ci.idDict)
 
+class TestCoaddIdRetrieval(unittest.TestCase):
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='COADD_OBJECT')
+    def test_retrieveCoaddObjectIds(self, _):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.fetchmany.side_effect = [[(1, 101), (2, 102), (1, 999)], [(3, 103)], []]
+        idDict = {3: 303}
+        ci = ccol.CoaddCatalog(ingesttype='det', filetype='coadd_cat', datafile='/a/tile_det.fits', idDict=idDict, dbh=dbh)
+        ci.retrieveCoaddObjectIds()
+        self.assertEqual(idDict, {1: 101, 2: 102, 3: 303})
+        self.assertEqual(curs.execute.call_args[0][1], {'fname': 'tile_det.fits'})
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='COADD_OBJECT')
+    def test_getIDs(self, _):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.callfunc.return_value = 1000
+        idDict = {7: 5}
+        ci = ccol.CoaddCatalog(ingesttype='det', filetype='coadd_cat', datafile='/a/tile_det.fits', idDict=idDict, dbh=dbh)
+        ccol.CoaddCatalog.reservefunc = 'reserve_id_block'
+        ci.getIDs(3)
+        curs.callfunc.assert_called_once_with('reserve_id_block', int, ['COADD_OBJECT_SEQ', 3])
+        self.assertEqual(ci.coadd_ids.tolist(), [1000, 1001, 1002])
+        ci.assignIDs(np.array([4, 7, 2, 4]))
+        ci.assignIDs(np.array([9]))
+        self.assertEqual(idDict, {7: 5, 4: 1000, 2: 1001, 9: 1002})
+        # numbers given ids elsewhere keep them
+        idDict[10] = 50
+        ci.assignIDs(np.array([10, 9, 2]))
+        self.assertEqual(idDict[10], 50)
+        with self.assertRaises(Exception):
+            ci.assignIDs(np.array([11]))
+        # fall back to the sequence if there is no reservation function, or
+        # no way to reserve a block
+        curs.callfunc.side_effect = Exception('ORA-00904')
+        curs.fetchall.return_value = [(12,), (11,)]
+        try:
+            ci.getIDs(2)
+            self.assertEqual(ci.coadd_ids.tolist(), [11, 12])
+            self.assertIsNone(ccol.CoaddCatalog.reservefunc)
+            self.assertFalse(ccol.CoaddCatalog.blockreserve)
+            # neither is tried again
+            curs.callfunc.reset_mock()
+            curs.callproc.reset_mock()
+            ci.getIDs(2)
+            curs.callfunc.assert_not_called()
+            curs.callproc.assert_not_called()
+        finally:
+            ccol.CoaddCatalog.reservefunc = None
+            ccol.CoaddCatalog.blockreserve = True
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='COADD_OBJECT')
+    def test_reserveSequenceBlock(self, _):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.var.return_value.getvalue.return_value = 'LOCKHANDLE'
+        curs.callfunc.return_value = 0
+        curs.fetchone.return_value = (1099,)
+        ci = ccol.CoaddCatalog(ingesttype='det', filetype='coadd_cat', datafile='/a/tile_det.fits', idDict={}, dbh=dbh)
+        ci.getIDs(100)
+        self.assertEqual(ci.coadd_ids.tolist(), list(range(1000, 1100)))
+        self.assertEqual([call[0][0] for call in curs.execute.call_args_list],
+                         ['alter sequence COADD_OBJECT_SEQ increment by 100',
+                          'select COADD_OBJECT_SEQ.nextval from dual',
+                          'alter sequence COADD_OBJECT_SEQ increment by 1'])
+        # the lock is held around the alters, and released
+        self.assertEqual([call[0][0] for call in curs.callfunc.call_args_list],
+                         ['dbms_lock.request', 'dbms_lock.release'])
+        # the increment is restored if taking the block fails
+        curs.execute.reset_mock()
+        curs.fetchone.side_effect = Exception('ORA-08004')
+        curs.fetchall.return_value = [(5,), (6,)]
+        try:
+            ci.getIDs(2)
+            self.assertEqual(ci.coadd_ids.tolist(), [5, 6])
+            self.assertEqual(curs.execute.call_args_list[2][0][0], 'alter sequence COADD_OBJECT_SEQ increment by 1')
+            self.assertFalse(ccol.CoaddCatalog.blockreserve)
+        finally:
+            ccol.CoaddCatalog.blockreserve = True
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='COADD_OBJECT')
+    def test_prefetchCatalogInfo(self, _):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.fetchall.return_value = [('tile_det.fits', None, 'DES0001', 12), ('tile_g.fits', 'g', 'DES0001', 12)]
+        try:
+            missing = ccol.CoaddCatalog.prefetchCatalogInfo(dbh, ['tile_g.fits', 'tile_det.fits', 'tile_r.fits'])
+            self.assertEqual(missing, ['tile_r.fits'])
+            self.assertEqual(curs.execute.call_count, 1)
+            ci = ccol.CoaddCatalog(ingesttype='band', filetype='coadd_cat', datafile='/a/tile_g.fits', idDict={}, dbh=dbh)
+            ci.setCatalogInfo('band')
+            self.assertEqual(ci.constants, {'BAND': 'g', 'TILENAME': 'DES0001', 'FILENAME': 'tile_g.fits',
+                                            'PFW_ATTEMPT_ID': 12})
+            self.assertEqual(curs.execute.call_count, 1)
+        finally:
+            ccol.CoaddCatalog.catalogInfo.clear()
+
+
+class TestFitsUpdates(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'tile_wavg.fits')
+        cols = [fits.Column(name='NUMBER', format='J', array=np.array([1, 2, 3])),
+                fits.Column(name='MAG_AUTO', format='E', array=np.array([20.5, np.nan, 22.])),
+                fits.Column(name='FLAGS', format='J', array=np.array([0, 1, 2])),
+                fits.Column(name='SPREAD', format='E', array=np.array([.1, .2, .3]))]
+        fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(cols, name='OBJECTS')]).writeto(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeIngest(self, idDict, generateID=False, keycol='COADD_OBJECT_ID'):
+        dbh = MagicMock()
+        with patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='WAVG'):
+            obj = fin.FitsIngest('coadd_wavg', self.filename, idDict, generateID=generateID, dbh=dbh)
+        obj._dbDict = {'OBJECTS': OrderedDict()}
+        for att, col in [('NUMBER', keycol), ('MAG_AUTO', 'MAG_AUTO'), ('FLAGS', 'FLAGS'), ('ZEROPOINT', 'ZEROPOINT')]:
+            obj._dbDict['OBJECTS'][att] = Ingest.Entry(hdu='OBJECTS', attribute_name=att, position=0,
+                                                       column_name=col, dtype='float')
+        return obj, dbh.cursor.return_value
+
+    def test_backfillColumns(self):
+        obj, curs = self.makeIngest({1: 101, 2: 102, 3: 103})
+        with patch.object(obj, 'fits_chunk', 2):
+            self.assertEqual(obj.backfillColumns(['mag_auto', 'NUMBER', 'ZEROPOINT', 'SPREAD']), 0)
+        # only MAG_AUTO is updated, matching the rows on the ids of their numbers
+        self.assertEqual(curs.prepare.call_args[0][0],
+                         "update WAVG set MAG_AUTO=:1 where COADD_OBJECT_ID=:2 and filename=:3")
+        rows = [row for call in curs.executemany.call_args_list for row in call[0][1]]
+        self.assertEqual(curs.executemany.call_count, 2)
+        self.assertEqual(rows, [(20.5, 101, 'tile_wavg.fits'), (None, 102, 'tile_wavg.fits'),
+                                (22., 103, 'tile_wavg.fits')])
+        obj.close()
+
+        # nothing left to update
+        obj, curs = self.makeIngest({1: 101, 2: 102, 3: 103})
+        self.assertEqual(obj.backfillColumns(['NUMBER', 'ZEROPOINT']), 0)
+        curs.prepare.assert_not_called()
+        obj.close()
+
+    def test_backfillArrayColumn(self):
+        cols = [fits.Column(name='NUMBER', format='J', array=np.array([1, 2])),
+                fits.Column(name='MAG_APER', format='3E', array=np.array([[1., 2., 3.], [4., 5., 6.]]))]
+        fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(cols, name='OBJECTS')]).writeto(self.filename,
+                                                                                                      overwrite=True)
+        obj, curs = self.makeIngest({1: 101, 2: 102})
+        # only the first and third elements have columns in the table
+        entry = Ingest.Entry(hdu='OBJECTS', attribute_name='MAG_APER', position=0, column_name='MAG_APER_1',
+                             dtype='float')
+        entry.append('MAG_APER_3', 2)
+        obj._dbDict['OBJECTS']['MAG_APER'] = entry
+        self.assertEqual(obj.backfillColumns(['MAG_APER']), 0)
+        self.assertEqual(curs.prepare.call_args[0][0],
+                         "update WAVG set MAG_APER_1=:1, MAG_APER_3=:2 where COADD_OBJECT_ID=:3 and filename=:4")
+        self.assertEqual(curs.executemany.call_args[0][1], [(1., 3., 101, 'tile_wavg.fits'),
+                                                            (4., 6., 102, 'tile_wavg.fits')])
+        obj.close()
+
+    def test_deltaIngest(self):
+        # the table holds the coadd object ids the numbers map to
+        obj, curs = self.makeIngest({1: 101, 2: 102, 3: 103})
+        with patch.object(obj, 'getIngestedKeys', return_value=np.array([101, 104])) as getkeys, \
+             patch.object(obj, 'executeIngest', return_value=0) as execingest:
+            self.assertEqual(obj.deltaIngest(deleteMissing=True, sortkey='MAG_AUTO'), 0)
+        getkeys.assert_called_once_with('COADD_OBJECT_ID')
+        self.assertEqual(obj.rowSubset.tolist(), [1, 2])
+        execingest.assert_called_once_with('MAG_AUTO')
+        self.assertEqual(curs.prepare.call_args[0][0], "delete from WAVG where filename=:1 and COADD_OBJECT_ID=:2")
+        self.assertEqual(curs.executemany.call_args[0][1], [('tile_wavg.fits', 104)])
+        obj.close()
+
+        # the table holds the numbers, new objects get new ids
+        obj, curs = self.makeIngest({1: 101, 2: 102}, generateID=True, keycol='OBJECT_NUMBER')
+        with patch.object(obj, 'getIngestedKeys', return_value=np.array([1, 2, 4])) as getkeys, \
+             patch.object(obj, 'executeIngest', return_value=0), \
+             patch.object(obj, 'getIDs', create=True) as getids:
+            self.assertEqual(obj.deltaIngest(), 0)
+        getkeys.assert_called_once_with('OBJECT_NUMBER')
+        self.assertEqual(obj.rowSubset.tolist(), [2])
+        getids.assert_called_once_with(1)
+        # vanished objects are kept unless asked otherwise
+        curs.prepare.assert_not_called()
+        # and cannot be deleted, their ids are referenced by other tables
+        with patch.object(obj, 'getIngestedKeys') as getkeys:
+            self.assertEqual(obj.deltaIngest(deleteMissing=True), 1)
+        getkeys.assert_not_called()
+        curs.prepare.assert_not_called()
+        obj.close()
+
+        # nothing new
+        obj, curs = self.makeIngest({1: 101, 2: 102, 3: 103})
+        with patch.object(obj, 'getIngestedKeys', return_value=np.array([101, 102, 103])), \
+             patch.object(obj, 'executeIngest') as execingest:
+            self.assertEqual(obj.deltaIngest(deleteMissing=True), 0)
+        execingest.assert_not_called()
+        curs.executemany.assert_not_called()
+        obj.close()
+
+    def test_deltaWithoutNumber(self):
+        obj, _ = self.makeIngest({1: 101, 2: 102, 3: 103})
+        self.assertTrue(obj.supportsDelta())
+        del obj._dbDict['OBJECTS']['NUMBER']
+        self.assertFalse(obj.supportsDelta())
+        self.assertEqual(obj.deltaIngest(), 1)
+        # the task falls back to skipping the loaded file
+        task = itk.IngestTask('wavg', 'wavg catalog', fin.FitsIngest, self.filename, filetype='coadd_wavg')
+        obj.numIngested = 3
+        with patch.object(obj, 'deltaIngest') as delta, patch.object(obj, 'isLoaded', return_value=True):
+            self.assertEqual(task._ingest(obj, {'delta': True}), 0)
+        delta.assert_not_called()
+        obj.close()
+
+
+    def test_purgeDependents(self):
+        purged = []
+        def makeTask(stage, numIngested):
+            ingestclass = MagicMock()
+            ingestclass.return_value.__enter__.return_value.purge.side_effect = lambda: purged.append(stage) or 2
+            task = itk.IngestTask(stage, stage, ingestclass, stage + '.fits', filetype='coadd_' + stage)
+            task.numIngested = numIngested
+            return task
+        tasks = [makeTask('band', 5), makeTask('wavg', None), makeTask('ccdgon', 0), makeTask('extinct', 3)]
+        self.assertEqual(itk.IngestTask.purgeDependents(tasks, MagicMock()), 6)
+        # the last stages go first, files known to be empty are skipped
+        self.assertEqual(purged, ['extinct', 'wavg', 'band'])
+        self.assertEqual([task.numIngested for task in tasks], [0, 0, 0, 0])
+
 class TestFitsIngest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -840,6 +1266,26 @@ port    =   0
         obj = fin.FitsIngest('cat_firstcut', '/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcat.fits', {}, dbh=dbh)
         self.assertTrue(hasattr(obj, 'fits'))
 
+    def test_columnToList(self):
+        res = fin.FitsIngest.columnToList(np.array([1.5, np.nan, 3.]))
+        self.assertEqual(res, [1.5, None, 3.])
+        res = fin.FitsIngest.columnToList(np.array([b'a  ', b'bc ']))
+        self.assertEqual(res, [b'a', b'bc'])
+        res = fin.FitsIngest.columnToList(np.array([1, 2], dtype=np.int32))
+        self.assertEqual(res, [1, 2])
+        self.assertTrue(isinstance(res[0], int))
+
+    def test_lazy_open(self):
+        dbh = desdbi.DesDbi(self.sfile, 'db-test')
+        with fin.FitsIngest('cat_firstcut', 'test.fits', {}, dbh=dbh, hdu='TESTER') as obj:
+            self.assertIsNone(obj._fits)
+            self.assertIsNone(obj._dbDict)
+            self.assertEqual(obj.getNumObjects(), 1000)
+            self.assertIsNone(obj._fits)
+            self.assertEqual(obj.fits['TESTER'].get_nrows(), 1000)
+            self.assertIsNotNone(obj._fits)
+        self.assertIsNone(obj._fits)
+
     def test_generate_rows_corner(self):
         dbh = desdbi.DesDbi(self.sfile, 'db-test')
         dbh.autocommit = True
@@ -858,18 +1304,18 @@ port    =   0
     def test_setCatalogInfo_corner(self):
         dbh = desdbi.DesDbi(self.sfile, 'db-test')
         dbh.autocommit = True
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
 
         cur = dbh.cursor()
         try:
             cur.execute("insert into catalog (filename, filetype, band, tilename, pfw_attempt_id) values ('D00526157_r_c01_r3463p01_red-fullcatx.fits', 'cat_firstcut', NULL, NULL, 123)")
         except:
             pass
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
         cur.execute("update catalog set band='r' where pfw_attempt_id=123")
-        self.assertRaises(SystemExit, ccol.CoaddCatalog, ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        self.assertRaises(SystemExit, ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare)
         cur.execute("update catalog set tilename='abc' where pfw_attempt_id=123")
-        _ = ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh)
+        ccol.CoaddCatalog(ingesttype='band', filetype='cat_firstcut', datafile='/var/lib/jenkins/test_data/D00526157_r_c01_r3463p01_red-fullcatx.fits', idDict={}, dbh=dbh).prepare()
 
     def test_retrieveCoaddObjectIds(self):
         os.environ['DES_SERVICES'] = self.sfile
@@ -962,7 +1408,449 @@ port    =   0
         m = mgl.Mangle(self.filename, 'mangle_csv_ccdgon',ids, checkcount=True, dbh=dbh)
         self.assertEqual(0, m.generateRows())
 
+    def test_countLines(self):
+        fh, name = tempfile.mkstemp(suffix='.csv')
+        os.close(fh)
+        try:
+            for content, count in [(b'', 0), (b'1,a\n', 1), (b'1,a\n2,b', 2), (b'1,a\n' * 5000, 5000)]:
+                with open(name, 'wb') as f:
+                    f.write(content)
+                with patch.object(mgl.Mangle, 'blocksize', 7):
+                    self.assertEqual(mgl.Mangle.countLines(name), count)
+        finally:
+            os.unlink(name)
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='MANGLE_TEST')
+    def test_parseBlock(self, _):
+        types = [int, str, float, int]
+        m = mgl.Mangle('/a/test.csv', 'mangle_csv', {1: 11, 2: 12, 3: 13}, dbh=MagicMock(), replacecol=3, skipmissing=True)
+        m.coadd_id = 0
+        block = b'1,a,1.5,-1\n4,b,2.5,7\n3,c,nan,2'
+        rows, skip = m.parseBlock(block, types)
+        self.assertEqual(rows[0], (11, 'a', 1.5, None))
+        self.assertEqual(rows[1][:2], (13, 'c'))
+        self.assertEqual(skip, 1)
+        self.assertEqual(m.linecount, 3)
+        # the same rows when parsed line by line
+        m.linecount = 0
+        rows2, skip2 = m.parseBlock(block.replace(b'\n', b'\r\n'), types)
+        self.assertEqual(rows2[0], (11, 'a', 1.5, None))
+        self.assertEqual(rows2[1][3], 2)
+        self.assertEqual(skip2, 1)
+        # errors are reported on the right line
+        m.linecount = 0
+        self.assertRaises(Exception, m.parseBlock, b'1,a,1.5,-1\n2,b\n', types)
+        self.assertEqual(m.linecount, 2)
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='MANGLE_TEST')
+    def test_readParallel(self, _):
+        types = [int, str, float]
+        fh, name = tempfile.mkstemp(suffix='.csv')
+        os.write(fh, b''.join(b'%d,t%d,%d.5\n' % (i, i, i) for i in range(2000)))
+        os.close(fh)
+        try:
+            self.assertEqual(mgl.Mangle.byteRanges(name, 7)[0][0], 0)
+            serial = mgl.Mangle(name, 'mangle_csv', {}, dbh=MagicMock())
+            serial.coadd_id = None
+            serial.parseCSV(name, types)
+            with patch.multiple(mgl.Mangle, parsejobs=3, parallelbytes=1, batchbytes=1000):
+                m = mgl.Mangle(name, 'mangle_csv', {}, dbh=MagicMock())
+                m.coadd_id = None
+                with patch.object(mgl.Mangle, 'readParallel', autospec=True,
+                                  side_effect=mgl.Mangle.readParallel) as parallel:
+                    m.parseCSV(name, types)
+                    self.assertEqual(parallel.call_count, 1 if threading.active_count() == 1 else 0)
+                    self.assertEqual(m.sqldata, serial.sqldata)
+                    self.assertEqual(m.linecount, 2000)
+                    # never forks while other threads are running
+                    stop = threading.Event()
+                    other = threading.Thread(target=stop.wait)
+                    other.start()
+                    try:
+                        parallel.reset_mock()
+                        m = mgl.Mangle(name, 'mangle_csv', {}, dbh=MagicMock())
+                        m.coadd_id = None
+                        with capture_output() as (out, _):
+                            m.parseCSV(name, types)
+                    finally:
+                        stop.set()
+                        other.join()
+                    parallel.assert_not_called()
+                    self.assertIn('in one process rather than', out.getvalue())
+                    self.assertEqual(m.sqldata, serial.sqldata)
+                # errors give the line in the whole file
+                with open(name, 'ab') as f:
+                    f.write(b'1,a\n')
+                m = mgl.Mangle(name, 'mangle_csv', {}, dbh=MagicMock())
+                m.coadd_id = None
+                with capture_output():
+                    self.assertRaises(Exception, m.parseCSV, name, types)
+                self.assertEqual(m.linecount, 2001)
+        finally:
+            os.unlink(name)
+
+
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.ledgerdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.ledgerdir, 'test.fits')
+        open(self.datafile, 'w').write('some data')
+
+    def tearDown(self):
+        shutil.rmtree(self.ledgerdir)
+
+    def test_lookup(self):
+        ledger = ldg.Ledger(self.ledgerdir)
+        self.assertIsNone(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+        ledger.record('cat', 'test.fits', self.datafile, 'TABLE', 12, 2.)
+        self.assertEqual(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'), 12)
+        self.assertIsNone(ledger.lookup('cat', 'test.fits', self.datafile, 'OTHER'))
+        # touched, the file is not read as no checksum was recorded
+        os.utime(self.datafile, (1000., 1000.))
+        with patch.object(ldg.Ledger, 'checksum') as checksum:
+            self.assertIsNone(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+        checksum.assert_not_called()
+        # touched but unchanged
+        ledger.record('cat', 'test.fits', self.datafile, 'TABLE', 12, 2., ldg.Ledger.checksum(self.datafile))
+        os.utime(self.datafile, (2000., 2000.))
+        self.assertEqual(ldg.Ledger(self.ledgerdir).lookup('cat', 'test.fits', self.datafile, 'TABLE'), 12)
+        # changed contents
+        open(self.datafile, 'w').write('more data')
+        self.assertIsNone(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+        ledger.forget('cat', 'test.fits')
+        self.assertIsNone(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+
+    def test_section(self):
+        ledger = ldg.Ledger(self.ledgerdir, 'db-desoper')
+        ledger.record('cat', 'test.fits', self.datafile, 'TABLE', 12, 2.)
+        self.assertEqual(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'), 12)
+        # the same table name in another database
+        other = ldg.Ledger(self.ledgerdir, 'db-destest')
+        self.assertIsNone(other.lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+        self.assertIsNone(ldg.Ledger(self.ledgerdir).lookup('cat', 'test.fits', self.datafile, 'TABLE'))
+        self.assertEqual(other.summary(), [])
+        other.forget('cat', 'test.fits')
+        self.assertEqual(ledger.lookup('cat', 'test.fits', self.datafile, 'TABLE'), 12)
+
+    def test_summary(self):
+        ledger = ldg.Ledger(self.ledgerdir)
+        ledger.record('cat', 'a.fits', self.datafile, 'TABLE', 100, 2.)
+        ledger.record('cat', 'b.fits', self.datafile, 'TABLE', 300, 2.)
+        ledger.record('wavg', 'c.fits', self.datafile, 'TABLE', 10)
+        self.assertEqual(ledger.summary(), [('cat', 2, 400, 4., 100.)])
+        self.assertEqual(ledger.summary(time.time() + 10), [])
+
+
+class TestIdMapCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        ccol.CoaddCatalog.idmapCache = None
+
+    def test_load(self):
+        cache = imc.IdMapCache(self.cachedir)
+        self.assertIsNone(cache.load('ALT_123', 3, 103))
+        cache.store('ALT_123', np.array([1, 2, 3]), np.array([101, 103, 102]))
+        numbers, ids = cache.load('ALT_123', 3, 103)
+        self.assertEqual(numbers.tolist(), [1, 2, 3])
+        self.assertEqual(ids.tolist(), [101, 103, 102])
+        # the database no longer matches
+        self.assertIsNone(cache.load('ALT_123', 4, 103))
+        self.assertIsNone(cache.load('ALT_123', 3, 104))
+        # corrupted map
+        data = np.load(cache.path('ALT_123'))
+        data[1, 0] = 5
+        np.save(cache.path('ALT_123'), data)
+        self.assertIsNone(cache.load('ALT_123', 3, 103))
+
+    @patch('databaseapps.Ingest.MetadataCache.getTableName', return_value='COADD_OBJECT')
+    def test_retrieveCoaddObjectIds(self, _):
+        ccol.CoaddCatalog.idmapCache = imc.IdMapCache(self.cachedir)
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        curs.fetchone.return_value = (2, 102)
+        curs.fetchmany.side_effect = [[(1, 101), (2, 102)], []]
+        idDict = {}
+        ci = ccol.CoaddCatalog(ingesttype='det', filetype='coadd_cat', datafile='/a/tile_det.fits', idDict=idDict, dbh=dbh)
+        ci.retrieveCoaddObjectIds()
+        self.assertEqual(curs.fetchmany.call_count, 2)
+        # the rerun uses the cached map
+        idDict.clear()
+        ci.retrieveCoaddObjectIds()
+        self.assertEqual(curs.fetchmany.call_count, 2)
+        self.assertEqual(idDict, {1: 101, 2: 102})
+
+
+class TestIngestScheduler(unittest.TestCase):
+    class FakeTask:
+        def __init__(self, name, size, status, order):
+            self.name = name
+            self._size = size
+            self.status = status
+            self.order = order
+
+        def size(self):
+            return self._size
+
+        def run(self, idDict, dbh, options):
+            self.order.append(self.name)
+            time.sleep(0.1)
+            return self.status
+
+    def test_run(self):
+        order = []
+        handles = []
+        def connect():
+            handles.append(MagicMock())
+            return handles[-1]
+        tasks = [self.FakeTask('small', 1, 0, order),
+                 self.FakeTask('large', 100, 1, order),
+                 self.FakeTask('medium', 10, 1, order)]
+        with isch.IngestScheduler(1, connect) as scheduler:
+            self.assertEqual(scheduler.run(tasks, {}, {}), 2)
+            self.assertEqual(order, ['large', 'medium', 'small'])
+            # the worker keeps its connection between runs
+            self.assertEqual(scheduler.run(tasks, {}, {}), 2)
+            self.assertEqual(len(handles), 1)
+        self.assertEqual(handles[0].close.call_count, 1)
+
+        with isch.IngestScheduler(3, connect) as scheduler:
+            start = time.time()
+            self.assertEqual(scheduler.run(tasks, {}, {}), 2)
+            self.assertTrue(time.time() - start < 0.25)
+        self.assertEqual(len(handles), 4)
 
+    class FakeConnection:
+        def close(self):
+            pass
+
+    class StateTask:
+        state = 0
+
+        def size(self):
+            return 0
+
+        def run(self, idDict, dbh, options):
+            type(self).pids.add(os.getpid())
+            return type(self).state + idDict[1]
+
+    def test_processes(self):
+        mapdir = tempfile.mkdtemp()
+        idmap = sim.SharedIdMap.publish({1: 10}, os.path.join(mapdir, 'map.npy'))
+        self.StateTask.pids = set()
+        try:
+            with isch.IngestScheduler(2, self.FakeConnection, processes=True) as scheduler, \
+                 patch('databaseapps.IngestScheduler.threading.active_count', return_value=1):
+                self.assertEqual(scheduler.run([self.StateTask()], idmap, {}), 10)
+                # the workers of each run are forked with the current state of the parent
+                self.StateTask.state = 1
+                self.assertEqual(scheduler.run([self.StateTask(), self.StateTask()], idmap, {}), 22)
+                self.assertRaises(TypeError, scheduler.run, [self.StateTask()], {1: 10}, {})
+            # the tasks ran in the workers, whose changes the parent does not see
+            self.assertEqual(self.StateTask.pids, set())
+            # never forks while other threads are running
+            with isch.IngestScheduler(2, self.FakeConnection, processes=True) as scheduler, \
+                 patch('databaseapps.IngestScheduler.threading.active_count', return_value=2), \
+                 capture_output() as (out, _):
+                self.assertEqual(scheduler.run([self.StateTask(), self.StateTask()], idmap, {}), 22)
+                self.assertEqual(scheduler.run([self.StateTask()], idmap, {}), 11)
+            self.assertEqual(self.StateTask.pids, {os.getpid()})
+            self.assertEqual(out.getvalue().count('using worker threads'), 1)
+        finally:
+            self.StateTask.state = 0
+            shutil.rmtree(mapdir)
+
+
+class TestSharedIdMap(unittest.TestCase):
+    def setUp(self):
+        self.mapdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mapdir)
+
+    def test_publish(self):
+        path = sim.SharedIdMap.mapPath('test_det.fits', self.mapdir)
+        self.assertIsNone(sim.SharedIdMap.attach(path))
+        idmap = sim.SharedIdMap.publish({5: 50, 1: 10, 3: 30}, path)
+        self.assertEqual(dict(idmap), {1: 10, 3: 30, 5: 50})
+        self.assertTrue(3 in idmap)
+        self.assertFalse(4 in idmap)
+        self.assertFalse(3.5 in idmap)
+        self.assertRaises(KeyError, idmap.__getitem__, 4)
+        self.assertEqual(idmap.maxId(), 50)
+        ids, found = idmap.lookup([1, 2, 5, 9])
+        self.assertTrue(np.array_equal(ids, [10, 0, 50, 0]))
+        self.assertTrue(np.array_equal(found, [True, False, True, False]))
+
+        other = sim.SharedIdMap.attach(path)
+        self.assertEqual(len(other), 3)
+        self.assertEqual(pickle.loads(pickle.dumps(idmap)).path, path)
+        with multiprocessing.get_context('fork').Pool(1) as pool:
+            self.assertEqual(pool.map(idmap.get, [1, 4]), [10, None])
+
+        idmap.unlink()
+        self.assertIsNone(sim.SharedIdMap.attach(path))
+        self.assertEqual(other[5], 50)
+
+    def test_empty(self):
+        idmap = sim.SharedIdMap.publish({}, os.path.join(self.mapdir, 'empty.npy'))
+        self.assertEqual(len(idmap), 0)
+        self.assertFalse(1 in idmap)
+        self.assertFalse(idmap.lookup([1])[1][0])
+        self.assertIsNone(idmap.maxId())
+
+    def test_mapPath(self):
+        path = sim.SharedIdMap.mapPath('db-desoper_COADD_OBJECT_tile/det.fits', self.mapdir)
+        self.assertEqual(path, os.path.join(self.mapdir, 'idmap_db-desoper_COADD_OBJECT_tile_det.fits.npy'))
+
+
+class TestReadAhead(unittest.TestCase):
+    def test_warmFile(self):
+        fh, name = tempfile.mkstemp()
+        os.write(fh, b'x' * 3000)
+        os.close(fh)
+        try:
+            self.assertEqual(rda.ReadAhead.warmFile(name, 1000), 1000)
+            self.assertEqual(rda.ReadAhead.warmFile(name, 5000), 3000)
+            self.assertEqual(rda.ReadAhead.warmFile(name + '.missing', 5000), 0)
+            with rda.ReadAhead(2000) as readahead:
+                readahead.warm(name)
+                self.assertEqual(readahead._pending.result(), 2000)
+            readahead = rda.ReadAhead(0)
+            readahead.warm(name)
+            self.assertIsNone(readahead._pending)
+        finally:
+            os.unlink(name)
+
+
+class TestCoalescingWriter(unittest.TestCase):
+    def makeObj(self, name, table, nrows):
+        obj = MagicMock()
+        obj.shortfilename = name
+        obj.targettable = table
+        obj.constants = {'FILENAME': name}
+        obj.generateRows.return_value = 0
+        obj.getInsertColumns.return_value = ['COADD_OBJECT_ID', 'MAG']
+        obj.sqldata = [[i, 1.5] for i in range(nrows)]
+        return obj
+
+    def test_add(self):
+        dbh = MagicMock()
+        curs = dbh.cursor.return_value
+        writer = cwr.CoalescingWriter(dbh, maxrows=10)
+        objs = [self.makeObj('a.csv', 'T1', 3), self.makeObj('b.csv', 'T1', 4),
+                self.makeObj('c.csv', 'T2', 2)]
+        for obj in objs:
+            self.assertEqual(writer.add(obj), 0)
+        # the change of table flushed the first two files together
+        self.assertEqual(dbh.commit.call_count, 1)
+        self.assertEqual(curs.prepare.call_args[0][0],
+                         'insert into T1 (FILENAME, COADD_OBJECT_ID, MAG) values (:1, :2, :3)')
+        rows = curs.executemany.call_args[0][1]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[3], ['b.csv', 0, 1.5])
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(dbh.commit.call_count, 2)
+        self.assertEqual(objs[2].updateLedger.call_args[0][0], 2)
+
+        bad = self.makeObj('d.csv', 'T1', 1)
+        bad.generateRows.return_value = 1
+        self.assertEqual(writer.add(bad), 1)
+        self.assertEqual(writer.flush(), 0)
+
+
+def _drainQueue(queuedir):
+    queue = wkq.WorkQueue(queuedir, lease=5.)
+    names = []
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            return names
+        with queue.holding(claimed[0]):
+            time.sleep(0.01)
+        queue.complete(claimed[0])
+        names.append(claimed[1]['detcat'])
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.queuedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.queuedir)
+
+    def test_claim(self):
+        queue = wkq.WorkQueue(self.queuedir)
+        for i in range(40):
+            self.assertTrue(queue.submit(f"T{i:02d}", {'detcat': f"t{i:d}_det.fits"}))
+        self.assertFalse(queue.submit('T00', {'detcat': 't0_det.fits'}))
+        # every tile is ingested exactly once by the worker processes
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.map(_drainQueue, [self.queuedir] * 4)
+        done = sorted(name for names in results for name in names)
+        self.assertEqual(done, sorted(f"t{i:d}_det.fits" for i in range(40)))
+        self.assertEqual(queue.counts(), {'todo': 0, 'claimed': 0, 'done': 40, 'failed': 0})
+        self.assertFalse(queue.submit('T00', {'detcat': 't0_det.fits'}))
+
+    def test_reclaim(self):
+        crashed = wkq.WorkQueue(self.queuedir, lease=60., owner='crashed')
+        crashed.submit('T1', {'detcat': 't1_det.fits'})
+        self.assertEqual(crashed.claim()[0], 'T1')
+        queue = wkq.WorkQueue(self.queuedir, lease=60.)
+        self.assertIsNone(queue.claim())
+        self.assertEqual(queue.reclaim(), [])
+        # the crashed worker stops renewing its lease
+        claimfile = os.path.join(self.queuedir, 'claimed', 'T1@crashed')
+        os.utime(claimfile, (time.time() - 120, time.time() - 120))
+        self.assertEqual(queue.reclaim(), ['T1'])
+        self.assertEqual(queue.claim()[0], 'T1')
+        self.assertFalse(crashed.renew('T1'))
+        self.assertFalse(crashed.complete('T1'))
+        self.assertTrue(queue.complete('T1', ok=False))
+        self.assertEqual(queue.counts()['failed'], 1)
+
+    def test_holding(self):
+        queue = wkq.WorkQueue(self.queuedir, lease=0.3, owner='slow')
+        queue.submit('T1', {'detcat': 't1_det.fits'})
+        queue.claim()
+        with capture_output():
+            with queue.holding('T1') as lost:
+                time.sleep(0.25)
+                self.assertFalse(lost.is_set())
+                # another worker takes over the tile
+                os.rename(os.path.join(self.queuedir, 'claimed', 'T1@slow'),
+                          os.path.join(self.queuedir, 'claimed', 'T1@other'))
+                self.assertTrue(lost.wait(1.))
+        self.assertFalse(queue.complete('T1'))
+        self.assertRaises(Exception, mei.checkClaim, lost)
+        mei.checkClaim(None)
+
+
+class TestManifest(unittest.TestCase):
+    def test_readManifest(self):
+        fh, name = tempfile.mkstemp(suffix='.json')
+        os.write(fh, b'''{"tiles": [{"name": "T1", "detcat": "cat/t1_det.fits", "wavg_list": "t1.list"},
+                                    {"detcat": "cat/t2_det.fits", "det_pfwid": 12}]}''')
+        os.close(fh)
+        args = {'detcat': None, 'wavg_list': None, 'det_pfwid': None, 'wavg_filetype': 'coadd_wavg'}
+        try:
+            tiles = mei.readManifest(name, args)
+            self.assertEqual(len(tiles), 2)
+            self.assertEqual(tiles[0]['name'], 'T1')
+            self.assertEqual(tiles[0]['wavg_list'], 't1.list')
+            self.assertEqual(tiles[0]['wavg_filetype'], 'coadd_wavg')
+            self.assertEqual(tiles[1]['name'], 't2_det.fits')
+            self.assertEqual(tiles[1]['det_pfwid'], 12)
+            self.assertIsNone(args['detcat'])
+
+            open(name, 'w').write('[{"detcat": "cat/t1_det.fits", "bogus": 1}]')
+            self.assertRaises(Exception, mei.readManifest, name, args)
+        finally:
+            os.unlink(name)
 
 
 if __name__ == '__main__':